@@ -5,4 +5,14 @@
 
 """
 
-from .database import Database, MetatabManager
+__all__ = ['Database', 'MetatabManager']
+
+
+def __getattr__(name):
+    # Importing the database module loads SqlAlchemy and the ORM, so it is deferred until
+    # it is used, which keeps importing the package, and the mt subcommands, fast.
+    if name in __all__:
+        from . import database
+        return getattr(database, name)
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
@@ -0,0 +1,294 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A local, content-addressed cache for resource sources.
+
+Downloaded files are stored once, under the SHA256 digest of their contents, and a
+key file, named for the digest of the URL and a fingerprint, points to the content.
+Files are written to a temporary file and moved into place, so several processes can
+share one cache directory. The modification time of the content files is used as the
+access time for LRU eviction when the cache grows past its size limit. Key files are
+removed with the content they point to.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+from os.path import basename, exists, join, splitext
+from urllib.parse import unquote, urlparse
+from urllib.request import Request, urlopen
+
+CACHEABLE_SCHEMES = ('http', 'https', 'ftp', 'file')
+
+
+class DownloadCache(object):
+    """Content-addressed cache of resource source files"""
+
+    def __init__(self, root, max_size=10 * 1024 ** 3, chunk_size=1024 * 1024):
+        """
+        :param root: Directory to store the cache in
+        :param max_size: Maximum size of the cached content, in bytes. When a download
+        pushes the cache past this size, the least recently used files are removed.
+        :param chunk_size: Size of reads when downloading
+        """
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_downloaded = 0
+
+        for d in ('objects', 'keys', 'tmp'):
+            os.makedirs(join(self.root, d), exist_ok=True)
+
+    @staticmethod
+    def cacheable(url):
+        """Return True if the url, a string, can be fetched by the cache"""
+        return urlparse(str(url)).scheme in CACHEABLE_SCHEMES
+
+    @staticmethod
+    def _file_path(url):
+        return unquote(urlparse(url).path)
+
+    def default_fingerprint(self, url):
+        """Fingerprint for a url when the caller doesn't supply one, so a changed source is
+        fetched again. Local files are keyed on their size and modification time. HTTP sources
+        are keyed on the ETag, Last-Modified and Content-Length headers of a HEAD request. Other
+        sources, and HTTP sources whose server doesn't answer the HEAD request, have no fingerprint"""
+
+        scheme = urlparse(url).scheme
+
+        if scheme == 'file':
+            st = os.stat(self._file_path(url))
+            return '{}:{}'.format(st.st_size, st.st_mtime_ns)
+
+        if scheme in ('http', 'https'):
+            try:
+                with urlopen(Request(url, method='HEAD'), timeout=30) as r:
+                    headers = r.headers
+            except (IOError, ValueError):
+                return ''
+
+            return '{}:{}:{}'.format(headers.get('ETag', ''), headers.get('Last-Modified', ''),
+                                     headers.get('Content-Length', ''))
+
+        return ''
+
+    def key(self, url, fingerprint=None):
+        """Return the cache key for a url and fingerprint"""
+
+        if fingerprint is None:
+            fingerprint = self.default_fingerprint(url)
+
+        return hashlib.sha256('{}\0{}'.format(url, fingerprint).encode('utf8')).hexdigest()
+
+    def _key_path(self, key):
+        return join(self.root, 'keys', key[:2], key)
+
+    def _object_path(self, digest, ext):
+        return join(self.root, 'objects', digest[:2], digest + ext)
+
+    def _tempfile(self):
+        return tempfile.mkstemp(dir=join(self.root, 'tmp'))
+
+    def _store(self, f, ext):
+        """Copy from the file-like f into the cache, through a temporary file that is
+        renamed to the content path. Returns the digest, the path and the number of bytes written"""
+
+        h = hashlib.sha256()
+        size = 0
+
+        fd, tmp = self._tempfile()
+
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                while True:
+                    chunk = f.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    out.write(chunk)
+                    size += len(chunk)
+
+            path = self._object_path(h.hexdigest(), ext)
+
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp, path)
+        except:
+            if exists(tmp):
+                os.remove(tmp)
+            raise
+
+        return h.hexdigest(), path, size
+
+    def _open(self, url):
+        if urlparse(url).scheme == 'file':
+            return open(self._file_path(url), 'rb')
+        else:
+            return urlopen(url)
+
+    def get(self, url, fingerprint=None):
+        """Return the local path of a cached url, or None if it is not in the cache"""
+        return self._get(self._key_path(self.key(url, fingerprint)))
+
+    def _get(self, key_path):
+
+        try:
+            with open(key_path) as f:
+                digest, ext = f.read().split('\t')
+        except (IOError, ValueError):
+            return None
+
+        path = self._object_path(digest, ext)
+
+        try:
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            self._remove(key_path)  # Evicted
+            return None
+
+        return path
+
+    def fetch(self, url, fingerprint=None):
+        """Return the local path for the contents of a url, downloading it if it is not
+        already in the cache."""
+
+        url = str(url)
+
+        # The key is computed once, so a source that changes during the download is stored under
+        # the fingerprint it was looked up with, and an HTTP source gets one HEAD request
+        key_path = self._key_path(self.key(url, fingerprint))
+
+        path = self._get(key_path)
+
+        if path:
+            self.hits += 1
+            return path
+
+        self.misses += 1
+
+        # Keep the extension, since rowgenerators uses it to pick a generator
+        ext = splitext(basename(urlparse(url).path))[1]
+
+        with self._open(url) as f:
+            digest, path, size = self._store(f, ext)
+
+        self.bytes_downloaded += size
+
+        os.makedirs(os.path.dirname(key_path), exist_ok=True)
+
+        fd, tmp = self._tempfile()
+        with os.fdopen(fd, 'w') as f:
+            f.write('{}\t{}'.format(digest, ext))
+        os.replace(tmp, key_path)
+
+        self.evict(keep=path)
+
+        return path
+
+    def digest(self, url, fingerprint=None):
+        """Return the SHA256 digest of the contents of a url, fetching it if it is not already
+        in the cache."""
+        return basename(self.fetch(url, fingerprint))[:64]
+
+    def localize(self, url, fingerprint=None):
+        """Fetch the url into the cache and return a file url for the local copy, with the
+        fragment of the original url, so it can be passed to parse_app_url()"""
+
+        url = str(url)
+
+        base, _, fragment = url.partition('#')
+
+        path = self.fetch(base, fingerprint)
+
+        return 'file:' + path + ('#' + fragment if fragment else '')
+
+    def _objects(self):
+        objects_dir = join(self.root, 'objects')
+        for d in os.listdir(objects_dir):
+            for e in os.scandir(join(objects_dir, d)):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                yield e.path, st.st_size, st.st_mtime
+
+    @property
+    def size(self):
+        """Total size of the cached content, in bytes"""
+        return sum(size for _, size, _ in self._objects())
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False  # Another process got it first
+
+    def _keys(self):
+        """Yield the path of each key file, and the content path it points to"""
+        keys_dir = join(self.root, 'keys')
+        for d in os.listdir(keys_dir):
+            for e in os.scandir(join(keys_dir, d)):
+                try:
+                    with open(e.path) as f:
+                        digest, ext = f.read().split('\t')
+                except (IOError, ValueError):
+                    continue
+                yield e.path, self._object_path(digest, ext)
+
+    def evict(self, keep=None):
+        """Remove least recently used content until the cache is under its size limit, and
+        the key files that point to it"""
+
+        if self.max_size is None:
+            return
+
+        objects = sorted(self._objects(), key=lambda e: e[2])
+
+        total = sum(e[1] for e in objects)
+
+        evicted = set()
+
+        for path, size, _ in objects:
+            if total <= self.max_size:
+                break
+
+            if path == keep:
+                continue
+
+            if self._remove(path):
+                self.evictions += 1
+
+            evicted.add(path)
+
+            total -= size
+
+        if evicted:
+            for key_path, path in self._keys():
+                if path in evicted:
+                    self._remove(key_path)
+
+    def clear(self):
+        """Remove everything from the cache"""
+        for d in ('objects', 'keys'):
+            shutil.rmtree(join(self.root, d), ignore_errors=True)
+            os.makedirs(join(self.root, d), exist_ok=True)
+
+    def stats(self):
+        """Return a dict of hit, miss and size statistics"""
+        objects = list(self._objects())
+
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'bytes_downloaded': self.bytes_downloaded,
+            'files': len(objects),
+            'size': sum(e[1] for e in objects)
+        }
@@ -0,0 +1,22 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Subcommands for the mt program. The modules only import what is needed to build their
+argument parsers; the rest is imported when a command runs.
+"""
+
+from functools import lru_cache
+
+
+@lru_cache()
+def memo_class():
+    """Return the MetapackCliMemo class for the subcommands, importing the metapack CLI"""
+    from metapack.cli.core import MetapackCliMemo as _MetapackCliMemo
+
+    class MetapackCliMemo(_MetapackCliMemo):
+
+        def __init__(self, args, downloader=None):
+            super().__init__(args, downloader)
+
+    return MetapackCliMemo
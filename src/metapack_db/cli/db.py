@@ -5,18 +5,22 @@
 
 """
 
+import sys
 from os import remove
 from os.path import exists
 
-from metapack.cli.core import MetapackCliMemo as _MetapackCliMemo
+from . import memo_class
 
 
 class ArgumentError(Exception): pass
 
-class MetapackCliMemo(_MetapackCliMemo):
 
-    def __init__(self, args, downloader):
-        super().__init__(args, downloader)
+def __getattr__(name):
+    # The metapack CLI is imported when a command runs, not when the subcommand is registered
+    if name == 'MetapackCliMemo':
+        return memo_class()
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def db(subparsers):
@@ -44,7 +48,11 @@ def db(subparsers):
     load.set_defaults(sub_command=run_import_cmd)
     load.add_argument('-C', '--clean', default=False, action='store_true',
                       help='Delete everything from the database first')
-    load.add_argument('urls', nargs='*', help="Database or Datapackage URLS")
+    load.add_argument('-b', '--bulk', default=False, action='store_true',
+                      help='Load in bulk load mode, which builds indexes and statistics after loading')
+    load.add_argument('-q', '--quiet', default=False, action='store_true',
+                      help="Don't display a progress bar")
+    load.add_argument('urls', nargs='*', help="Database and Datapackage URLS")
 
     ## Delete
 
@@ -59,21 +67,119 @@ def db(subparsers):
     list.add_argument('url', nargs='?', help="Database or Datapackage URLS With no package, list all packages. "
                                              "With packages, list resoruces in the packages")
 
+    ## Garbage collection
+
+    gc = subparsers.add_parser('gc', help='Delete superseded versions of packages, and their tables')
+    gc.set_defaults(sub_command=run_gc_cmd)
+    gc.add_argument('-k', '--keep', type=int, default=1,
+                    help='Number of versions of each package to keep. Default 1')
+    gc.add_argument('-n', '--newer-than',
+                    help='Also keep versions added to the database after this date')
+    gc.add_argument('-d', '--dry-run', default=False, action='store_true',
+                    help='List the packages that would be deleted, but don\'t delete them')
+    gc.add_argument('database', help="Database URL")
+
+    ## Job queue
+
+    enqueue = subparsers.add_parser('enqueue', help='Add jobs to load packages to the job queue')
+    enqueue.set_defaults(sub_command=run_enqueue_cmd)
+    enqueue.add_argument('-p', '--priority', type=int, default=0,
+                         help='Jobs with higher priorities run first. Default 0')
+    enqueue.add_argument('-r', '--retries', type=int, default=3,
+                         help='Number of times to retry a job that fails. Default 3')
+    enqueue.add_argument('-b', '--bulk', default=False, action='store_true',
+                         help='Load in bulk load mode, which builds indexes and statistics after loading')
+    enqueue.add_argument('database', help="Database URL")
+    enqueue.add_argument('urls', nargs='+', help="Datapackage URLS")
+
+    worker = subparsers.add_parser('worker', help='Run jobs from the job queue')
+    worker.set_defaults(sub_command=run_worker_cmd)
+    worker.add_argument('-c', '--concurrency', type=int, default=1,
+                        help='Number of jobs to run at once. Default 1')
+    worker.add_argument('-e', '--exit', default=False, action='store_true',
+                        help='Exit when there are no more queued jobs')
+    worker.add_argument('-q', '--quiet', default=False, action='store_true',
+                        help="Don't display progress")
+    worker.add_argument('database', help="Database URL")
+
+    jobs = subparsers.add_parser('jobs', help='Display job queue statistics, and failed jobs')
+    jobs.set_defaults(sub_command=run_jobs_cmd)
+    jobs.add_argument('database', help="Database URL")
+
 
 def run_metapackdb(args):
-    m = MetapackCliMemo(args)
+    m = memo_class()(args)
 
     args.sub_command(m)
 
 
+def is_database_url(url):
+    """True if the URL is a SqlAlchemy database URL, rather than a package URL"""
+    scheme = url.split(':', 1)[0].split('+', 1)[0]
+
+    return scheme in ('sqlite', 'postgresql', 'postgres', 'mysql', 'oracle', 'mssql')
+
+
+class ProgressBar(object):
+    """Progress callback for MetatabManager.load(), which displays a progress bar for
+    each resource"""
+
+    def __init__(self, out=None, width=30):
+        self.out = out or sys.stderr
+        self.width = width
+        self._last = 0  # Length of the last line, which a shorter line must cover
+
+    def __call__(self, p):
+        from datetime import timedelta
+
+        parts = [p.name]
+
+        if p.fraction is not None:
+            n = int(p.fraction * self.width)
+            parts.append('{:4.0%} |{}{}|'.format(p.fraction, '#' * n, ' ' * (self.width - n)))
+
+        parts.append('{:,} rows'.format(p.rows))
+        parts.append('{:,.0f} rows/s'.format(p.rows_per_sec))
+
+        if p.done:
+            parts.append('in {}'.format(timedelta(seconds=int(p.elapsed))))
+        elif p.eta is not None:
+            parts.append('ETA {}'.format(timedelta(seconds=int(p.eta))))
+
+        line = ' '.join(parts)
+
+        self.out.write('\r' + line.ljust(self._last) + ('\n' if p.done else ''))
+        self.out.flush()
+
+        self._last = 0 if p.done else len(line)
+
+
 def run_import_cmd(m):
+    from metapack.cli.core import err
+    from metapack_db import Database, MetatabManager
+    from sqlalchemy.engine.url import make_url
+
+    databases = [u for u in m.args.urls if is_database_url(u)]
+    packages = [u for u in m.args.urls if not is_database_url(u)]
+
+    if len(databases) != 1:
+        err("Specify one database URL")
+
+    database = databases[0]
+
     if m.args.clean:
-        if (m.database_url.dialect == 'sqlite'):
-            if exists(m.database_url.path):
-                remove(m.database_url.path)
+        url = make_url(database)
 
-    for p in m.packages:
-        print(p)
+        if url.get_backend_name() == 'sqlite' and url.database and exists(url.database):
+            remove(url.database)
+
+    mm = MetatabManager(Database(database))
+
+    progress = None if m.args.quiet else ProgressBar()
+
+    for p in packages:
+        doc, resources = mm.load(p, load_all_resources=True, bulk=m.args.bulk, progress=progress)
+        print(doc.name)
 
 
 def run_delete_cmd(m):
@@ -86,3 +192,80 @@ def run_list_cmd(m):
 
 def run_info_cmd(m):
     pass
+
+
+def run_gc_cmd(m):
+    from dateutil.parser import parse
+    from metapack_db import Database, MetatabManager
+
+    mm = MetatabManager(Database(m.args.database))
+
+    newer_than = parse(m.args.newer_than) if m.args.newer_than else None
+
+    names = {d.id: d.name for d in mm.documents()}
+
+    ids = mm.superseded(m.args.keep, newer_than)
+
+    if not m.args.dry_run:
+        mm.delete_documents(ids)
+
+    for id in ids:
+        print(names[id])
+
+
+def run_enqueue_cmd(m):
+    from metapack_db import Database, MetatabManager
+    from metapack_db.jobs import JobQueue
+
+    queue = JobQueue(MetatabManager(Database(m.args.database)))
+
+    for url in m.args.urls:
+        id = queue.enqueue(url, priority=m.args.priority, retries=m.args.retries, bulk=m.args.bulk)
+        print(id, url)
+
+
+def run_worker_cmd(m):
+    from metapack_db import Database, MetatabManager
+    from metapack_db.jobs import JobQueue, Worker
+
+    queue = JobQueue(MetatabManager(Database(m.args.database)))
+
+    progress = None if m.args.quiet or m.args.concurrency > 1 else ProgressBar()
+
+    worker = Worker(queue, concurrency=m.args.concurrency, exit_when_empty=m.args.exit, progress=progress)
+
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+
+    print("{} jobs done, {} failed".format(worker.completed, worker.failed))
+
+
+def run_jobs_cmd(m):
+    import json
+    from metapack_db import Database, MetatabManager
+    from metapack_db.jobs import FAILED, QUEUED, JobQueue
+
+    queue = JobQueue(MetatabManager(Database(m.args.database)))
+
+    stats = queue.stats()
+    failures = [j for j in queue.jobs() if j.state == FAILED or (j.state == QUEUED and j.attempts)]
+
+    if m.args.json:
+        stats['failures'] = [{'id': j.id, 'url': j.url, 'state': j.state, 'attempts': j.attempts,
+                              'error': j.error} for j in failures]
+        print(json.dumps(stats, indent=4))
+        return
+
+    for k, v in stats.items():
+        print('{:<16} {}'.format(k, round(v, 1) if isinstance(v, float) else v))
+
+    for j in failures:
+        print()
+        print('{} {} {} attempts={}'.format(j.id, j.state, j.url, j.attempts))
+
+        lines = (j.error or '').strip().splitlines()
+
+        if lines:
+            print('    ' + lines[-1])  # The exception, from the end of the traceback
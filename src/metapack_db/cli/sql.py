@@ -6,32 +6,13 @@ Load a resource into an Sql database.
 """
 
 import textwrap
+import threading
+from functools import lru_cache
+from pathlib import Path
 from textwrap import dedent
 
-from metapack import Downloader
-from metapack.cli.core import MetapackCliMemo as _MetapackCliMemo
-from metapack.cli.core import err, prt, warn
-from sqlalchemy import (
-    BLOB,
-    Column,
-    Date,
-    DateTime,
-    Float,
-    Integer,
-    MetaData,
-    String,
-    Table,
-    Text,
-    Time,
-    Unicode,
-    create_engine
-)
-from sqlalchemy.dialects import mysql, postgresql, sqlite
-from sqlalchemy.orm import create_session
-from sqlalchemy.schema import CreateTable, DropTable
-from tabulate import tabulate
-
-downloader = Downloader()
+# Metapack, SqlAlchemy and tabulate are imported by the functions that use them, so
+# registering the subcommand doesn't load them.
 
 # From http://stackoverflow.com/a/295466
 def slugify(value):
@@ -47,15 +28,25 @@ def slugify(value):
 
     return value
 
-class MetapackCliMemo(_MetapackCliMemo):
+def __getattr__(name):
+    # Module attributes that need the heavy imports are created on first access
+    if name == 'MetapackCliMemo':
+        from . import memo_class
+        return memo_class()
+    elif name == 'dialect_map':
+        return _dialect_map()
+    elif name == 'type_map':
+        return _type_map()
 
-    def __init__(self, args, downloader):
-        super().__init__(args, downloader)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 
 class Database(object):
 
     def __init__(self, db_url, echo=False):
+        from sqlalchemy import MetaData, create_engine
+        from sqlalchemy.orm import create_session
+
         self.db_url = db_url
 
         self.engine = create_engine(db_url)
@@ -108,73 +99,153 @@ def sql(subparsers):
     parser.add_argument('-u', '--curl', default=False, action='store_const', dest='load_prog', const='curl',
                         help="For postgres format, use cURL to load data")
 
+    parser.add_argument('-i', '--inserts', default=False, action='store_true',
+                        help="Load data with INSERT statements, rather than the dialect's bulk loading command")
+    parser.add_argument('-b', '--batch-size', type=int, default=1000,
+                        help="Number of rows in each INSERT statement. Default 1000")
+
     parser.add_argument('-A', '--access_key', help="For Redshift format, the access key to use for COPY credentials")
     parser.add_argument('-S', '--secret',  help="For Redshift format, the secret key to use for COPY credentials")
     parser.add_argument('-P', '--s3profile', help="For Redshift format, boto or aws profile to use for COPY credentials")
 
+    parser.add_argument('-j', '--jobs', type=int, default=8,
+                        help="Number of packages to open at once. Default 8")
+
     parser.add_argument('metatabfile', nargs='*',
                         help="Path or URL to a metatab file. If not provided, defaults to 'metadata.csv' ")
 
 
-dialect_map = {
-    'msql': mysql.dialect(),
-    'postgresql': postgresql.dialect(),
-    'redshift': postgresql.dialect(),
-    'sqlite': sqlite.dialect(),
-}
+@lru_cache()
+def _dialect_map():
+    from sqlalchemy.dialects import mysql, postgresql, sqlite
 
+    return {
+        'mysql': mysql.dialect(),
+        'postgresql': postgresql.dialect(),
+        'redshift': postgresql.dialect(),
+        'sqlite': sqlite.dialect(),
+    }
 
-type_map = {
-    'unknown': Text,
-    'int': Integer,
-    'float': Float,
-    'number': Float,
-    'date': Date,
-    'time': Time,
-    'datetime': DateTime,
-    'str': String,
-    'bytes': BLOB,
-    'unicode': Unicode
-}
 
+def get_dialect(name):
+    """Return the SqlAlchemy dialect for a --dialect argument, defaulting to MySQL"""
+    from sqlalchemy.dialects import mysql
 
-def expand_refs(r):
-    from metapack import open_package, Resource
-    from pathlib import Path
+    return _dialect_map().get(name, mysql.dialect())
 
 
-    if isinstance(r, Resource):
-        yield r.doc, r
-        return
+@lru_cache()
+def _type_map():
+    # The map the loader uses, so the DDL here matches the tables it creates
+    from metapack_db.coerce import type_map
 
-    if isinstance(r, (list, tuple)): # Ought to be iterable type or somesuch
-        for e in r:
-            yield from expand_refs(e)
-        return
+    return type_map
 
-    pkg = open_package(r)
 
-    if not pkg.resources():
-        # Metatab can open a lof of normal files, and try to interpret them, without errors,
-        # but the files won't have any resources. SO, just assume it is a
-        # file with a list of packages.
-        for l in Path(r).open().readlines():
-            yield from expand_refs(l.strip())
+class PackageResolver(object):
+    """Opens packages for expand_refs() on a pool of threads. Each package URL is opened only
+    once in a run, and the packages in a list are opened concurrently, while expand()
+    yields resources in the order of the references"""
 
+    def __init__(self, max_workers=8, opener=None):
+        """
+        :param max_workers: Maximum number of packages to open at once
+        :param opener: Function to open a package from a URL. Defaults to metapack.open_package
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-    if pkg.default_resource:
-        yield from expand_refs(pkg.resource(pkg.default_resource))
-    else:
-        for r in pkg.resources():
-            if r.resolved_url.proto == 'metapack':
-                try:
-                    yield pkg, r.resolved_url.resource
-                except AttributeError:
-                    yield from r.resolved_url.doc.resources()
+        if opener is None:
+            from metapack import open_package as opener
+
+        self.opener = opener
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self._packages = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, ref):
+        """Start opening a package, unless it is already open or being opened. Returns a Future"""
+
+        ref = str(ref)
+
+        with self._lock:
+            if ref not in self._packages:
+                self._packages[ref] = self.executor.submit(self.opener, ref)
+
+            return self._packages[ref]
+
+    def open(self, ref):
+        """Return an open package, waiting for it if it is being opened"""
+        return self.prefetch(ref).result()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+    def expand(self, r):
+        """Yield (package, resource) tuples for a resource, a package reference, a file with
+        a list of package references, or a list of any of these."""
+        from metapack import Resource
+
+        if isinstance(r, Resource):
+            yield r.doc, r
+            return
+
+        if isinstance(r, (list, tuple)): # Ought to be iterable type or somesuch
+            for e in r:
+                if not isinstance(e, (Resource, list, tuple)):
+                    self.prefetch(e)
+
+            for e in r:
+                yield from self.expand(e)
+            return
+
+        pkg = self.open(r)
+
+        resources = list(pkg.resources())
+
+        if not resources:
+            # Metatab can open a lof of normal files, and try to interpret them, without errors,
+            # but the files won't have any resources. SO, just assume it is a
+            # file with a list of packages.
+            with Path(str(r)).open() as f:
+                yield from self.expand([l.strip() for l in f if l.strip()])
+            return
+
+        if pkg.default_resource:
+            yield from self.expand(pkg.resource(pkg.default_resource))
+            return
+
+        for e in resources:
+            if e.resolved_url.proto == 'metapack':
+                self.prefetch(e.resolved_url.clear_fragment())
+
+        for e in resources:
+            if e.resolved_url.proto == 'metapack':
+                u = e.resolved_url
+                doc = self.open(u.clear_fragment())
+
+                if u.target_file:
+                    yield doc, doc.resource(u.target_file)
+                else:
+                    for dr in doc.resources():
+                        yield doc, dr
             else:
-                yield pkg, r
+                yield pkg, e
+
+
+def expand_refs(r, max_workers=8):
+    """Yield (package, resource) tuples for references to resources, packages or lists of packages,
+    opening the packages concurrently. See PackageResolver"""
+
+    resolver = PackageResolver(max_workers)
+
+    try:
+        yield from resolver.expand(r)
+    finally:
+        resolver.close()
 
 def run_sql(args):
+    from metapack.cli.core import warn
 
     if not any([args.drop, args.create, args.load]):
         args.drop = True
@@ -184,13 +255,18 @@ def run_sql(args):
     drop = []
     create = []
     load = []
+    index = []
 
-    resources = list(expand_refs(list(args.metatabfile)))
+    resources = list(expand_refs(list(args.metatabfile), args.jobs))
 
     for doc, r in resources:
-        drop.append(drop_sql(args, doc,r))
-        create.append(create_sql(args, doc, r))
-        load.append(load_sql(args, doc, r))
+        if args.drop:
+            drop.append(drop_sql(args, doc,r))
+        if args.create:
+            create.append(create_sql(args, doc, r))
+            index.append(index_sql(args, doc, r))
+        if args.load:
+            load.append(load_sql(args, doc, r))
 
     if args.drop:
         print('\n'.join(drop))
@@ -201,6 +277,10 @@ def run_sql(args):
     if args.load:
         print('\n'.join(load))
 
+    # Indexes are created after loading, which is faster than updating them for every row
+    if args.create:
+        print('\n'.join(i for i in index if i))
+
     if not any([args.drop, args.create, args.load]):
         warn(f'No action specified; nothing to do. Use --create, --drop or --load')
 
@@ -208,6 +288,10 @@ def mk_table_name(r, doc):
     return slugify(r.name+'-'+doc.name)
 
 def create_sql(args, doc, r):
+    from metapack.cli.core import err
+    from sqlalchemy import Column, MetaData, Table, Text
+    from sqlalchemy.schema import CreateTable
+    from tabulate import tabulate
 
     try:
         st = r.schema_term
@@ -225,14 +309,14 @@ def create_sql(args, doc, r):
 
     for col in r.columns():
         # print(col)
-        sql_type = type_map.get(col['datatype'], Text)
+        sql_type = _type_map().get(col['datatype'], Text)
 
         table.append_column(Column(col['header'], sql_type,
                                    comment=col.get('description')))
 
         comment_rows.append((col['header'], sql_type.__name__, col['description']))
 
-    dialect = dialect_map.get(args.dialect,mysql.dialect())
+    dialect = get_dialect(args.dialect)
 
     comment=dedent(f"""
 Table:       {table_name}
@@ -244,6 +328,9 @@ Columns:
     return textwrap.indent(comment,'-- ')+'\n'+str(CreateTable(table).compile(dialect=dialect)).strip()+';'
 
 def drop_sql(args, doc, r):
+    from metapack.cli.core import err
+    from sqlalchemy import MetaData, Table
+    from sqlalchemy.schema import DropTable
 
     try:
         st = r.schema_term
@@ -257,7 +344,7 @@ def drop_sql(args, doc, r):
 
     table = Table(table_name, MetaData(bind=None))
 
-    dialect = dialect_map.get(args.dialect,mysql.dialect())
+    dialect = get_dialect(args.dialect)
 
     lines =  str(DropTable(table).compile(dialect=dialect)).\
             replace('DROP TABLE', 'DROP TABLE IF EXISTS')
@@ -276,7 +363,157 @@ def get_credentials(profile):
     return (session.get_credentials().access_key,
             session.get_credentials().secret_key)
 
+def sql_string(v, dialect_name=None):
+    """Quote a string as a SQL literal"""
+    v = str(v)
+
+    if dialect_name == 'mysql':
+        v = v.replace('\\', '\\\\')  # MySQL treats backslashes in strings as escapes
+
+    return "'" + v.replace("'", "''") + "'"
+
+
+def sql_literal(v, dialect_name=None, datatype=None):
+    """Return a SQL literal for a value from a resource row. An empty string is NULL, unless
+    the column's datatype is stored as a string"""
+    import math
+    from metapack_db.coerce import is_string_datatype
+
+    if v is None or (v == '' and not is_string_datatype(datatype)):
+        return 'NULL'
+    elif isinstance(v, bool):
+        return ('1' if v else '0') if dialect_name == 'sqlite' else ('TRUE' if v else 'FALSE')
+    elif isinstance(v, int):
+        return str(v)
+    elif isinstance(v, float):
+        return repr(v) if math.isfinite(v) else 'NULL'
+    else:
+        return sql_string(v, dialect_name)
+
+
+def local_csv(r):
+    """Return the path of a resource's source, if it is a local CSV file, or None"""
+
+    u = r.resolved_url.get_resource().get_target()
+
+    if u.proto == 'file' and u.target_format == 'csv':
+        return str(u.fspath)
+
+    return None
+
+
+def csv_header(path):
+    import csv
+
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f), [])
+
+
+def csv_line_terminator(path):
+    with open(path, 'rb') as f:
+        return '\\r\\n' if f.readline().endswith(b'\r\n') else '\\n'
+
+
+def mysql_load_sql(table_name, path, columns):
+    """LOAD DATA statement for a local CSV file. CSV columns are matched to table columns
+    by name, and empty values are loaded as NULL, except in string columns. Returns None
+    if none of the CSV columns are in the table"""
+    from metapack_db.coerce import is_string_datatype
+
+    quote = get_dialect('mysql').identifier_preparer.quote
+
+    datatypes = {c['header']: c.get('datatype') for c in columns}
+
+    header = csv_header(path)
+
+    variables = ['@v{}'.format(i) if h in datatypes else '@skip' for i, h in enumerate(header)]
+    assignments = ["{} = @v{}".format(quote(h), i) if is_string_datatype(datatypes[h]) else
+                   "{} = NULLIF(@v{}, '')".format(quote(h), i)
+                   for i, h in enumerate(header) if h in datatypes]
+
+    if not assignments:
+        return None
+
+    return (f"LOAD DATA LOCAL INFILE {sql_string(path, 'mysql')} INTO TABLE {quote(table_name)}\n"
+            f"  CHARACTER SET utf8mb4\n"
+            f"  FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY ''\n"
+            f"  LINES TERMINATED BY '{csv_line_terminator(path)}'\n"
+            f"  IGNORE 1 LINES\n"
+            f"  ({', '.join(variables)})\n"
+            f"  SET {', '.join(assignments)};")
+
+
+def postgres_copy_sql(table_name, path, columns):
+    """psql \\copy command, which runs COPY FROM STDIN, sending the local file. Empty values
+    are loaded as NULL, except in string columns. Returns None if the file has columns that
+    aren't in the table"""
+    from metapack_db.coerce import is_string_datatype
+
+    quote = get_dialect('postgresql').identifier_preparer.quote
+
+    datatypes = {c['header']: c.get('datatype') for c in columns}
+
+    header = csv_header(path)
+
+    if not set(header) <= set(datatypes):
+        return None
+
+    strings = [quote(h) for h in header if is_string_datatype(datatypes[h])]
+    force_not_null = f", FORCE_NOT_NULL ({', '.join(strings)})" if strings else ''
+
+    return (f"\\copy {quote(table_name)} ({', '.join(quote(h) for h in header)}) "
+            f"FROM {sql_string(path)} WITH (FORMAT csv, HEADER true, ENCODING 'utf8'{force_not_null})")
+
+
+def insert_sql(args, table_name, r):
+    """Multi-row INSERT statements for the rows of a resource, which work in every dialect"""
+    from metapack_db.util import chunks
+
+    quote = get_dialect(args.dialect).identifier_preparer.quote
+
+    columns = [(c['header'], c.get('datatype')) for c in r.columns()]
+
+    head = 'INSERT INTO {} ({}) VALUES\n'.format(quote(table_name), ', '.join(quote(n) for n, _ in columns))
+
+    statements = []
+
+    for batch in chunks(r.iterdict, args.batch_size):
+        rows = ['({})'.format(', '.join(sql_literal(row.get(n), args.dialect, datatype) for n, datatype in columns))
+                for row in batch]
+        statements.append(head + ',\n'.join(rows) + ';')
+
+    return '\n'.join(statements)
+
+
+def index_sql(args, doc, r):
+    """CREATE INDEX statements for the primary key, unique and indexed columns of the schema, and
+    the resource's index spec. See metapack_db.resource.schema_indexes()"""
+    from sqlalchemy import Column, Index, MetaData, Table
+    from sqlalchemy.schema import CreateIndex
+    from metapack_db.resource import schema_indexes
+
+    try:
+        schema = list(r.columns())
+    except AttributeError:
+        return ''
+
+    spec = (getattr(r, 'properties', None) or {}).get('indexes')
+
+    table_name = mk_table_name(r, doc)
+
+    table = Table(table_name, MetaData(bind=None), *[Column(c['header']) for c in schema])
+
+    dialect = get_dialect(args.dialect)
+
+    return '\n'.join(str(CreateIndex(Index(slugify(name), *[table.c[c] for c in columns], unique=unique))
+                         .compile(dialect=dialect)).strip() + ';'
+                     for name, columns, unique in schema_indexes(table_name, schema, spec))
+
+
 def load_sql(args, doc,r):
+    """Return the statements to load a resource, using the dialect's bulk loading
+    command for local CSV files, and INSERT statements otherwise"""
+    from metapack.cli.core import err
 
     try:
         st = r.schema_term
@@ -288,6 +525,12 @@ def load_sql(args, doc,r):
 
     table_name =  mk_table_name(r, doc)
 
+    columns = list(r.columns())
+    names = [c['header'] for c in columns]
+
+    if args.inserts:
+        return insert_sql(args, table_name, r)
+
     if args.dialect == 'redshift':
 
         if args.access_key and args.secret:
@@ -308,9 +551,28 @@ def load_sql(args, doc,r):
 
             return f"""COPY {table_name} FROM PROGRAM '{ args.load_prog} "{url}"' WITH CSV HEADER ENCODING 'utf8'; """
 
+        path = local_csv(r)
+
+        if path:
+            copy = postgres_copy_sql(table_name, path, columns)
+            if copy:
+                return copy
+
+    elif args.dialect == 'mysql':
+
+        path = local_csv(r)
+
+        if path:
+            load = mysql_load_sql(table_name, path, columns)
+            if load:
+                return load
+
     elif args.dialect == 'sqlite':
 
-        u = r.resolved_url.get_resource().get_target()
-        return f".mode csv {table_name}\n.import  '{str(u.fspath)}' {table_name}"
+        path = local_csv(r)
+
+        # .import loads the CSV columns by position, so they must be in the order of the table's
+        if path and csv_header(path) == names:
+            return f".import --csv --skip 1 {sql_string(path)} {table_name}"
 
-    return ''
+    return insert_sql(args, table_name, r)
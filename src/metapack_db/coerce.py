@@ -0,0 +1,309 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Convert batches of resource rows to the types declared in the resource schema.
+
+Conversion is done a column at a time, mapping one converter over all of the
+values of a column in a batch. If a column has a value that can't be converted,
+the column is converted again value by value, to find the bad rows, which are
+removed from the batch and returned as rejects.
+"""
+
+import json
+from datetime import date, datetime, time
+
+from sqlalchemy import (
+    BLOB,
+    Boolean,
+    Column,
+    Date,
+    DateTime,
+    Float,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Text,
+    Time,
+    Unicode
+)
+
+# Map metatab datatypes to SqlAlchemy types. Datatypes that aren't listed are stored as String
+
+type_map = {
+    'unknown': Text,
+    'int': Integer,
+    'integer': Integer,
+    'float': Float,
+    'number': Float,
+    'date': Date,
+    'time': Time,
+    'datetime': DateTime,
+    'bool': Boolean,
+    'boolean': Boolean,
+    'str': String,
+    'string': String,
+    'text': String,
+    'unicode': Unicode,
+    'bytes': BLOB,
+}
+
+
+# Integers are stored as signed 64 bit values, by Sqlite, PostgreSQL's BIGINT and Parquet
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+
+def is_string_datatype(datatype):
+    """True if a column of a metatab datatype is stored as a string, so an empty string is a
+    value, rather than a missing value"""
+    return issubclass(type_map.get(datatype, String), String)
+
+
+def _int(v):
+    if isinstance(v, int):
+        return v
+
+    try:
+        if not isinstance(v, float):
+            return int(v)
+    except ValueError:
+        pass
+
+    try:
+        f = float(v)  # Handles '3.0', which int() rejects
+    except ValueError:
+        f = None
+
+    if f is None or not f.is_integer():
+        raise ValueError("Not an integer: '{}'".format(v))
+
+    return int(f)
+
+
+def to_int(v):
+    i = _int(v)
+
+    # Out of range values would fail the insert, and abort the load, rather than being rejected
+    if not INT_MIN <= i <= INT_MAX:
+        raise ValueError("Integer out of range: '{}'".format(v))
+
+    return i
+
+
+def to_bool(v):
+    if isinstance(v, bool):
+        return v
+
+    s = str(v).strip().lower()
+
+    if s in ('1', 't', 'true', 'y', 'yes'):
+        return True
+    elif s in ('0', 'f', 'false', 'n', 'no'):
+        return False
+
+    raise ValueError("Not a boolean: '{}'".format(v))
+
+
+def to_datetime(v):
+    if isinstance(v, datetime):
+        return v
+
+    if isinstance(v, date):
+        return datetime(v.year, v.month, v.day)
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S'):
+        try:
+            return datetime.strptime(v, fmt)
+        except ValueError:
+            pass
+
+    from dateutil.parser import parse
+    return parse(v)
+
+
+def to_date(v):
+    if isinstance(v, datetime):
+        return v.date()
+
+    if isinstance(v, date):
+        return v
+
+    try:
+        return datetime.strptime(v, '%Y-%m-%d').date()
+    except ValueError:
+        return to_datetime(v).date()
+
+
+def to_time(v):
+    if isinstance(v, time):
+        return v
+
+    if isinstance(v, datetime):
+        return v.time()
+
+    for fmt in ('%H:%M:%S', '%H:%M'):
+        try:
+            return datetime.strptime(v, fmt).time()
+        except ValueError:
+            pass
+
+    from dateutil.parser import parse
+    return parse(v).time()
+
+
+def to_str(v):
+    return v if isinstance(v, str) else str(v)
+
+
+def to_bytes(v):
+    return v if isinstance(v, bytes) else str(v).encode('utf8')
+
+
+converter_map = {
+    Integer: to_int,
+    Float: float,
+    Date: to_date,
+    Time: to_time,
+    DateTime: to_datetime,
+    Boolean: to_bool,
+    String: to_str,
+    Text: to_str,
+    BLOB: to_bytes,
+}
+
+
+def make_converter(sa_type, dialect=None):
+    """Return a function that converts a value for a column of a SqlAlchemy type, and then applies
+    the type's bind processor for the dialect, since rows are inserted with DBAPI executemany,
+    bypassing SqlAlchemy's own processing. For types other than strings, empty strings are
+    converted to None. Strings are kept as they are"""
+
+    f = converter_map.get(sa_type, to_str)
+
+    processor = sa_type().dialect_impl(dialect).bind_processor(dialect) if dialect is not None else None
+
+    # An empty string is a value of a string column, and a missing value of other types
+    empty = None if issubclass(sa_type, String) else ''
+
+    if processor:
+        def convert(v):
+            return None if v is None or v == empty else processor(f(v))
+    else:
+        def convert(v):
+            return None if v is None or v == empty else f(v)
+
+    return convert
+
+
+class Coercer(object):
+    """Convert batches of row tuples to the types of a resource schema"""
+
+    def __init__(self, schema, dialect=None, unique=()):
+        """
+        :param schema: List of column dicts from Resource.schema, in the order of the values in the rows
+        :param dialect: SqlAlchemy dialect that values will be inserted into
+        :param unique: Lists of column names whose values must be unique, such as the primary key.
+        A row with the same values as an earlier row is rejected, rather than failing the unique index
+        when it is built after the load. Rows with a missing value aren't checked.
+        """
+        self.names = [c['header'] for c in schema]
+        self.converters = [make_converter(type_map.get(c.get('datatype'), String), dialect) for c in schema]
+
+        # (column positions, names, keys seen so far) for each unique key
+        self.unique = [([self.names.index(n) for n in names], ', '.join(names), set()) for names in unique]
+
+        self.row_number = 0  # Number of data rows seen
+        self.rejected = 0
+
+    def coerce(self, rows):
+        """Convert a batch of row tuples. Returns the converted rows, and a list of
+        rejects, each a tuple of (row_number, reason, row as json)"""
+
+        start = self.row_number
+        self.row_number += len(rows)
+
+        if not rows or not self.converters:
+            return rows, []
+
+        bad = {}
+        out = []
+
+        for name, conv, col in zip(self.names, self.converters, zip(*rows)):
+            try:
+                out.append(list(map(conv, col)))
+            except Exception:
+                # Find the values that failed
+                values = []
+                for i, v in enumerate(col):
+                    try:
+                        values.append(conv(v))
+                    except Exception as e:
+                        values.append(None)
+                        bad.setdefault(i, "{}: {}".format(name, e))
+
+                out.append(values)
+
+        converted = list(zip(*out))
+
+        if self.unique:
+            self._check_unique(converted, bad)
+
+        if not bad:
+            return converted, []
+
+        self.rejected += len(bad)
+
+        rejects = [(start + i + 1, reason, json.dumps(list(rows[i]), default=str))
+                   for i, reason in sorted(bad.items())]
+
+        return [r for i, r in enumerate(converted) if i not in bad], rejects
+
+    def _check_unique(self, rows, bad):
+        """Add the rows that duplicate the unique keys of earlier rows to bad"""
+
+        for i, row in enumerate(rows):
+            if i in bad:
+                continue
+
+            keys = [tuple(row[p] for p in positions) for positions, _, _ in self.unique]
+
+            for key, (_, names, seen) in zip(keys, self.unique):
+                if key in seen and None not in key:
+                    bad[i] = "Duplicate value of ({}), which must be unique".format(names)
+                    break
+            else:
+                # Only keys of rows that are loaded count as seen
+                for key, (_, _, seen) in zip(keys, self.unique):
+                    seen.add(key)
+
+
+class RejectWriter(object):
+    """Write rejected rows to a table, which is created when the first rejects are written"""
+
+    def __init__(self, connection, table_name):
+        from .loader import RowWriter
+
+        self.connection = connection
+
+        self.table = Table(table_name, MetaData(),
+                           Column('_id', Integer, primary_key=True),
+                           Column('row_number', Integer),
+                           Column('reason', Text),
+                           Column('row', Text))
+
+        self.writer = RowWriter(connection, table_name, ['row_number', 'reason', 'row'])
+
+        self._created = False
+
+    def write(self, rejects):
+
+        if not rejects:
+            return
+
+        if not self._created:
+            self.table.create(self.connection, checkfirst=True)
+            self._created = True
+
+        self.writer.write(rejects)
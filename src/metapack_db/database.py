@@ -5,10 +5,16 @@
 
 """
 
+import re
+import threading
+import time
 from contextlib import contextmanager
+from datetime import datetime
+from itertools import cycle
+from os import makedirs, remove, replace
+from os.path import abspath, exists, join
+from urllib.parse import quote as url_quote
 
-from metapack import MetapackDoc
-from rowgenerators import parse_app_url
 from sqlalchemy import (
     Column,
     Float,
@@ -16,79 +22,401 @@ from sqlalchemy import (
     MetaData,
     String,
     Table,
-    create_engine
+    and_,
+    create_engine,
+    event,
+    select
 )
-from sqlalchemy.orm import load_only, sessionmaker
+from sqlalchemy.orm import aliased, load_only, sessionmaker
 
 from .document import Document
+from .jobs import Job  # Registers the mt_jobs table
+from .lease import Leases
+from .migrations import migrate
 from .orm import Base
 from .resource import Resource  # Need to import even if not referenced here.
+from .stats import ColumnStats
+from .storage import SQL, get_storage
 from .term import ResourceTerm, Root, Section, Term
+from .util import chunks
+
+# Indexes for the manager's lookups, which are added to snapshots
+SNAPSHOT_INDEXES = [
+    ('mt_documents', 'ref'),
+    ('mt_documents', 'package_url'),
+    ('mt_terms', 'document_id'),
+    ('mt_resources', 'document_id'),
+    ('mt_resources', 'table_name'),
+]
+
+
+def with_rejects_resources(table_names):
+    """Return the set of table names, with the resource tables of any rejects tables among them, since
+    a rejects table is stored with its resource's table"""
+
+    table_names = {t.lower() for t in table_names}
+
+    return table_names | {t[:-len('_rejects')] for t in table_names if t.endswith('_rejects')}
+
+
+def sqlite_transactions(engine):
+    """Have SQLAlchemy, rather than pysqlite, emit BEGIN, so SAVEPOINTs work. See
+    http://docs.sqlalchemy.org/en/latest/dialects/sqlite.html#pysqlite-serializable"""
+
+    @event.listens_for(engine, "connect")
+    def do_connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        # BEGIN IMMEDIATE takes the write lock at the start of the transaction, rather than at the
+        # first write, which can fail without waiting if another connection is writing
+        conn.execute("BEGIN IMMEDIATE" if conn.get_execution_options().get('sqlite_immediate') else "BEGIN")
+
+
+def make_engine(ref):
+    """Create an engine, with the transaction handling that SAVEPOINTs need on Sqlite"""
+
+    engine = create_engine(ref)
+
+    if engine.dialect.name == 'sqlite':
+        sqlite_transactions(engine)
+
+    return engine
 
 
 class Database(object):
-    def __init__(self, ref):
+    def __init__(self, ref, shard_dir=None, readers=None, columnar_dir=None):
+        """
+        :param ref: SqlAlchemy database URL for the writer, which is the primary database
+        :param shard_dir: For Sqlite databases, a directory for per-resource database files. If
+        set, each resource table is created in its own file in this directory, rather than in the
+        catalog database, so loads into different resources don't contend for one write lock.
+        :param readers: Optional list of URLs for read replicas of the writer. Reads
+        from a MetatabManager are spread over the readers, and writes go to the writer.
+        :param columnar_dir: Directory for the files of resources in columnar storage backends,
+        such as 'parquet'. See metapack_db.storage
+        """
         self.ref = ref
 
-        self.engine = create_engine(ref)
+        self.engine = make_engine(ref)
+
+        self.readers = [make_engine(r) for r in (readers or [])]
+        self._reader_cycle = cycle(self.readers)
+        self._reader_lock = threading.Lock()
 
         self.Session = sessionmaker(bind=self.engine)
 
+        @event.listens_for(self.Session, 'after_flush')
+        def after_flush(session, flush_context):
+            session.info['wrote'] = True
+
+        @event.listens_for(self.Session, 'after_bulk_delete')
+        def after_bulk_delete(delete_context):
+            delete_context.session.info['wrote'] = True
+
+        if shard_dir is not None:
+            if self.engine.dialect.name != 'sqlite':
+                raise ValueError("Shard files can only be used with Sqlite databases")
+
+            shard_dir = abspath(shard_dir)
+            makedirs(shard_dir, exist_ok=True)
+
+        self.shard_dir = shard_dir
+
+        if columnar_dir is not None:
+            columnar_dir = abspath(columnar_dir)
+            makedirs(columnar_dir, exist_ok=True)
+
+        self.columnar_dir = columnar_dir
+
+        self._shard_engines = {}
+
+    @classmethod
+    def snapshot(cls, path):
+        """Open a snapshot file written by MetatabManager.export_snapshot(). The file is opened
+        read only and immutable, so Sqlite doesn't lock it or check it for changes"""
+        return cls('sqlite:///file:{}?mode=ro&immutable=1&uri=true'.format(url_quote(abspath(path))))
+
     def session(self, **kwargs):
         return self.Session(**kwargs)
 
+    def reader(self):
+        """Return the engine for the next reader, round robin, or the writer's engine if
+        there are no readers"""
+
+        if not self.readers:
+            return self.engine
+
+        with self._reader_lock:
+            return next(self._reader_cycle)
+
     def create_tables(self):
-        Base.metadata.create_all(self.engine)
+        """Create the catalog tables, or upgrade them to the current schema version. When
+        the catalog is up to date, this only checks the version."""
+        return migrate(self.engine)
+
+    def shard_path(self, table_name):
+        """Return the path of the shard file for a resource table"""
+        return join(self.shard_dir, table_name + '.db')
+
+    def columnar_path(self, table_name):
+        """Return the path of the Parquet file for a resource table"""
+        return join(self.columnar_dir, table_name + '.parquet')
+
+    def shard_engine(self, path):
+        """Return an engine for a shard file"""
+
+        if path not in self._shard_engines:
+            self._shard_engines[path] = make_engine('sqlite:///' + path)
+
+        return self._shard_engines[path]
+
+    def attach(self, connection, shards):
+        """Attach shard files to a connection, which must not be in a transaction. Tables in attached
+        files can be referenced without a schema name, as long as the names are unique.
+
+        :param connection: A SqlAlchemy connection to the catalog database
+        :param shards: Dict of attachment schema names to shard paths
+        :return: The list of schema names that were attached, for detach()
+        """
+        attached = set(r[1] for r in connection.execute('PRAGMA database_list'))
+
+        names = []
+
+        for name, path in shards.items():
+            if name not in attached:
+                connection.execute('ATTACH DATABASE ? AS {}'.format(name), (path,))
+                names.append(name)
+
+        return names
+
+    def detach(self, connection, names):
+        for name in names:
+            connection.execute('DETACH DATABASE {}'.format(name))
+
+
+class IngestBatch(object):
+    """Adds documents to a manager inside a batch transaction. Returned by MetatabManager.batch()"""
+
+    def __init__(self, manager, session, commit_every=None):
+        self.manager = manager
+        self.session = session
+        self.commit_every = commit_every
+
+        self.added = []  # Documents that were added
+        self.failed = []  # (mt_doc, exception) for documents that could not be added
+
+        self._uncommitted = 0
+
+    def add_doc(self, mt_doc):
+        """Add a document in a savepoint. Returns the document, or None if adding it failed"""
+        try:
+            document = self.manager.add_doc(mt_doc)
+        except Exception as e:
+            self.failed.append((mt_doc, e))
+            return None
+
+        self.added.append(document)
+        self._uncommitted += 1
+
+        if self.commit_every and self._uncommitted >= self.commit_every:
+            self.commit()
+
+        return document
+
+    def commit(self):
+        """Commit the documents added so far"""
+        self.session.commit()
+        self.session.info['created_files'] = []  # Committed, so no longer removed on rollback
+        self._uncommitted = 0
 
 
 class MetatabManager(object):
     """Manages Metatab tables in a database"""
 
-    def __init__(self, database):
+    def __init__(self, database, cache=None, lazy=False, share=False, write_lag=5.0, query_cache=None,
+                 lease_ttl=60.0, storage=None):
+        """
+        :param database: A Database
+        :param cache: An optional metapack_db.cache.DownloadCache, for local copies of resource sources
+        :param lazy: If True, add_doc() creates resource tables without loading them, and resources
+        are loaded the first time they are read through query() or read()
+        :param share: If True, a resource with the same source data and schema as a resource that
+        is already loaded, such as in another version of the package, shares its table, through a view.
+        Finding the fingerprint of the source data may download a remote source. The default is False
+        :param write_lag: If the database has readers, reads go to the writer for this many seconds
+        after the manager writes, so they see the writes, even if the readers lag behind.
+        :param query_cache: An optional metapack_db.querycache.QueryCache, for the results of query()
+        :param lease_ttl: Seconds until a lease on a document or resource expires, if the process
+        holding it stops renewing it. See metapack_db.lease
+        :param storage: Name of the storage backend for resources whose resource term has no
+        'storage' property. The default is 'sql'. See metapack_db.storage
+        """
 
         self.database = database
 
+        self.cache = cache
+
+        self.lazy = lazy
+
+        self.share = share
+
+        self.write_lag = write_lag
+        self._last_write = None
+
+        self.query_cache = query_cache
+
+        self.storage = get_storage(storage).name
+
+        # Leases in the catalog, so processes that share it don't add or load the same thing at once
+        self.leases = Leases(self.database.engine, lease_ttl)
+
         # Should this be done here? Probably not ...
         self.database.create_tables()
 
-        self._session = None
+        # Session state is per-thread, so threads can share a manager
+        self._local = threading.local()
+
+        self._load_locks = {}
+        self._load_locks_lock = threading.Lock()
+
+    @property
+    def _session(self):
+        return getattr(self._local, 'session', None)
+
+    @_session.setter
+    def _session(self, v):
+        self._local.session = v
 
-        self._nesting = 0
+    @property
+    def _nesting(self):
+        return getattr(self._local, 'nesting', 0)
+
+    @_nesting.setter
+    def _nesting(self, v):
+        self._local.nesting = v
+
+    @property
+    def _use_nesting(self):
+        return getattr(self._local, 'use_nesting', False)
+
+    @_use_nesting.setter
+    def _use_nesting(self, v):
+        self._local.use_nesting = v
+
+    def _read_engine(self):
+        """Return the engine for reads, which is the writer's if the manager wrote recently"""
+
+        if self._last_write is not None and time.monotonic() - self._last_write < self.write_lag:
+            return self.database.engine
+
+        return self.database.reader()
 
-        self._use_nesting = False
     @contextmanager
-    def session(self):
-        """Provide a transactional scope around a series of operations."""
+    def session(self, read=False, write_lock=False):
+        """Provide a transactional scope around a series of operations.
+
+        Nested scopes share the session of the outermost scope, which commits when it exits.
+        If _use_nesting is set, each nested scope runs in a SAVEPOINT, so an error
+        in the scope rolls back only the work done in it.
+
+        :param read: If True, and this is the outermost scope, the session may be bound to
+        one of the database's readers. Read scopes can't contain write scopes.
+        :param write_lock: If True, and this is the outermost scope, on Sqlite, take the write lock
+        when the transaction begins, for a transaction that will write while other processes
+        may be writing.
+        """
+
+        savepoint = None
 
         if self._session:
+            outer = False
+
+            if not read and self._session.info.get('read'):
+                raise RuntimeError("Can't write in a read session")
+
             if self._use_nesting:
-                self._session.begin_nested()
-            pass
+                savepoint = self._session.begin_nested()
+                created = len(self._session.info.get('created_files', []))
         else:
             assert self._nesting == 0
-            self._session = self.database.Session()
+            outer = True
+
+            if read:
+                self._session = self.database.Session(bind=self._read_engine())
+            elif write_lock:
+                self._session = self.database.Session(
+                    bind=self.database.engine.execution_options(sqlite_immediate=True))
+            else:
+                self._session = self.database.Session()
+
             self._session.info['manager'] = self
+            self._session.info['read'] = read
 
         try:
-            if self._use_nesting:
-                self._nesting += 1
+            self._nesting += 1
 
             yield self._session
-            if self._session:
+
+            if savepoint is not None:
+                savepoint.commit()
+            elif outer:
+                wrote = self._session.info.get('wrote')
                 self._session.commit()
+
+                if wrote:
+                    self._last_write = time.monotonic()
         except:
-            if self._session:
+            if savepoint is not None:
+                savepoint.rollback()
+                self._remove_created(created)
+            elif outer:
                 self._session.rollback()
+                self._remove_created(0)
             raise
         finally:
-            if self._session:
+            self._nesting -= 1
+
+            if outer:
                 self._session.close()
+                self._session = None
 
-            if self._use_nesting:
-                self._nesting -= 1
+    def _remove_created(self, mark):
+        """Remove the files created for resources after the mark, a position in the session's
+        list of created files, when the transaction that created them is rolled back"""
 
-            if self._nesting == 0:
-                self._session = None
+        created = self._session.info.get('created_files', [])
+
+        for path in created[mark:]:
+            if exists(path):
+                remove(path)
+
+        del created[mark:]
+
+    @contextmanager
+    def batch(self, commit_every=None):
+        """Add many documents in one transaction.
+
+        Each document is added in its own SAVEPOINT, so a document that fails to load
+        is rolled back and recorded, without aborting the rest of the batch::
+
+            with mm.batch(commit_every=500) as b:
+                for ref in refs:
+                    b.add_doc(MetapackDoc(ref))
+
+            print(len(b.added), len(b.failed))
+
+        :param commit_every: If set, commit after this many documents have been added,
+        rather than only at the end of the batch.
+        """
+
+        with self.session() as s:
+            use_nesting, self._use_nesting = self._use_nesting, True
+            try:
+                yield IngestBatch(self, s, commit_every)
+            finally:
+                self._use_nesting = use_nesting
 
     def init_tables(self):
         pass
@@ -109,6 +437,12 @@ class MetatabManager(object):
         def add_term(session, document, t):
             term_class = cls_map[type(t)]
 
+            if isinstance(t, metatab.SectionTerm):
+                # The section's arguments, the names of its property columns, in order
+                properties = {a: '' for a in t.property_names if a}
+            else:
+                properties = t.all_props
+
             term = term_class(
                 document=document,
                 parent_term=t.parent_term_lc,
@@ -117,7 +451,7 @@ class MetatabManager(object):
                 value=t.value,
                 section=t.section._db_term if t.section is not None else None,
                 term_value_name=t.term_value_name,
-                properties=t.all_props
+                properties=properties
             )
 
             session.add(term)
@@ -137,11 +471,12 @@ class MetatabManager(object):
 
             session.add(resource)
 
-        with self.session() as s:
+        with self.session(write_lock=True) as s:
             document = Document()
             document.update_from_doc(mt_doc)
+            document.ingested = datetime.utcnow()
             s.add(document)
-            s.commit()
+            s.flush() # Get the document id, which is used for resource table names
 
             add_term(s,document, mt_doc.root)
 
@@ -157,22 +492,43 @@ class MetatabManager(object):
                     if t.term_is('Root.Datafile'):
                         add_resource(s,document,t)
 
-            s.commit()
+            s.flush()
+
+            if self.lazy:
+                for r in document.resources:
+                    r.make_table()
+
+                s.flush()
+
             s.expunge(document)
             return document
 
-    def load(self, url, load_all_resources = False):
-        """Load a package and possibly one or all resources, from a url"""
+    def load(self, url, load_all_resources = False, bulk=False, progress=None):
+        """Load a package and possibly one or all resources, from a url. If the manager is lazy,
+        the resources are not loaded until they are read. If bulk is True, resources are
+        loaded in bulk load mode; see load_resource(). progress is a callable that is called
+        with a LoadProgress as each resource loads; see Resource.load_rows()"""
+        from metapack import MetapackDoc
+        from rowgenerators import parse_app_url
 
         u = parse_app_url(url)
 
         d = MetapackDoc(u.clear_fragment())
 
-        db_doc = self.document(name=d.get_value('Root.Name'))
+        name = d.get_value('Root.Name')
+
+        db_doc = self.document(name=name)
 
         if not db_doc:
-            self.add_doc(d)
-            db_doc = self.document(name=d.get_value('Root.Name'))
+            with self.leases.hold('document:' + name):
+                # Check again, on the writer, since another process may have added it while we waited
+                with self.session() as s:
+                    added = s.query(Document.id).filter(Document.name == name).first() is not None
+
+                if not added:
+                    self.add_doc(d)
+
+            db_doc = self.document(name=name)
             assert db_doc
 
         resources = []
@@ -180,25 +536,40 @@ class MetatabManager(object):
         if load_all_resources:
 
             for r in self.resources(db_doc):
-                self.load_resource(r)
+                if not self.lazy:
+                    self.load_resource(r, bulk=bulk, progress=progress)
                 resources.append(r)
 
         elif u.target_file:
 
             r = self.resource(db_doc, u.target_file)
 
-            self.load_resource(r)
+            if not self.lazy:
+                self.load_resource(r, bulk=bulk, progress=progress)
 
-            resources.append(d)
+            resources.append(r)
 
         return (db_doc, resources)
 
 
     def documents(self):
         """Return a subset of fields from all of the documents that have been loaded into the database"""
-        with self.session() as s:
+        # Run in the session, so a lazy query can't start a transaction after it closes,
+        # which would hold a Sqlite read lock until the session is garbage collected
+        def f(s):
             return s.query(Document)\
-                   .options(load_only("id","identifier","name","title","description"))
+                   .options(load_only("id","identifier","name","title","description")).all()
+
+        if self._session:
+            return f(self._session)
+
+        with self.session(read=True) as s:
+            docs = f(s)
+
+            for d in docs:
+                s.expunge(d)
+
+            return docs
 
     def document(self, ref=None, id=None, identifier=None, name=None):
         """
@@ -231,13 +602,79 @@ class MetatabManager(object):
         if self._session:
             return f(self._session, ref, id, identifier, name)
         else:
-            with self.session() as s:
+            with self.session(read=True) as s:
                 d = f(self._session, ref, id, identifier, name)
                 if d:
                     s.expunge(d) # So the doc can be used outside of the session
 
                 return d
 
+    def versions(self, name_nv):
+        """Return the documents for all versions of a package, given the unversioned name,
+        newest version first"""
+
+        def f(s):
+            return s.query(Document).filter(Document.name_nv == name_nv)\
+                .order_by(Document.version.is_(None), Document.version.desc(),
+                          Document.ingested.desc(), Document.id.desc()).all()
+
+        if self._session:
+            return f(self._session)
+
+        with self.session(read=True) as s:
+            docs = f(s)
+
+            for d in docs:
+                s.expunge(d)
+
+            return docs
+
+    def latest(self, name_nv):
+        """Return the document for the newest version of a package, given the unversioned name"""
+        return next(iter(self.versions(name_nv)), None)
+
+    def superseded(self, keep=1, newer_than=None):
+        """Return the ids of documents that a retention policy would delete. The newest version
+        of each package is always kept.
+
+        :param keep: Number of versions of each package to keep
+        :param newer_than: A datetime. If set, versions ingested after it are also kept
+        """
+
+        keep = max(keep or 0, 1)
+
+        ids = []
+
+        with self.session() as s:
+            q = s.query(Document.id, Document.name_nv, Document.ingested)\
+                .order_by(Document.name_nv, Document.version.is_(None), Document.version.desc(),
+                          Document.ingested.desc(), Document.id.desc())
+
+            last_name = None
+
+            for id, name_nv, ingested in q:
+                if name_nv != last_name:
+                    last_name, n = name_nv, 0
+
+                n += 1
+
+                if n <= keep or (newer_than is not None and ingested is not None and ingested > newer_than):
+                    continue
+
+                ids.append(id)
+
+        return ids
+
+    def gc(self, keep=1, newer_than=None, chunk_size=500):
+        """Delete superseded versions of packages, with their resource tables, in bulk. See
+        superseded() for the retention policy. Returns the ids of the deleted documents"""
+
+        ids = self.superseded(keep, newer_than)
+
+        self.delete_documents(ids, chunk_size=chunk_size)
+
+        return ids
+
     def resources(self, doc):
         """Return the resources for a database document"""
 
@@ -246,7 +683,7 @@ class MetatabManager(object):
             return self._session.query(Resource).filter_by(document_id=doc.id).all()
         else:
             # Create a session and detach the object so they can be used outside the session
-            with self.session() as s:
+            with self.session(read=True) as s:
 
                 resources = []
 
@@ -264,12 +701,23 @@ class MetatabManager(object):
 
         if self._session:
             return f(self._session)
-        with self.session() as s:
+        with self.session(read=True) as s:
             r = f(s)
             s.expunge(r)
             return r
 
 
+    def resource_by_id(self, id):
+        """Return a resource by its id"""
+
+        if self._session:
+            return self._session.query(Resource).get(id)
+
+        with self.session(read=True) as s:
+            r = s.query(Resource).get(id)
+            s.expunge(r)
+            return r
+
     def create_resource_table(self, table):
         """Create resource table on the database"""
         table.create(self.database.engine)
@@ -292,13 +740,508 @@ class MetatabManager(object):
 
         self.metadata = MetaData(bind=self.engine)
 
+    def delete_documents(self, ids, chunk_size=500):
+        """Delete documents, with their terms, resources and resource tables.
 
-    def load_resource(self, r):
+        Unlike deleting a Document through the session, which relies on the ORM cascades
+        to load and delete every term and resource one at a time, this issues set-based
+        DELETE statements, a chunk of documents at a time, and drops the resource
+        tables, all in one transaction. Shard files, and the files of file storage backends,
+        for the resources are deleted after the transaction commits.
+
+        :param ids: Iterable of document ids
+        :param chunk_size: Number of documents to delete per statement. Keeps the number
+        of bound parameters under the limits of databases like Sqlite
+        :return: The number of documents deleted
+        """
+
+        n = 0
+
+        shard_paths = []
+        shard_views = []
+        storage_files = []  # (backend, path) for file storage backends
 
         with self.session() as s:
+
+            quote = s.bind.dialect.identifier_preparer.quote
+
+            for chunk in chunks(ids, chunk_size):
+
+                deleted = s.query(Resource).filter(Resource.document_id.in_(chunk))\
+                    .options(load_only('table_name', 'storage_table', 'shard_path', 'storage', 'storage_path')).all()
+
+                resource_ids = s.query(Resource.id).filter(Resource.document_id.in_(chunk))
+
+                s.query(ColumnStats).filter(ColumnStats.resource_id.in_(resource_ids))\
+                    .delete(synchronize_session=False)
+                s.query(Resource).filter(Resource.document_id.in_(chunk)).delete(synchronize_session=False)
+                s.query(Term).filter(Term.document_id.in_(chunk)).delete(synchronize_session=False)
+                n += s.query(Document).filter(Document.id.in_(chunk)).delete(synchronize_session=False)
+
+                storage = {}
+
+                for r in deleted:
+                    if not r.table_name:
+                        continue
+
+                    storage[r.storage_table or r.table_name] = r
+
+                    if r.shared:
+                        if r.backend.columnar:
+                            pass  # Shares the other resource's file, without a view
+                        elif r.shard_path:
+                            shard_views.append((r.shard_path, r.table_name))
+                        else:
+                            s.execute('DROP VIEW IF EXISTS {}'.format(quote(r.table_name)))
+
+                # Tables that are shared are dropped with the last resource that uses them
+                in_use = {t for t, in s.query(Resource.storage_table)
+                          .filter(Resource.storage_table.in_(list(storage)))}
+
+                for table_name, r in storage.items():
+                    if table_name in in_use:
+                        continue
+
+                    if r.backend.columnar:
+                        if r.storage_path:
+                            storage_files.append((r.backend, r.storage_path))
+                    elif r.shard_path:
+                        shard_paths.append(r.shard_path)
+                    else:
+                        for t in (table_name, table_name + '_rejects'):
+                            s.execute('DROP TABLE IF EXISTS {}'.format(quote(t)))
+
+        # Shard files are changed after the catalog changes are committed
+        for path in shard_paths:
+            if exists(path):
+                remove(path)
+
+        for path, view in shard_views:
+            if exists(path):
+                with self.database.shard_engine(path).begin() as connection:
+                    connection.execute('DROP VIEW IF EXISTS {}'.format(quote(view)))
+
+        for backend, path in storage_files:
+            backend.drop(path)
+
+        return n
+
+
+    def load_resource(self, r, bulk=False, **kwargs):
+        """Create the table for a resource and load it. Keyword arguments are passed to
+        Resource.load_resource(). Returns the load statistics from Resource.load_resource()
+
+        Indexes declared in the schema, and in the resource's index spec, are built after the rows
+        are loaded. In bulk load mode, a PostgreSQL table is created UNLOGGED, and made logged
+        after it is loaded, and the table is analyzed.
+
+        Resources in shard files, or in file storage backends, such as 'parquet', are loaded
+        outside of the catalog transaction, so loads of different resources, in different processes,
+        only briefly lock the catalog.
+
+        If the manager shares tables, and another resource with the same source data and schema
+        is loaded, the resource uses the other resource's table, and nothing is loaded.
+
+        The load holds a lease on the resource, so if another process, or thread, is loading it,
+        this waits for that load to finish, and then finds the resource loaded. The leases the
+        thread holds are renewed when the load starts, and in the transaction that records it,
+        since the heartbeats can't renew them while the load writes to a Sqlite catalog. If
+        one was lost, the load is rolled back, and LeaseLost is raised."""
+
+        with self.leases.hold('resource:{}'.format(r.id)):
+            return self._load_resource(r, bulk, **kwargs)
+
+    def _load_resource(self, r, bulk=False, **kwargs):
+
+        self.leases.renew_held()
+
+        with self.session(write_lock=True) as s:
             dbr = s.query(Resource).get(r.id)
-            dbr.make_table()
+
+            if not dbr.loaded and self.share:
+                other = self._shared_resource(s, dbr)
+
+                if other is not None:
+                    dbr.share_table(other)
+                    return None
+
+            dbr.make_table(unlogged=bulk)
+
+            backend = dbr.backend
+
+            if dbr.loaded or not backend.detached(dbr):
+                stats = dbr.load_resource(bulk=bulk, **kwargs)
+                self.leases.renew_held(s.connection())
+                return stats
+
+            fast_csv = dbr.fast_csv
+            index_spec = dbr.index_spec or ''  # Not None, which would read it from the detached resource
+
+            if kwargs.get('progress') is not None:
+                kwargs.setdefault('total_rows', dbr.previous_rows())
+
+            s.flush()
+            s.expunge(dbr)
+
+        with backend.connect(dbr, self.database) as connection:
+            stats = dbr.load_rows(connection, self.cache, fast_csv=fast_csv, bulk=bulk,
+                                  index_spec=index_spec, **kwargs)
+
+        with self.session(write_lock=True) as s:
+            self.leases.renew_held(s.connection())
+
+            dbr = s.query(Resource).get(dbr.id)
+            dbr.set_column_stats(stats['columns'])
+            dbr.mark_loaded()
+
+        return stats
+
+    def _shared_resource(self, session, r):
+        """Return a loaded resource with the same source data and schema as r, in the same storage
+        backend, or None"""
+
+        # The backend make_table() would use, so a resource isn't moved to another backend
+        storage = get_storage(r.storage or r.storage_spec or self.storage).name
+
+        if r.fingerprint is None:
+            r.fingerprint = r.source_fingerprint(self.cache)
+
+            if r.fingerprint is None:
+                return None
+
+        if storage == SQL:
+            in_storage = (Resource.storage == SQL) | Resource.storage.is_(None)
+        else:
+            in_storage = Resource.storage == storage
+
+        return session.query(Resource)\
+            .filter(Resource.fingerprint == r.fingerprint)\
+            .filter(Resource.loaded.is_(True))\
+            .filter(Resource.id != r.id)\
+            .filter(in_storage)\
+            .first()
+
+    def _shards(self, session, table_names):
+        """Return a dict of attachment names to paths, for the shard files of the named tables"""
+
+        q = session.query(Resource).options(load_only('id', 'shard_path'))\
+            .filter(Resource.shard_path.isnot(None))\
+            .filter(Resource.table_name.in_(list(with_rejects_resources(table_names))))
+
+        # Resources that share a table are in the same file, which is attached once
+        names = {}
+        for r in q:
+            names.setdefault(r.shard_path, 'shard_{}'.format(r.id))
+
+        return {name: path for path, name in names.items()}
+
+    def _columnar(self, table_names):
+        """Return the columnar storage backend of the named resource tables, and a dict of their table
+        names to file paths, or (None, {}) if none of them are in a columnar backend. Raises ValueError if
+        a columnar table is queried with a table that isn't a loaded resource in the same backend, such
+        as a catalog table, or a table in the 'sql' backend, since they can't be queried together"""
+
+        table_names = {t.lower() for t in table_names}
+
+        # Rejects tables of columnar resources are in files beside the resource's file
+        names = with_rejects_resources(table_names)
+
+        with self.session(read=True) as s:
+            rows = s.query(Resource.table_name, Resource.storage, Resource.storage_path, Resource.loaded)\
+                .filter(Resource.table_name.in_(list(names))).all()
+
+        columnar = [(table_name, get_storage(storage), path) for table_name, storage, path, loaded in rows
+                    if loaded and get_storage(storage).columnar]
+
+        if not columnar:
+            return None, {}
+
+        backends = {backend.name for _, backend, _ in columnar}
+
+        if len(backends) > 1:
+            raise ValueError("Can't query tables in different storage backends together: {}"
+                             .format(', '.join(sorted(backends))))
+
+        # Catalog tables, and resources that aren't loaded in the backend
+        others = (table_names & set(Base.metadata.tables)) | \
+            ({table_name for table_name, _, _, _ in rows} - {table_name for table_name, _, _ in columnar})
+
+        if others:
+            raise ValueError("Can't query tables in the '{}' storage backend with other tables: {}"
+                             .format(next(iter(backends)), ', '.join(sorted(others))))
+
+        return columnar[0][1], {table_name: path for table_name, _, path in columnar}
+
+    @contextmanager
+    def connection(self, table_names=(), read=True):
+        """Provide a connection for reading resource tables, to a reader if the database has them,
+        with the shard files for any of the named tables attached. Sqlite limits the number of attached
+        databases, by default to 10.
+
+        :param read: If False, connect to the writer
+        """
+
+        engine = self._read_engine() if read else self.database.engine
+
+        with engine.connect() as connection:
+
+            if not self.database.shard_dir:
+                yield connection
+                return
+
+            with self.session(read=read) as s:
+                shards = self._shards(s, table_names)
+
+            names = self.database.attach(connection, shards)
+
+            try:
+                yield connection
+            finally:
+                self.database.detach(connection, names)
+
+    def ensure_loaded(self, table_names):
+        """Load any of the named resource tables that have not been loaded. Each resource has a lock,
+        so threads that read the same resource at the same time load it only once."""
 
         with self.session() as s:
-            dbr = s.query(Resource).get(r.id)
-            dbr.load_resource()
+            ids = [r.id for r in s.query(Resource).options(load_only('id'))
+                   .filter(Resource.table_name.in_(list(table_names)))
+                   .filter(Resource.loaded.isnot(True))]
+
+        for id in ids:
+            with self._load_locks_lock:
+                lock = self._load_locks.setdefault(id, threading.Lock())
+
+            with lock:
+                # From the writer, since a reader may not have the latest load yet
+                with self.session() as s:
+                    r = s.query(Resource).get(id)
+                    s.expunge(r)
+
+                if not r.loaded:
+                    self.load_resource(r)
+
+    def _query_key(self, sql, params, table_names):
+        """Return the query cache key for a query, or None if the query can't be cached, because it
+        isn't a SELECT, reads catalog tables, which have no load generations, or reads no resource tables"""
+        from .querycache import QueryCache, normalize_sql
+
+        names = {t.lower() for t in table_names}
+
+        if not normalize_sql(sql).startswith(('select', 'with')) or names & set(Base.metadata.tables):
+            return None
+
+        # A shared resource is a view of another resource's table, so its results change when that
+        # table is loaded
+        owner = aliased(Resource)
+        owner_document = aliased(Document)
+
+        with self.session(read=True) as s:
+            # The document's ingest time distinguishes a resource from a deleted one with the same id
+            generations = [tuple(str(v) for v in row) for row in
+                           s.query(Resource.table_name, Resource.id, Resource.generation, Document.ingested,
+                                   owner.id, owner.generation, owner_document.ingested)
+                           .join(Document, Resource.document_id == Document.id)
+                           .outerjoin(owner, and_(owner.table_name == Resource.storage_table, owner.id != Resource.id))
+                           .outerjoin(owner_document, owner.document_id == owner_document.id)
+                           .filter(Resource.table_name.in_(list(names)))]
+
+        if not generations:
+            return None
+
+        return QueryCache.key(sql, params, generations, self.database.engine.url)
+
+    def query(self, sql, *params):
+        """Run a query against the resource tables and return a list of result rows. Any
+        resource tables that are in shard files are attached for the query. For a lazy
+        manager, resource tables that haven't been loaded are loaded first.
+
+        If the manager has a query cache, results of SELECT statements over resource tables are
+        cached, as tuples, until one of the tables is loaded again.
+
+        Queries of resources in a columnar storage backend run in the backend, such as DuckDB for
+        'parquet', and return tuples. They can't also read tables in the catalog database."""
+
+        table_names = set(re.findall(r'\w+', sql))
+
+        if self.lazy:
+            self.ensure_loaded(table_names)
+
+        key = self._query_key(sql, params, table_names) if self.query_cache is not None else None
+
+        if key is not None:
+            rows = self.query_cache.get(key)
+
+            if rows is not None:
+                return rows
+
+        backend, columnar = self._columnar(table_names)
+
+        if backend is not None:
+            rows = backend.query(columnar, sql, params)
+        else:
+            with self.connection(table_names) as connection:
+                rows = connection.execute(sql, *params).fetchall()
+
+        if key is not None:
+            rows = self.query_cache.put(key, rows)
+
+        return rows
+
+    def read(self, r):
+        """Return all of the rows in a resource's table"""
+        quote = self.database.engine.dialect.identifier_preparer.quote
+        return self.query('SELECT * FROM {}'.format(quote(r.table_name)))
+
+    def export_document(self, doc, fp, format='csv'):
+        """Write a document to a text file object as Metatab CSV, or as JSON lines, one object per
+        term. The terms are streamed from the catalog, without building a MetapackDoc.
+
+        :param doc: A Document, or a document id
+        :param fp: Text file object. For CSV, open it with newline=''
+        :param format: 'csv' or 'jsonl'
+        """
+        from .export import FORMATS, iter_terms, write_csv, write_jsonl
+
+        if format not in FORMATS:
+            raise ValueError("Unknown export format '{}'; expected one of {}".format(format, ', '.join(FORMATS)))
+
+        doc_id = getattr(doc, 'id', doc)
+
+        with self.connection() as connection:
+            terms = iter_terms(connection, [doc_id])
+
+            if format == 'csv':
+                write_csv(terms, fp)
+            else:
+                write_jsonl(terms, fp)
+
+    def export_documents(self, dest, ids=None, format='jsonl', chunk_size=500):
+        """Export many documents, streaming their terms from the catalog a chunk of documents at a
+        time, so memory use doesn't depend on the number of documents. Returns the number of
+        documents exported.
+
+        :param dest: For 'jsonl', a text file object, which gets a {"document": ...} line before the
+        terms of each document. For 'csv', a directory, which gets a <name>.csv file for each document
+        :param ids: Ids of the documents to export. If None, export all of them
+        :param format: 'csv' or 'jsonl'
+        :param chunk_size: Number of documents to query at a time
+        """
+        from .export import FORMATS, by_document, iter_terms, write_csv, write_jsonl
+
+        if format not in FORMATS:
+            raise ValueError("Unknown export format '{}'; expected one of {}".format(format, ', '.join(FORMATS)))
+
+        if ids is None:
+            with self.session(read=True) as s:
+                ids = [id for id, in s.query(Document.id).order_by(Document.id)]
+
+        if format == 'csv':
+            makedirs(dest, exist_ok=True)
+
+        n = 0
+
+        with self.connection() as connection:
+            for chunk in chunks(ids, chunk_size):
+
+                docs = {row.id: dict(zip(row.keys(), row)) for row in connection.execute(
+                    select([Document.id, Document.identifier, Document.name, Document.version])
+                    .where(Document.id.in_(chunk)))}
+
+                terms = iter_terms(connection, chunk)
+
+                if format == 'csv':
+                    for doc_id, doc_terms in by_document(terms):
+                        with open(join(dest, docs[doc_id]['name'] + '.csv'), 'w', newline='') as f:
+                            write_csv(doc_terms, f)
+                else:
+                    write_jsonl(terms, dest, docs)
+
+                n += len(docs)
+
+        return n
+
+    def export_snapshot(self, path, resources=(), batch_size=5000):
+        """Write a compact, read-only copy of the catalog to a Sqlite file, for services that
+        only read it, which open it with Database.snapshot(). The snapshot has the mt_* tables, with
+        indexes for the manager's lookups, and is analyzed and vacuumed. The file is written
+        under a temporary name, and moved into place when it is complete.
+
+        :param path: Path of the snapshot file
+        :param resources: Resources, or table names, whose tables are copied into the snapshot.
+        The other resources are in the snapshot's catalog, with no tables. Resources in columnar
+        storage backends aren't copied; the snapshot refers to their files
+        :param batch_size: Number of rows to copy at a time
+        :return: The path of the snapshot
+        """
+        import sqlite3
+
+        table_names = [r if isinstance(r, str) else r.table_name for r in resources]
+
+        tmp = path + '.tmp'
+
+        if exists(tmp):
+            remove(tmp)
+
+        with self.session() as s:
+            copied = s.query(Resource).filter(Resource.table_name.in_(table_names)).all()
+
+            for r in copied:
+                s.expunge(r)
+
+        engine = create_engine('sqlite:///' + tmp)
+
+        Base.metadata.create_all(engine)
+
+        def copy(src, dst, source_table, dest_table):
+            rows = src.execute(source_table.select())
+
+            while True:
+                batch = rows.fetchmany(batch_size)
+
+                if not batch:
+                    break
+
+                dst.execute(dest_table.insert(), [dict(row) for row in batch])
+
+        # One transaction on the writer, so the snapshot is consistent
+        with self.connection(table_names, read=False) as src, src.begin(), engine.begin() as dst:
+
+            for table in Base.metadata.sorted_tables:
+                copy(src, dst, table, table)
+
+            for r in copied:
+                if r.backend.columnar:
+                    continue
+
+                # Named for the resource, even if its rows are in a shared table
+                table = r.table
+                table.create(dst)
+                copy(src, dst, table, table)
+
+            resources_table = Resource.__table__
+
+            dst.execute(resources_table.update()
+                        .where(resources_table.c.table_name.notin_(table_names))
+                        .values(table_created=False, loaded=False, storage_table=None, shard_path=None,
+                                storage=None, storage_path=None))
+
+            dst.execute(resources_table.update()
+                        .where(resources_table.c.table_name.in_(table_names))
+                        .values(storage_table=resources_table.c.table_name, shard_path=None))
+
+            for table_name, column in SNAPSHOT_INDEXES:
+                dst.execute('CREATE INDEX IF NOT EXISTS ix_{0}_{1} ON {0} ({1})'.format(table_name, column))
+
+        engine.dispose()
+
+        conn = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            conn.execute('ANALYZE')
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+
+        replace(tmp, path)
+
+        return path
@@ -67,7 +67,10 @@ class Document(Base):
     id = Column(Integer, primary_key=True)
     identifier = Column(String, nullable=False, unique=True)
     name = Column(String, nullable=False, unique=True)
-    name_nv = Column(String, nullable=False)
+    name_nv = Column(String, nullable=False, index=True)
+    version = Column(Integer)  # Root.Version, if it is an integer
+
+    ingested = Column(DateTime)  # When the document was added to the database
 
     title = Column(String)
     description = Column(String)
@@ -102,6 +105,12 @@ class Document(Base):
         self.identifier = doc.get_value('Root.Identifier')
         self.name = doc.get_value('Root.Name')
         self.name_nv = doc.as_version(None)
+
+        try:
+            self.version = int(doc.get_value('Root.Version'))
+        except (TypeError, ValueError):
+            self.version = None
+
         # the Identifier is supposed to be unique for datasets, but it won't be between
         # versions and segument updates.
         self.table_prefix = hashlib.sha224(self.name.encode('utf-8')).hexdigest()[0:8]
@@ -0,0 +1,124 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Streaming export of catalog documents, as Metatab CSV or as JSON lines.
+
+Terms are read from the mt_terms table in the order they were added, which is the order
+of the original document, and written as they are read, without building metatab
+objects, so memory use doesn't grow with the size or number of the documents.
+"""
+
+import csv
+import json
+from itertools import groupby
+from operator import itemgetter
+
+from metatab import ELIDED_TERM
+from sqlalchemy import select
+
+from .term import Term
+
+FORMATS = ('csv', 'jsonl')
+
+
+def term_name(parent_term, record_term):
+    """Return the name of a term, as it is written in a Metatab CSV row"""
+
+    if parent_term == 'root':
+        return record_term
+    elif parent_term == ELIDED_TERM:
+        return '.' + record_term
+    else:
+        return parent_term + '.' + record_term
+
+
+def iter_terms(connection, document_ids):
+    """Yield (document_id, term, value, section, properties) tuples for the terms of documents,
+    ordered by document, then in the order of the terms in the document. Sections are yielded
+    with a term of 'Section' and the section name as the value, and properties whose keys are
+    the section's arguments, the names of the property columns. The root section isn't yielded.
+
+    :param connection: A SqlAlchemy Connection
+    :param document_ids: Ids of the documents
+    """
+
+    t = Term.__table__
+
+    q = select([t.c.document_id, t.c.id, t.c.class_type, t.c.section_id, t.c.parent_term,
+                t.c.record_term, t.c.term_value_name, t.c.value, t.c.properties]) \
+        .where(t.c.document_id.in_(list(document_ids))) \
+        .order_by(t.c.document_id, t.c.id)
+
+    document_id = None
+    sections = {}  # Section names, by term id, for the current document
+
+    for row in connection.execution_options(stream_results=True).execute(q):
+
+        if row.document_id != document_id:
+            document_id = row.document_id
+            sections = {}
+
+        if row.class_type in ('root', 'section'):
+            sections[row.id] = row.value or 'Root'
+
+            if row.class_type == 'section' and str(row.value).lower() != 'root':
+                # The section's own value, the section name, isn't one of the arguments
+                value_names = ('@value', (row.term_value_name or '@value').lower())
+                args = {k: v for k, v in (row.properties or {}).items() if k.lower() not in value_names}
+
+                yield row.document_id, 'Section', row.value, row.value, args
+        else:
+            yield (row.document_id, term_name(row.parent_term, row.record_term), row.value,
+                   sections.get(row.section_id), row.properties)
+
+
+def write_csv(terms, fp):
+    """Write terms from iter_terms(), for one document, as Metatab CSV rows, in the layout of
+    metatab's CSV writer. Each section row has the section's arguments, and each term row
+    has the values of its properties in those columns. Children that are written in their
+    parent's columns aren't also written as rows"""
+
+    w = csv.writer(fp)
+
+    args = []  # Arguments of the current section, lower cased
+
+    for _, term, value, _, properties in terms:
+
+        if term == 'Section':
+            w.writerow([''])
+            w.writerow(['Section', value] + list(properties or {}))
+            args = [a.lower() for a in properties or {}]
+            continue
+
+        if '.' in term and term.rsplit('.', 1)[1] in args:
+            continue  # A child that is in a property column of its parent
+
+        props = {k.lower(): v for k, v in (properties or {}).items()}
+
+        w.writerow([term.title(), '' if value is None else value] +
+                   ['' if props.get(a) is None else props[a] for a in args])
+
+
+def write_jsonl(terms, fp, documents=None):
+    """Write terms from iter_terms() as JSON lines, one object per term
+
+    :param documents: Optional dict of document ids to dicts, each written as a
+    {"document": ...} line before the first term of the document
+    """
+
+    document_id = None
+
+    for doc_id, term, value, section, properties in terms:
+
+        if documents is not None and doc_id != document_id:
+            fp.write(json.dumps({'document': documents.get(doc_id)}, default=str) + '\n')
+            document_id = doc_id
+
+        fp.write(json.dumps({'document_id': doc_id, 'term': term, 'value': value, 'section': section,
+                             'properties': properties}, default=str) + '\n')
+
+
+def by_document(terms):
+    """Group terms from iter_terms() by document, yielding (document_id, terms)"""
+    return groupby(terms, key=itemgetter(0))
@@ -0,0 +1,383 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A queue of package load jobs, in the catalog, and workers that run them.
+
+Jobs are rows in mt_jobs. A worker claims the queued job with the highest priority
+with an UPDATE that only matches the job while it is still queued, so on both Sqlite
+and PostgreSQL, each job is claimed by one worker. While a job runs, the worker holds
+a lease on it. A job that fails is queued again, after a backoff that doubles with each
+attempt, until it has used all of its attempts. A job whose worker died, which is
+running without a lease, is treated as a failure and retried. The lease is checked again in
+the transaction that retries the job, since, on Sqlite, a worker that is loading into the
+catalog renews its lease in the load's transaction, and while it loads, the lease looks
+expired to other processes. A job is only marked done
+or failed by the worker that claimed it, so a worker that was presumed dead can't overwrite
+the state of the retry. Job times come from the database's clock.
+
+Any number of workers, on any number of hosts, can run jobs from one catalog. Workers
+wait, and try again, while another process holds the catalog's write lock.
+"""
+
+import threading
+import time
+import traceback
+from datetime import timedelta
+
+from sqlalchemy import Boolean, Column, DateTime, Float, Integer, String, Text, exists, func, select
+from sqlalchemy.exc import OperationalError
+
+from .lease import Lease, database_now, is_locked
+from .orm import Base
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Job(Base):
+    """A job to load a package, or one resource of a package"""
+
+    __tablename__ = 'mt_jobs'
+
+    id = Column(Integer, primary_key=True)
+    url = Column(String, nullable=False)
+    bulk = Column(Boolean, default=False)
+
+    priority = Column(Integer, default=0)  # Higher priorities run first
+    state = Column(String, nullable=False, default=QUEUED, index=True)
+
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=1)
+    run_after = Column(DateTime)  # Queued jobs don't run until this time, for the backoff after a failure
+
+    owner = Column(String)  # Worker running the job
+    enqueued = Column(DateTime)
+    started = Column(DateTime)
+    finished = Column(DateTime)
+
+    rows = Column(Integer)  # Rows loaded
+    elapsed = Column(Float)  # Seconds spent running the last attempt
+    error = Column(Text)  # Error from the last failed attempt
+
+    def __repr__(self):
+        return "<Job {} {} {} attempts={}>".format(self.id, self.state, self.url, self.attempts)
+
+
+class JobQueue(object):
+    """Add, claim and finish jobs in a catalog"""
+
+    def __init__(self, manager, backoff=30.0, max_backoff=3600.0):
+        """
+        :param manager: A MetatabManager, for the catalog database, and to run the jobs
+        :param backoff: Seconds to wait before the first retry of a failed job. Each retry waits
+        twice as long as the one before
+        :param max_backoff: Maximum seconds to wait before a retry
+        """
+        self.manager = manager
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    @property
+    def engine(self):
+        return self.manager.database.engine
+
+    def _begin(self):
+        """Begin a transaction that takes the write lock at the start, on Sqlite"""
+        return self.engine.execution_options(sqlite_immediate=True).begin()
+
+    def enqueue(self, url, priority=0, retries=3, bulk=False):
+        """Add a job to load a package url. If the url has a fragment, only that resource is loaded,
+        otherwise all of the resources are. Returns the job id
+
+        :param priority: Jobs with higher priorities run first
+        :param retries: Number of times to retry the job if it fails
+        :param bulk: If True, load in bulk load mode. See MetatabManager.load_resource()
+        """
+        t = Job.__table__
+
+        with self._begin() as connection:
+            r = connection.execute(t.insert(), url=str(url), bulk=bulk, priority=priority, state=QUEUED,
+                                   attempts=0, max_attempts=retries + 1, enqueued=database_now(connection))
+
+            return r.inserted_primary_key[0]
+
+    def claim(self, owner):
+        """Claim the next job that is ready to run, and mark it running. Returns the Job, or None"""
+
+        t = Job.__table__
+
+        while True:
+            with self._begin() as connection:
+                now = database_now(connection)
+
+                id = connection.execute(
+                    select([t.c.id])
+                    .where(t.c.state == QUEUED)
+                    .where((t.c.run_after.is_(None)) | (t.c.run_after <= now))
+                    .order_by(t.c.priority.desc(), t.c.id)
+                    .limit(1)).scalar()
+
+                if id is None:
+                    return None
+
+                r = connection.execute(t.update()
+                                       .where(t.c.id == id)
+                                       .where(t.c.state == QUEUED)
+                                       .values(state=RUNNING, owner=owner, started=now, attempts=t.c.attempts + 1))
+
+                if r.rowcount == 1:
+                    return Job(**dict(connection.execute(t.select().where(t.c.id == id)).first()))
+
+            # Another worker claimed it first
+
+    @staticmethod
+    def _claimed(job):
+        """Restrict an update to a job that is still running for the worker that claimed it"""
+        t = Job.__table__
+        return t.update().where(t.c.id == job.id).where(t.c.state == RUNNING).where(t.c.owner == job.owner)
+
+    def complete(self, job, rows, elapsed):
+        """Mark a job done. Returns False if the job is no longer running for its owner, because
+        it was recovered and queued again, and then nothing is changed"""
+
+        with self._begin() as connection:
+            r = connection.execute(self._claimed(job)
+                                   .values(state=DONE, finished=database_now(connection), rows=rows,
+                                           elapsed=elapsed, error=None))
+            return r.rowcount == 1
+
+    def fail(self, job, error, elapsed=None):
+        """Record a failed attempt. The job is queued again, after a backoff, if it has attempts left,
+        otherwise it is marked failed. Returns False if the job is no longer running for its owner,
+        and then nothing is changed"""
+        return self._fail(job, error, elapsed)
+
+    def _fail(self, job, error, elapsed=None, unleased=False):
+        """Record a failed attempt, as for fail()
+
+        :param unleased: If True, only if the job has no lease, checked in the same transaction
+        """
+
+        with self._begin() as connection:
+            now = database_now(connection)
+
+            if job.attempts < job.max_attempts:
+                delay = min(self.backoff * 2 ** max(job.attempts - 1, 0), self.max_backoff)
+                values = dict(state=QUEUED, run_after=now + timedelta(seconds=delay), owner=None)
+            else:
+                values = dict(state=FAILED, finished=now)
+
+            q = self._claimed(job)
+
+            if unleased:
+                l = Lease.__table__
+                q = q.where(~exists().where(l.c.name == 'job:{}'.format(job.id)).where(l.c.expires >= now))
+
+            r = connection.execute(q.values(error=str(error), elapsed=elapsed, **values))
+            return r.rowcount == 1
+
+    def recover(self):
+        """Retry running jobs whose workers stopped, which have no lease. Returns the number of jobs"""
+
+        t = Job.__table__
+
+        leased = {l.name for l in self.manager.leases.active()}
+
+        with self.engine.connect() as connection:
+            # Give a worker time to take the lease after claiming the job
+            started = database_now(connection) - timedelta(seconds=self.manager.leases.ttl)
+
+            stale = [Job(**dict(row)) for row in
+                     connection.execute(t.select().where(t.c.state == RUNNING).where(t.c.started < started))
+                     if 'job:{}'.format(row.id) not in leased]
+
+        # A job that finished, or whose lease was renewed, since it was read isn't changed
+        return sum(self._fail(job, 'The worker stopped: {}'.format(job.owner), unleased=True) for job in stale)
+
+    def jobs(self, state=None):
+        """Return a list of jobs, optionally in one state, ordered by id"""
+
+        t = Job.__table__
+
+        q = t.select().order_by(t.c.id)
+
+        if state is not None:
+            q = q.where(t.c.state == state)
+
+        with self.engine.connect() as connection:
+            return [Job(**dict(row)) for row in connection.execute(q)]
+
+    def stats(self):
+        """Return a dict of the number of jobs in each state, with the number of queued jobs that
+        are waiting to be retried, and the rows, time and throughput of done jobs"""
+
+        t = Job.__table__
+
+        with self.engine.connect() as connection:
+            counts = dict(connection.execute(select([t.c.state, func.count()]).group_by(t.c.state)).fetchall())
+
+            retrying = connection.execute(select([func.count()]).select_from(t)
+                                          .where(t.c.state == QUEUED).where(t.c.attempts > 0)).scalar()
+
+            rows, elapsed = connection.execute(select([func.sum(t.c.rows), func.sum(t.c.elapsed)])
+                                               .where(t.c.state == DONE)).first()
+
+            last_hour = connection.execute(
+                select([func.count()]).select_from(t)
+                .where(t.c.state == DONE)
+                .where(t.c.finished >= database_now(connection) - timedelta(hours=1))).scalar()
+
+        return {
+            QUEUED: counts.get(QUEUED, 0),
+            RUNNING: counts.get(RUNNING, 0),
+            DONE: counts.get(DONE, 0),
+            FAILED: counts.get(FAILED, 0),
+            'retrying': retrying,
+            'rows': rows or 0,
+            'elapsed': elapsed or 0.0,
+            'rows_per_sec': (rows or 0) / elapsed if elapsed else 0.0,
+            'done_last_hour': last_hour
+        }
+
+
+class Worker(object):
+    """Run jobs from a JobQueue, in one or more threads"""
+
+    def __init__(self, queue, concurrency=1, poll=5.0, exit_when_empty=False, progress=None):
+        """
+        :param queue: A JobQueue
+        :param concurrency: Number of jobs to run at once, each in its own thread
+        :param poll: Seconds to wait before checking again, when there are no jobs ready to run, or
+        before trying again, when the catalog is locked by another process
+        :param exit_when_empty: If True, each thread exits when there are no queued jobs
+        :param progress: Optional progress callable, passed to MetatabManager.load()
+        """
+        self.queue = queue
+        self.manager = queue.manager
+        self.concurrency = concurrency
+        self.poll = poll
+        self.exit_when_empty = exit_when_empty
+        self.progress = progress
+
+        self.completed = 0
+        self.failed = 0
+
+        self.error = None  # An error, other than a locked catalog, that stopped the worker
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _retry(self, f, *args, stoppable=True):
+        """Call a queue method, and if the catalog is locked, while another process holds the Sqlite
+        write lock, try again after the poll interval. Other errors are raised.
+
+        :param stoppable: If True, return None if the worker is stopped while waiting to try again.
+        Otherwise, keep trying, so a running job is recorded as done or failed
+        """
+
+        while True:
+            try:
+                return f(*args)
+            except OperationalError as e:
+                if not is_locked(e):
+                    raise
+
+            if stoppable:
+                if self._stop.wait(self.poll):
+                    return None
+            else:
+                time.sleep(self.poll)
+
+    def run_job(self, job):
+        """Run a claimed job, and mark it done or failed. Returns True if it succeeded"""
+
+        rows = [0]
+
+        def progress(p):
+            if p.done:
+                rows[0] += p.rows
+
+            if self.progress is not None:
+                self.progress(p)
+
+        start = time.perf_counter()
+
+        with self.manager.leases.hold('job:{}'.format(job.id)):
+            try:
+                self.manager.load(job.url, load_all_resources='#' not in job.url, bulk=bool(job.bulk),
+                                  progress=progress)
+            except Exception:
+                self._retry(self.queue.fail, job, traceback.format_exc(), time.perf_counter() - start,
+                            stoppable=False)
+
+                with self._lock:
+                    self.failed += 1
+
+                return False
+
+            self._retry(self.queue.complete, job, rows[0], time.perf_counter() - start, stoppable=False)
+
+        with self._lock:
+            self.completed += 1
+
+        return True
+
+    def _work(self):
+
+        owner = self.manager.leases.owner
+
+        while not self._stop.is_set():
+            try:
+                job = self.queue.claim(owner)
+
+                if job is not None:
+                    self.run_job(job)
+                    continue
+
+                self.queue.recover()
+
+                if self.exit_when_empty and not self.queue.stats()[QUEUED]:
+                    return
+            except Exception as e:
+                if not (isinstance(e, OperationalError) and is_locked(e)):
+                    # Such as a missing table, or a lost connection, which won't go away by waiting
+                    self.error = e
+                    self.stop()
+                    return
+
+                # The catalog is locked. Try again after the poll interval
+
+            self._stop.wait(self.poll)
+
+    def run(self):
+        """Run jobs until stopped, or, if exit_when_empty, until the queue is empty. If an error
+        other than a locked catalog stops a thread, the other threads finish their jobs, and
+        the error is raised"""
+
+        threads = [threading.Thread(target=self._work, name='metapack_db-worker-{}'.format(i), daemon=True)
+                   for i in range(self.concurrency)]
+
+        for t in threads:
+            t.start()
+
+        try:
+            for t in threads:
+                while t.is_alive():
+                    t.join(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+
+            for t in threads:
+                t.join()
+
+            raise
+
+        if self.error is not None:
+            raise self.error
+
+    def stop(self):
+        """Stop claiming jobs. Running jobs finish"""
+        self._stop.set()
@@ -0,0 +1,290 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Leases in the catalog, for coordinating processes that share it.
+
+A lease is a row in mt_leases, named for the thing it protects, such as a document
+name or a resource id, with an owner and an expiry time. A lease is acquired with an
+INSERT, which fails if the row exists, or with an UPDATE that only matches an expired
+row, so on both Sqlite and PostgreSQL, only one owner can hold it. While it is held, a
+heartbeat thread extends the expiry time. If the owner dies, the lease expires, and
+another owner can take it over.
+
+Each statement runs in its own short transaction, on its own connection, so other
+processes see leases as soon as they are acquired. Expiry times are in UTC, from the
+clock of the database, so they don't depend on the clocks of the hosts that share it.
+
+On Sqlite, a transaction that writes holds the lock on the whole database, so while a
+thread's own transaction is writing, its heartbeats can't renew its leases. A thread
+that holds leases renews them with renew_held() before a long write transaction, and,
+through the transaction's connection, before it commits, so the leases don't expire
+while it writes.
+"""
+
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from sqlalchemy import Column, DateTime, String, func, select
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from .orm import Base
+
+
+def database_now(connection):
+    """Return the current UTC time from the database's clock, as a naive datetime"""
+
+    dialect = connection.dialect.name
+
+    if dialect == 'sqlite':
+        now = connection.execute("SELECT strftime('%Y-%m-%d %H:%M:%f', 'now')").scalar()
+        return datetime.strptime(now, '%Y-%m-%d %H:%M:%S.%f')
+    elif dialect == 'postgresql':
+        return connection.execute("SELECT timezone('utc', clock_timestamp())").scalar()
+    elif dialect == 'mysql':
+        return connection.execute('SELECT UTC_TIMESTAMP(6)').scalar()
+    else:
+        return connection.execute(select([func.current_timestamp()])).scalar()
+
+
+def is_locked(e):
+    """True if an OperationalError is Sqlite's error for a database that another connection
+    is writing, which goes away when the writer commits"""
+    return 'database is locked' in str(e.orig if getattr(e, 'orig', None) is not None else e)
+
+
+class Lease(Base):
+    """A lease on a named thing, held by one owner until it expires"""
+
+    __tablename__ = 'mt_leases'
+
+    name = Column(String, primary_key=True)
+    owner = Column(String, nullable=False)
+    acquired = Column(DateTime)
+    expires = Column(DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return "<Lease {} owner={} expires={}>".format(self.name, self.owner, self.expires)
+
+
+class LeaseTimeout(RuntimeError):
+    """A lease could not be acquired before the timeout"""
+
+
+class LeaseLost(RuntimeError):
+    """A held lease expired, and another owner took it"""
+
+
+class Heartbeat(threading.Thread):
+    """Extend a lease periodically, until stopped. If the lease is lost, because it
+    expired and another owner took it, lost is set."""
+
+    def __init__(self, leases, name, owner, interval):
+        super().__init__(name='metapack_db-lease', daemon=True)
+        self.leases = leases
+        self.lease_name = name
+        self.owner = owner
+        self.interval = interval
+
+        self.lost = False
+
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if self.leases.renew(self.lease_name, self.owner) is False:
+                self.lost = True
+                return
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class Leases(object):
+    """Acquire, renew and release leases in a catalog"""
+
+    def __init__(self, engine, ttl=60.0, poll=0.5):
+        """
+        :param engine: SqlAlchemy engine for the catalog database
+        :param ttl: Seconds until a lease expires, if it isn't renewed. Held leases are
+        renewed every third of this time
+        :param poll: Seconds between attempts, when waiting for a lease
+        """
+        self.engine = engine
+        self.ttl = ttl
+        self.poll = poll
+
+        # Unique to this object, in this process, on this host
+        self.prefix = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+        self._local = threading.local()
+
+    def _begin(self):
+        """Begin a transaction that takes the write lock at the start, on Sqlite, so the expiry
+        time is from the database's clock when the lease is written, not when the transaction
+        began, which can be long before, if it waited for the lock"""
+        return self.engine.execution_options(sqlite_immediate=True).begin()
+
+    @property
+    def owner(self):
+        """The owner name for the current thread"""
+        return '{}:{}'.format(self.prefix, threading.get_ident())
+
+    @property
+    def _held(self):
+        """The leases held by the current thread, mapping names to Heartbeats"""
+        if not hasattr(self._local, 'held'):
+            self._local.held = {}
+
+        return self._local.held
+
+    def try_acquire(self, name, owner=None):
+        """Acquire a lease, if it is free or expired. Returns True if it was acquired"""
+
+        owner = owner or self.owner
+
+        t = Lease.__table__
+
+        try:
+            # Check with a read, so waiting for a lease doesn't take write locks, which, on Sqlite,
+            # can make the holder's transactions fail
+            with self.engine.connect() as connection:
+                row = connection.execute(select([t.c.owner, t.c.expires]).where(t.c.name == name)).first()
+                now = database_now(connection)
+
+            if row is not None and row.expires >= now and row.owner != owner:
+                return False
+
+            with self._begin() as connection:
+                now = database_now(connection)
+                expires = now + timedelta(seconds=self.ttl)
+
+                if row is None:
+                    connection.execute(t.insert(), name=name, owner=owner, acquired=now, expires=expires)
+                    return True
+
+                # Take over the lease if it expired
+                r = connection.execute(t.update()
+                                       .where(t.c.name == name)
+                                       .where((t.c.expires < now) | (t.c.owner == owner))
+                                       .values(owner=owner, acquired=now, expires=expires))
+                return r.rowcount == 1
+        except IntegrityError:
+            return False  # Another owner inserted it first
+        except OperationalError as e:
+            if is_locked(e):
+                return False  # Sqlite is locked by another writer
+            raise
+
+    def renew(self, name, owner=None, connection=None):
+        """Extend a lease. Returns False if the owner no longer holds it, or None if the
+        catalog couldn't be written, which may be temporary
+
+        :param connection: If given, renew in the connection's transaction, which will commit
+        the new expiry time. Otherwise, renew in a transaction of its own
+        """
+
+        owner = owner or self.owner
+        t = Lease.__table__
+
+        def _renew(connection):
+            r = connection.execute(t.update()
+                                   .where(t.c.name == name)
+                                   .where(t.c.owner == owner)
+                                   .values(expires=database_now(connection) + timedelta(seconds=self.ttl)))
+            return r.rowcount == 1
+
+        if connection is not None:
+            return _renew(connection)
+
+        try:
+            with self._begin() as connection:
+                return _renew(connection)
+        except OperationalError as e:
+            if is_locked(e):
+                return None
+            raise
+
+    def renew_held(self, connection=None):
+        """Renew the leases held by the current thread. Raises LeaseLost, and sets the lost
+        attribute of its Heartbeat, if one of them was lost.
+
+        :param connection: If given, renew in the connection's transaction, such as the
+        Sqlite transaction of a load, which blocks the heartbeats while it writes
+        """
+
+        for name, heartbeat in self._held.items():
+            if self.renew(name, heartbeat.owner, connection) is False:
+                heartbeat.lost = True
+
+            if heartbeat.lost:
+                raise LeaseLost("Lost lease '{}'; it expired, and another owner took it".format(name))
+
+    def release(self, name, owner=None):
+        """Release a lease, if the owner holds it. If the catalog can't be written, the lease
+        is left to expire"""
+
+        owner = owner or self.owner
+        t = Lease.__table__
+
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(t.delete().where(t.c.name == name).where(t.c.owner == owner))
+        except OperationalError as e:
+            if not is_locked(e):
+                raise
+
+    def active(self):
+        """Return the unexpired leases, as Lease objects"""
+
+        t = Lease.__table__
+
+        with self.engine.connect() as connection:
+            now = database_now(connection)
+            return [Lease(**dict(row)) for row in
+                    connection.execute(t.select().where(t.c.expires >= now).order_by(t.c.name))]
+
+    @contextmanager
+    def hold(self, name, timeout=None):
+        """Hold a lease for the duration of a context, waiting for it if another owner holds it,
+        and renewing it until the context exits. A thread that already holds the lease holds
+        it again. Yields the Heartbeat, whose lost attribute is set if the lease was lost.
+
+        :param name: Name of the lease
+        :param timeout: Seconds to wait for the lease before raising LeaseTimeout. If None, wait
+        until it is acquired
+        """
+
+        held = self._held
+
+        if name in held:
+            # Only the outermost hold releases the lease
+            yield held[name]
+            return
+
+        owner = self.owner
+        start = time.monotonic()
+
+        while not self.try_acquire(name, owner):
+            if timeout is not None and time.monotonic() - start >= timeout:
+                raise LeaseTimeout("Timed out waiting for lease '{}'".format(name))
+
+            time.sleep(self.poll)
+
+        heartbeat = Heartbeat(self, name, owner, self.ttl / 3)
+        heartbeat.start()
+
+        held[name] = heartbeat
+
+        try:
+            yield heartbeat
+        finally:
+            heartbeat.stop()
+            del held[name]
+            self.release(name, owner)
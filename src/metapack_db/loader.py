@@ -0,0 +1,451 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Pipelined loading of resource rows into a database table.
+
+A parser stage, running in its own thread, fetches and parses the source and
+groups rows into batches, which it passes to the writer stage through a bounded
+queue. The writer runs in the calling thread, so it can use the caller's
+database connection and transaction. When the queue is full, the parser blocks,
+which caps the memory used to the size of the queue.
+"""
+
+import csv
+import io
+import mmap
+import os
+import queue
+import threading
+import time
+from itertools import chain
+from operator import itemgetter
+
+_DONE = object()
+
+
+def mmap_blocks(path, block_size=16 * 1024 * 1024, encoding='utf-8', progress=None):
+    """Memory map a file and yield it as decoded blocks of text, split on line boundaries
+
+    :param progress: Optional LoadProgress, which is told the number of bytes in each block
+    """
+
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+
+        if size == 0:
+            return
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            pos = 0
+
+            while pos < size:
+                end = m.rfind(b'\n', pos, pos + block_size)
+
+                if end == -1 or pos + block_size >= size:
+                    # The block has no line ending, or the rest of the file fits in the block
+                    end = m.find(b'\n', pos + block_size) if pos + block_size < size else -1
+                    end = size - 1 if end == -1 else end
+
+                if progress is not None:
+                    progress.read(end + 1 - pos)
+
+                # The first block may have a byte order mark
+                yield m[pos:end + 1].decode('utf-8-sig' if pos == 0 and encoding == 'utf-8' else encoding)
+
+                pos = end + 1
+
+
+def mmap_csv_rows(path, columns, block_size=16 * 1024 * 1024, encoding='utf-8', progress=None):
+    """Yield tuples of values for the named columns from a local CSV file, reading it through
+    a memory map, in large blocks. The first row must be the header. Columns that aren't
+    in the header are None. Rows are never materialized as dicts.
+
+    :param progress: Optional LoadProgress, for the bytes read. See mmap_blocks()
+    """
+
+    lines = chain.from_iterable(io.StringIO(block, newline='')
+                                for block in mmap_blocks(path, block_size, encoding, progress))
+
+    reader = csv.reader(lines)
+
+    try:
+        header = next(reader)
+    except StopIteration:
+        return
+
+    positions = {h: i for i, h in enumerate(header)}
+
+    if all(c in positions for c in columns) and len(columns) > 1:
+        getter = itemgetter(*[positions[c] for c in columns])
+    else:
+        getter = None
+
+    idx = [positions.get(c) for c in columns]
+
+    def slow(row):
+        return tuple(row[i] if i is not None and i < len(row) else None for i in idx)
+
+    for row in reader:
+        if not row:
+            continue  # Blank line
+
+        if getter is not None:
+            try:
+                yield getter(row)
+                continue
+            except IndexError:
+                pass  # Short row
+
+        yield slow(row)
+
+
+class Stage(object):
+    """Tracks the time a pipeline stage spends working, versus waiting on the other stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.busy = 0.0
+        self.waiting = 0.0
+        self.rows = 0
+        self.batches = 0
+
+        self._start = None
+        self._end = None
+
+    def start(self):
+        self._start = time.perf_counter()
+
+    def end(self):
+        self._end = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0.0
+        return (self._end or time.perf_counter()) - self._start
+
+    @property
+    def utilization(self):
+        """Fraction of the elapsed time that the stage was working"""
+        return self.busy / self.elapsed if self.elapsed else 0.0
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'elapsed': self.elapsed,
+            'busy': self.busy,
+            'waiting': self.waiting,
+            'utilization': self.utilization
+        }
+
+
+class LoadProgress(object):
+    """The progress of loading a resource, which is passed to a progress callback after each batch
+    is written, and when the load is done. The callback runs in the thread that writes rows, so it
+    should return quickly.
+
+    The ETA is based on an estimate of the number of rows: total_rows, if it is known, or otherwise
+    the number of rows parsed so far, scaled by the size of the source over the bytes read so far,
+    if the source is a local file. Without either, fraction and eta are None.
+    """
+
+    def __init__(self, name, callback, total_bytes=None, total_rows=None):
+        """
+        :param name: Name of the resource
+        :param callback: Callable that takes the LoadProgress
+        :param total_bytes: Size of the source, if it is known
+        :param total_rows: Number of rows in the source, if it is known
+        """
+        self.name = name
+        self.callback = callback
+        self.total_bytes = total_bytes
+        self.total_rows = total_rows
+
+        self.rows = 0  # Rows written
+        self.rows_read = 0  # Rows parsed, which can be ahead of the rows written
+        self.bytes = 0  # Bytes of the source read, if the parser reports them
+        self.done = False
+
+        self._start = time.perf_counter()
+        self._end = None
+
+    def read(self, n):
+        """Count bytes read from the source. Called in the parser thread"""
+        self.bytes += n
+
+    def parsed(self, n):
+        """Count rows parsed. Called in the parser thread"""
+        self.rows_read += n
+
+    def wrote(self, n):
+        """Count rows written, and call the callback"""
+        self.rows += n
+        self.callback(self)
+
+    def finish(self):
+        self._end = time.perf_counter()
+        self.done = True
+        self.callback(self)
+
+    @property
+    def elapsed(self):
+        return (self._end or time.perf_counter()) - self._start
+
+    @property
+    def rows_per_sec(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def estimated_rows(self):
+        """The total number of rows, if it is known, or an estimate, or None"""
+        if self.done:
+            return self.rows
+
+        if self.total_rows:
+            return self.total_rows
+
+        if self.total_bytes and self.bytes and self.rows_read:
+            return max(int(round(self.rows_read * self.total_bytes / self.bytes)), self.rows_read)
+
+        return None
+
+    @property
+    def fraction(self):
+        """Fraction of the rows that have been written, or None if there is no estimate of the rows"""
+        if self.done:
+            return 1.0
+
+        total = self.estimated_rows
+
+        return min(self.rows / total, 1.0) if total else None
+
+    @property
+    def eta(self):
+        """Estimated seconds until the load is done, or None"""
+        if self.done:
+            return 0.0
+
+        total = self.estimated_rows
+
+        if not total or not self.rows:
+            return None
+
+        return max(total - self.rows, 0) / self.rows_per_sec
+
+    def __repr__(self):
+        return "<LoadProgress {} rows={} fraction={} eta={}>".format(self.name, self.rows, self.fraction, self.eta)
+
+
+class RowWriter(object):
+    """Inserts batches of row tuples into a table, through the DBAPI cursor of a
+    SqlAlchemy connection, to avoid constructing a dict for every row."""
+
+    # Positional parameter markers, for the paramstyles that have them
+    markers = {
+        'qmark': '?',
+        'format': '%s',
+        'pyformat': '%s',
+    }
+
+    def __init__(self, connection, table_name, columns):
+        """
+        :param connection: A SqlAlchemy Connection
+        :param table_name: Name of the table to insert into
+        :param columns: Column names, in the order of the values in each row
+        """
+        self.connection = connection
+        self.table_name = table_name
+        self.columns = list(columns)
+
+        dialect = connection.dialect
+        quote = dialect.identifier_preparer.quote
+
+        self._marker = self.markers.get(dialect.paramstyle)
+
+        if self._marker:
+            self.sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+                quote(table_name),
+                ', '.join(quote(c) for c in self.columns),
+                ', '.join([self._marker] * len(self.columns)))
+        else:
+            from sqlalchemy import MetaData, Table, Column
+            self._table = Table(table_name, MetaData(), *[Column(c) for c in self.columns])
+
+    def write(self, rows):
+        """Insert a list of row tuples"""
+
+        if not rows:
+            return
+
+        if self._marker:
+            cursor = self.connection.connection.cursor()
+            try:
+                cursor.executemany(self.sql, rows)
+            finally:
+                cursor.close()
+        else:
+            self.connection.execute(self._table.insert(), [dict(zip(self.columns, row)) for row in rows])
+
+
+class PipelinedLoader(object):
+    """Run a parser stage and a writer stage, connected by a bounded queue of row batches"""
+
+    def __init__(self, source, writer, batch_size=5000, queue_size=4, transform=None, rejects=None,
+                 progress=None):
+        """
+        :param source: A callable that returns an iterator of row tuples. It is called in the
+        parser thread, so fetching the source overlaps with setting up the writer.
+        :param writer: Object with a write(rows) method, such as a RowWriter
+        :param batch_size: Number of rows in each batch
+        :param queue_size: Maximum number of batches waiting for the writer
+        :param transform: Optional callable, run in the parser stage, that takes a batch and
+        returns the rows to write and a list of rejected rows, such as Coercer.coerce
+        :param rejects: Object with a write(rejects) method, for the rejects from the transform
+        :param progress: Optional LoadProgress, which is updated as batches are parsed and written
+        """
+        self.source = source
+        self.writer = writer
+        self.batch_size = batch_size
+        self.transform = transform
+        self.rejects = rejects
+        self.progress = progress
+
+        self.rejected = 0
+
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.parser = Stage('parser')
+        self.writer_stage = Stage('writer')
+
+        self._error = None
+        self._stop = threading.Event()
+
+    def _put(self, item):
+        """Put an item on the queue, giving up if the writer has stopped"""
+        t = time.perf_counter()
+
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+        self.parser.waiting += time.perf_counter() - t
+
+    def _batch(self, rows):
+        """Return the (rows, rejects) queue item for a batch of parsed rows"""
+
+        self.parser.rows += len(rows)
+        self.parser.batches += 1
+
+        if self.progress is not None:
+            self.progress.parsed(len(rows))
+
+        if self.transform is not None:
+            return self.transform(rows)
+        else:
+            return rows, []
+
+    def _parse(self):
+
+        self.parser.start()
+
+        try:
+            t = time.perf_counter()
+
+            batch = []
+
+            for row in self.source():
+                batch.append(row)
+
+                if len(batch) >= self.batch_size:
+                    item = self._batch(batch)
+                    self.parser.busy += time.perf_counter() - t
+
+                    self._put(item)
+
+                    if self._stop.is_set():
+                        return
+
+                    batch = []
+                    t = time.perf_counter()
+
+            if batch:
+                item = self._batch(batch)
+                self.parser.busy += time.perf_counter() - t
+                self._put(item)
+            else:
+                self.parser.busy += time.perf_counter() - t
+
+        except Exception as e:
+            self._error = e
+        finally:
+            self.parser.end()
+            self._put(_DONE)
+
+    def run(self):
+        """Run the pipeline, returning the number of rows written. Errors in either stage
+        stop both stages and are raised in the calling thread"""
+
+        thread = threading.Thread(target=self._parse, name='metapack_db-parser', daemon=True)
+
+        self.writer_stage.start()
+
+        thread.start()
+
+        try:
+            while True:
+                t = time.perf_counter()
+                item = self.queue.get()
+                self.writer_stage.waiting += time.perf_counter() - t
+
+                if item is _DONE:
+                    break
+
+                rows, rejects = item
+
+                t = time.perf_counter()
+                self.writer.write(rows)
+
+                if rejects:
+                    if self.rejects is not None:
+                        self.rejects.write(rejects)
+                    self.rejected += len(rejects)
+
+                self.writer_stage.busy += time.perf_counter() - t
+
+                self.writer_stage.rows += len(rows)
+                self.writer_stage.batches += 1
+
+                if self.progress is not None:
+                    self.progress.wrote(len(rows))
+
+        except:
+            self._stop.set()
+            raise
+        finally:
+            self.writer_stage.end()
+            thread.join()
+
+        if self._error is not None:
+            raise self._error
+
+        if self.progress is not None:
+            self.progress.finish()
+
+        return self.writer_stage.rows
+
+    def stats(self):
+        """Return a dict of statistics for each stage"""
+        return {
+            'parser': self.parser.stats(),
+            'writer': self.writer_stage.stats(),
+            'rejected': self.rejected
+        }
@@ -0,0 +1,174 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Catalog schema versions and migrations.
+
+The catalog records its schema version in the mt_schema table. Opening a catalog
+that is up to date only costs a version check. A new catalog is created with create_all() at
+the current version; an older catalog has the migrations after its version applied,
+in order, in one transaction.
+
+To change the schema, change the ORM classes, then append a migration that makes the
+same change to an existing catalog. A catalog created before versioning is version 0,
+and may already have some of the changes, so migrations check before altering.
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, Index, Integer, String, inspect
+
+from .orm import Base
+
+
+class SchemaVersion(Base):
+    """The schema version of the catalog, in a single row"""
+
+    __tablename__ = 'mt_schema'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False)
+    upgraded = Column(DateTime)
+
+
+def add_column(connection, table_name, column):
+    """Add a column to a table, if the table doesn't have it"""
+
+    if column.name in [c['name'] for c in inspect(connection).get_columns(table_name)]:
+        return
+
+    preparer = connection.dialect.identifier_preparer
+
+    connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+        preparer.quote(table_name), preparer.quote(column.name), column.type.compile(dialect=connection.dialect)))
+
+
+def add_index(connection, table_name, name, *columns):
+    """Create an index, if the table doesn't have one with the same name"""
+
+    if name in [i['name'] for i in inspect(connection).get_indexes(table_name)]:
+        return
+
+    table = Base.metadata.tables[table_name]
+
+    # Use the index the ORM declares, if there is one. A new Index would be added to the table,
+    # and create_all() would then create the index twice
+    index = next((i for i in table.indexes if i.name == name), None)
+
+    if index is None:
+        index = Index(name, *[table.c[c] for c in columns])
+
+    index.create(connection)
+
+
+def create_table(connection, table_name):
+    Base.metadata.tables[table_name].create(connection, checkfirst=True)
+
+
+def shard_files(connection):
+    add_column(connection, 'mt_resources', Column('shard_path', String))
+
+
+def column_stats(connection):
+    create_table(connection, 'mt_column_stats')
+
+
+def shared_tables(connection):
+    add_column(connection, 'mt_resources', Column('fingerprint', String))
+    add_column(connection, 'mt_resources', Column('storage_table', String))
+    add_index(connection, 'mt_resources', 'ix_mt_resources_fingerprint', 'fingerprint')
+
+
+def document_versions(connection):
+    add_column(connection, 'mt_documents', Column('version', Integer))
+    add_column(connection, 'mt_documents', Column('ingested', DateTime))
+    add_index(connection, 'mt_documents', 'ix_mt_documents_name_nv', 'name_nv')
+
+
+def load_generations(connection):
+    add_column(connection, 'mt_resources', Column('generation', Integer))
+
+
+def leases(connection):
+    create_table(connection, 'mt_leases')
+
+
+def jobs(connection):
+    create_table(connection, 'mt_jobs')
+
+
+def resource_storage(connection):
+    add_column(connection, 'mt_resources', Column('storage', String))
+    add_column(connection, 'mt_resources', Column('storage_path', String))
+
+
+# Each migration upgrades the catalog from the version of its position in the list to the next
+MIGRATIONS = [
+    shard_files,
+    column_stats,
+    shared_tables,
+    document_versions,
+    load_generations,
+    leases,
+    jobs,
+    resource_storage,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+# Key of the PostgreSQL advisory lock that migrations are run under
+MIGRATION_LOCK = 0x6d745f736368656d  # 'mt_schem'
+
+
+def schema_version(connection):
+    """Return the schema version of a catalog, 0 for a catalog from before versioning, or None
+    if there is no catalog"""
+
+    has_table = connection.dialect.has_table
+
+    if has_table(connection, 'mt_schema'):
+        return connection.execute('SELECT max(version) FROM mt_schema').scalar() or 0
+
+    return 0 if has_table(connection, 'mt_documents') else None
+
+
+def migrate(engine):
+    """Create or upgrade the catalog tables. Returns the list of migrations that were applied"""
+
+    with engine.connect() as connection:
+        version = schema_version(connection)
+
+    if version == SCHEMA_VERSION:
+        return []
+
+    if version is not None and version > SCHEMA_VERSION:
+        raise RuntimeError("Catalog schema version {} is newer than this version of metapack_db, {}"
+                           .format(version, SCHEMA_VERSION))
+
+    # Take the write lock when the transaction begins, on Sqlite, so processes that open an
+    # old catalog at the same time migrate it one at a time
+    with engine.execution_options(sqlite_immediate=True).begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            connection.execute('SELECT pg_advisory_xact_lock({})'.format(MIGRATION_LOCK))
+
+        # Check again, holding the lock, in case another process migrated the catalog
+        version = schema_version(connection)
+
+        if version == SCHEMA_VERSION:
+            return []
+
+        if version is None:
+            applied = []
+        else:
+            applied = MIGRATIONS[version:]
+
+            for m in applied:
+                m(connection)
+
+        # Creates the tables of a new catalog, and any tables that migrations don't create
+        Base.metadata.create_all(connection)
+
+        connection.execute(SchemaVersion.__table__.delete())
+        connection.execute(SchemaVersion.__table__.insert(), version=SCHEMA_VERSION, upgraded=datetime.utcnow())
+
+    return applied
@@ -0,0 +1,269 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A cache of query results, for queries over resource tables.
+
+Results are keyed on the normalized SQL, the parameters, and the load generation of each
+resource table in the query. Loading a resource increments its generation, so results
+from before the load are never used again, and age out of the cache. The cache has
+two tiers: a memory tier, limited to a number of rows, and an optional disk tier,
+limited to a number of bytes, which can be shared by processes. Both evict the least
+recently used results.
+
+The disk tier stores results as JSON, with values of types that JSON doesn't have, such as
+dates and decimals, tagged with their type, so reading a file in the cache directory can't
+run code.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from os.path import exists, join
+
+# Quoted strings and identifiers, which normalization doesn't change
+_QUOTED = re.compile(r"""('(?:[^']|'')*'|"(?:[^"]|"")*")""")
+
+
+def normalize_sql(sql):
+    """Normalize a SQL statement for use in a cache key. Outside of quotes, runs of whitespace
+    are collapsed to one space and text is lower cased. Trailing semicolons are removed."""
+
+    parts = []
+
+    for i, part in enumerate(_QUOTED.split(sql)):
+        if i % 2:
+            parts.append(part)
+        else:
+            parts.append(re.sub(r'\s+', ' ', part).lower())
+
+    return ''.join(parts).strip().rstrip(';').strip()
+
+
+# (type, tag, encode, decode) for values that JSON doesn't have. datetime is before date,
+# since it is a subclass of date
+_TAGGED = [
+    (datetime, 'datetime', datetime.isoformat, datetime.fromisoformat),
+    (date, 'date', date.isoformat, date.fromisoformat),
+    (time, 'time', time.isoformat, time.fromisoformat),
+    (timedelta, 'timedelta', lambda v: [v.days, v.seconds, v.microseconds], lambda v: timedelta(*v)),
+    (Decimal, 'decimal', str, Decimal),
+    ((bytes, bytearray, memoryview), 'bytes', lambda v: base64.b64encode(bytes(v)).decode('ascii'), base64.b64decode),
+    (uuid.UUID, 'uuid', str, uuid.UUID),
+    ((list, dict), 'json', lambda v: v, lambda v: v),  # Values of JSON and array columns
+]
+
+_DECODERS = {tag: decode for _, tag, _, decode in _TAGGED}
+
+
+def encode_value(v):
+    """Encode a result value for JSON. Values of types that JSON doesn't have are
+    encoded as a dict of the type tag and the value. Raises TypeError for other types"""
+
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return v
+
+    for types, tag, encode, _ in _TAGGED:
+        if isinstance(v, types):
+            return {'t': tag, 'v': encode(v)}
+
+    raise TypeError("Can't cache a value of type {}".format(type(v).__name__))
+
+
+def decode_value(v):
+    """Decode a value from encode_value()"""
+    return _DECODERS[v['t']](v['v']) if isinstance(v, dict) else v
+
+
+class QueryCache(object):
+    """Memory and disk cache of query results"""
+
+    def __init__(self, root=None, max_rows=100000, max_size=1024 ** 3):
+        """
+        :param root: Directory for the disk tier. If None, there is only the memory tier
+        :param max_rows: Maximum number of rows of results held in memory
+        :param max_size: Maximum size of the disk tier, in bytes
+        """
+        self.root = root
+        self.max_rows = max_rows
+        self.max_size = max_size
+
+        self._memory = OrderedDict()  # key -> rows, least recently used first
+        self._rows = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.root is not None:
+            for d in ('results', 'tmp'):
+                os.makedirs(join(self.root, d), exist_ok=True)
+
+    @staticmethod
+    def key(sql, params, generations, database=''):
+        """Return the cache key for a query
+
+        :param sql: SQL statement
+        :param params: Query parameters
+        :param generations: Iterable of values that change when a table in the query is loaded
+        :param database: Identifies the database, for a disk tier shared by several databases
+        """
+        return hashlib.sha256(json.dumps([str(database), normalize_sql(sql), list(params),
+                                          sorted(generations)], default=str)
+                              .encode('utf8')).hexdigest()
+
+    def _path(self, key):
+        return join(self.root, 'results', key[:2], key)
+
+    def get(self, key):
+        """Return the cached rows for a key, or None"""
+
+        with self._lock:
+            rows = self._memory.get(key)
+
+            if rows is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                return rows
+
+        if self.root is not None:
+            path = self._path(key)
+
+            try:
+                with open(path, encoding='utf8') as f:
+                    rows = [tuple(decode_value(v) for v in row) for row in json.load(f)]
+                os.utime(path)  # Mark as recently used
+            except (IOError, ValueError, TypeError, KeyError):
+                rows = None
+
+            if rows is not None:
+                self._remember(key, rows)
+                with self._lock:
+                    self.hits += 1
+                    self.disk_hits += 1
+                return rows
+
+        with self._lock:
+            self.misses += 1
+
+        return None
+
+    def _remember(self, key, rows):
+        """Add rows to the memory tier, evicting the least recently used results"""
+
+        if len(rows) > self.max_rows:
+            return
+
+        with self._lock:
+            if key in self._memory:
+                self._rows -= len(self._memory.pop(key))
+
+            self._memory[key] = rows
+            self._rows += len(rows)
+
+            while self._rows > self.max_rows:
+                _, evicted = self._memory.popitem(last=False)
+                self._rows -= len(evicted)
+                self.evictions += 1
+
+    def put(self, key, rows):
+        """Cache a list of row tuples"""
+
+        rows = [tuple(r) for r in rows]
+
+        self._remember(key, rows)
+
+        if self.root is not None:
+            try:
+                data = json.dumps([[encode_value(v) for v in row] for row in rows])
+            except TypeError:
+                return rows  # Values that can't be stored on disk are only cached in memory
+
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            fd, tmp = tempfile.mkstemp(dir=join(self.root, 'tmp'))
+
+            try:
+                with os.fdopen(fd, 'w', encoding='utf8') as f:
+                    f.write(data)
+                os.replace(tmp, path)
+            except:
+                if exists(tmp):
+                    os.remove(tmp)
+                raise
+
+            self.evict(keep=path)
+
+        return rows
+
+    def _files(self):
+        results_dir = join(self.root, 'results')
+        for d in os.listdir(results_dir):
+            for e in os.scandir(join(results_dir, d)):
+                try:
+                    st = e.stat()
+                except FileNotFoundError:
+                    continue
+                yield e.path, st.st_size, st.st_mtime
+
+    def evict(self, keep=None):
+        """Remove least recently used results from the disk tier until it is under its size limit"""
+
+        if self.root is None or self.max_size is None:
+            return
+
+        files = sorted(self._files(), key=lambda e: e[2])
+
+        total = sum(e[1] for e in files)
+
+        for path, size, _ in files:
+            if total <= self.max_size:
+                break
+
+            if path == keep:
+                continue
+
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass  # Another process got it first
+
+            total -= size
+
+    def clear(self):
+        """Remove everything from the cache"""
+        with self._lock:
+            self._memory.clear()
+            self._rows = 0
+
+        if self.root is not None:
+            shutil.rmtree(join(self.root, 'results'), ignore_errors=True)
+            os.makedirs(join(self.root, 'results'), exist_ok=True)
+
+    def stats(self):
+        """Return a dict of hit, miss and size statistics"""
+        files = list(self._files()) if self.root is not None else []
+
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'memory_results': len(self._memory),
+            'memory_rows': self._rows,
+            'files': len(files),
+            'size': sum(e[1] for e in files)
+        }
@@ -9,7 +9,9 @@ from sqlalchemy import (
     Boolean,
     Column,
     ForeignKey,
+    Index,
     Integer,
+    MetaData,
     String,
     Table,
     inspect
@@ -17,10 +19,97 @@ from sqlalchemy import (
 from sqlalchemy.exc import InvalidRequestError
 from sqlalchemy.orm import mapper, relationship
 
+from .coerce import type_map
 from .orm import Base, JSONEncodedObj, MutationList
 from .util import base_encode, tablenamify
 
 
+def is_set(v):
+    """True if a schema property value turns a column option on"""
+    return v is not None and str(v).strip().lower() not in ('', '0', 'f', 'false', 'n', 'no', 'none')
+
+
+def parse_index_spec(spec):
+    """Parse an index spec, a list of indexes separated by ';', each a list of column names
+    separated by ','. An index prefixed with 'unique:' is unique. Returns a list of
+    (columns, unique) tuples
+
+    >>> parse_index_spec('state, county; unique: geoid')
+    [(('state', 'county'), False), (('geoid',), True)]
+    """
+
+    indexes = []
+
+    for part in str(spec or '').split(';'):
+        part = part.strip()
+
+        unique = part.lower().startswith('unique:')
+
+        if unique:
+            part = part[len('unique:'):]
+
+        columns = tuple(c.strip() for c in part.split(',') if c.strip())
+
+        if columns:
+            indexes.append((columns, unique))
+
+    return indexes
+
+
+def schema_indexes(table_name, schema, spec=None):
+    """Return the indexes for a resource table, as (name, columns, unique) tuples, from the
+    properties of the schema columns and an optional index spec, in the form parsed by
+    parse_index_spec().
+
+    Columns with a 'primarykey' property make up the primary key, which is a unique index,
+    since the table already has the _id primary key. Columns with a 'unique' property get a
+    unique index, and columns with an 'index' or 'foreignkey' property get an index.
+
+    :param table_name: Name of the table
+    :param schema: List of column dicts
+    :param spec: Index spec
+    """
+
+    headers = [c['header'] for c in schema]
+
+    pk = tuple(c['header'] for c in schema if is_set(c.get('primarykey')))
+
+    indexes = [(pk, True)] if pk else []
+
+    for c in schema:
+        if is_set(c.get('unique')):
+            indexes.append(((c['header'],), True))
+        elif is_set(c.get('index')) or is_set(c.get('foreignkey')):
+            indexes.append(((c['header'],), False))
+
+    for columns, unique in parse_index_spec(spec):
+        for c in columns:
+            if c not in headers:
+                raise ValueError("Index on column '{}', which is not in the schema for table '{}'"
+                                 .format(c, table_name))
+
+        indexes.append((columns, unique))
+
+    seen = set()
+    named = []
+
+    for columns, unique in indexes:
+        if columns in seen:
+            continue
+
+        seen.add(columns)
+
+        if pk and columns == pk:
+            name = 'pk_{}'.format(table_name)
+        else:
+            name = '{}_{}_{}'.format('uq' if unique else 'ix', table_name,
+                                     '_'.join(tablenamify(c) for c in columns))
+
+        named.append((name, columns, unique))
+
+    return named
+
+
 class Resource(Base):
 
     __tablename__ = 'mt_resources'
@@ -43,11 +132,43 @@ class Resource(Base):
     table_created = Column(Boolean, default=False)
     loaded = Column(Boolean, default=False)
 
+    shard_path = Column(String) # For Sqlite, the file that holds the table, if not the catalog database
+
+    # Digest of the source data and the schema, for finding resources that load identical data
+    fingerprint = Column(String, index=True)
+
+    # Table that holds the rows. If it isn't table_name, the rows are shared with other
+    # resources, and table_name is a view of this table
+    storage_table = Column(String)
+
+    # Name of the storage backend that holds the rows. See metapack_db.storage. None is 'sql'
+    storage = Column(String)
+
+    # For file backends, the file that holds the rows
+    storage_path = Column(String)
+
+    # Incremented each time the table is loaded, so cached query results from before the load aren't used
+    generation = Column(Integer, default=0)
+
+    # Column statistics, collected when the resource is loaded
+    stats = relationship("ColumnStats", cascade="all, delete-orphan", backref="resource",
+                         order_by="ColumnStats.position")
+
     @property
     def url(self):
         return self.resource_term.value
 
 
+    @property
+    def rejects_table_name(self):
+        """Name of the table that holds rows that could not be converted to the schema types"""
+        return (self.storage_table or self.table_name) + '_rejects'
+
+    @property
+    def shared(self):
+        """True if the rows are stored in another resource's table"""
+        return bool(self.storage_table) and self.storage_table != self.table_name
+
     @staticmethod
     def make_table_name(document, r):
         """Create a table name from the document id and a resource name"""
@@ -56,62 +177,376 @@ class Resource(Base):
     @property
     def table(self):
         """Return a SqlAlchemy table for this resource"""
+        return self.make_sa_table()
 
-        type_map = {
-            'text': Integer,
-            'number': Integer,
-            'integer': Integer
-        }
+    def make_sa_table(self, prefixes=None):
+        """Return a SqlAlchemy table for this resource, with optional prefixes for the CREATE statement,
+        such as UNLOGGED"""
 
         sacolumns = []
 
         for c in self.schema:
 
-            sa_type = type_map.get(c['datatype'], String)
+            sa_type = type_map.get(c.get('datatype'), String)
 
             sacol = Column(c['header'], sa_type)
             sacolumns.append(sacol)
 
-        table = Table(self.table_name, Base.metadata, Column('_id', Integer, primary_key=True), *sacolumns)
+        # Not in Base.metadata, which is shared by every database in the process
+        table = Table(self.table_name, MetaData(), Column('_id', Integer, primary_key=True), *sacolumns,
+                      prefixes=prefixes)
 
         return table
 
+    @property
+    def backend(self):
+        """The storage backend for this resource's rows"""
+        from .storage import get_storage
+        return get_storage(self.storage)
+
+    @property
+    def storage_spec(self):
+        """The storage backend named by the 'storage' property of the resource term"""
+        props = (self.resource_term.properties if self.resource_term else None) or {}
+
+        return props.get('storage')
+
+    @property
+    def index_spec(self):
+        """The index spec from the 'indexes' property of the resource term. See parse_index_spec()"""
+        props = (self.resource_term.properties if self.resource_term else None) or {}
+
+        return props.get('indexes')
+
+    def indexes(self, table=None, spec=None):
+        """Return SqlAlchemy Indexes for the primary key, unique columns and indexed columns of the
+        schema, and for the index spec. See schema_indexes(). They are created by finish_load(),
+        after the rows are loaded
+
+        :param spec: Index spec, used instead of the index_spec property
+        """
+
+        if table is None:
+            table = self.table
+
+        if spec is None:
+            spec = self.index_spec
+
+        return [Index(name, *[table.c[c] for c in columns], unique=unique)
+                for name, columns, unique in schema_indexes(self.table_name, self.schema, spec)]
+
+
+    def make_table(self, unlogged=False):
+        """Create the storage for this resource, in the backend named by the resource term's
+        'storage' property, or the manager's default backend. For the 'sql' backend, this creates
+        the table, including the DDL for the schema. Indexes are created after loading,
+        by finish_load()
 
-    def make_table(self):
-        """Create the table for this resource, including the DDL for the schema"""
+        :param unlogged: If True, and the database is PostgreSQL, create the table UNLOGGED, which
+        is faster to load. finish_load() makes it logged.
+        """
         session = inspect(self).session
         manager = session.info['manager']
 
         if not self.table_created:
-            self.table.create(manager.database.engine)
 
+            self.indexes()  # Check the index spec before anything is loaded
+
+            if self.storage is None:
+                self.storage = self.storage_spec or manager.storage
+
+            self.backend.create(self, session, unlogged=unlogged)
+
+            self.storage_table = self.table_name
             self.table_created = True
 
+    def share_table(self, other):
+        """Use the table of another loaded resource, with the same source data and schema, rather
+        than loading the rows again. A view, named for this resource's table, is created in the
+        same database as the other resource's table"""
+
+        session = inspect(self).session
+        database = session.info['manager'].database
+        quote = session.bind.dialect.identifier_preparer.quote
+
+        if self.table_created and not self.shared:
+            # An empty table, created when a lazy manager added the document
+            if self.backend.columnar:
+                pass  # The file isn't written until the resource is loaded
+            elif self.shard_path:
+                from os import remove
+                from os.path import exists
+
+                if exists(self.shard_path):
+                    remove(self.shard_path)
+            else:
+                session.execute('DROP TABLE IF EXISTS {}'.format(quote(self.table_name)))
+
+        sql = 'CREATE VIEW {} AS SELECT * FROM {}'.format(quote(self.table_name), quote(other.storage_table))
+
+        if other.backend.columnar:
+            pass  # The other resource's file is queried under this resource's table name
+        elif other.shard_path:
+            with database.shard_engine(other.shard_path).begin() as connection:
+                connection.execute(sql)
+        else:
+            session.connection().execute(sql)
+
+        self.storage_table = other.storage_table
+        self.shard_path = other.shard_path
+        self.storage = other.storage
+        self.storage_path = other.storage_path
+        self.stats = [c.copy() for c in other.stats]
+        self.table_created = True
+        self.mark_loaded()
+
+    def mark_loaded(self):
+        """Mark the table loaded, and increment its load generation"""
+        self.loaded = True
+        self.generation = (self.generation or 0) + 1
+
     @property
     def mapper(self):
         """Return the Sqlalchemy Mapper class for this resource"""
         session = inspect(self).session
-        manager = session.info['manager']
 
-        table = Table(self.table_name, Base.metadata, autoload=True, autoload_with=manager.database.engine)
+        table = Table(self.storage_table or self.table_name, MetaData(), autoload=True,
+                      autoload_with=session.connection())
 
         class BareMapper(object):
             """A Class for constructing mappers"""
 
         return mapper(BareMapper, table)
 
-    def load_resource(self):
-        """Load rows into a previously created resource table"""
+    def resolve_source(self, cache=None):
+        """Return the URL to load the resource from, which is a local copy in the cache,
+        if there is a cache and the source can be cached."""
+
+        if cache is not None and cache.cacheable(self.source_url):
+            return cache.localize(self.source_url)
+
+        return self.source_url
+
+    def source_fingerprint(self, cache=None):
+        """Return a digest of the source data and the schema, which is the same for resources
+        that would load identical tables. With a cache, the source is identified by the digest
+        of its contents, and without one, local files are identified by their size and
+        modification time. Returns None if the source can't be identified.
+        """
+        import hashlib
+        import json
+        from os import stat
+        from urllib.parse import unquote, urlparse
+
+        base, _, fragment = str(self.source_url).partition('#')
+
+        if cache is not None and cache.cacheable(base):
+            source = cache.digest(base)
+        elif urlparse(base).scheme == 'file':
+            try:
+                st = stat(unquote(urlparse(base).path))
+            except OSError:
+                return None
+
+            source = '{}:{}:{}'.format(base, st.st_size, st.st_mtime_ns)
+        else:
+            return None
+
+        return hashlib.sha256(json.dumps([source, fragment, self.schema], sort_keys=True, default=str)
+                              .encode('utf8')).hexdigest()
+
+    @property
+    def fast_csv(self):
+        """True if a local CSV source for this resource can be read directly with mmap_csv_rows(),
+        rather than through rowgenerators. Resources that set an encoding other than UTF-8, or
+        that have header rows to skip, use rowgenerators"""
+
+        props = (self.resource_term.properties if self.resource_term else None) or {}
+
+        encoding = str(props.get('encoding') or 'utf-8').lower().replace('_', '-')
+
+        return (encoding in ('utf-8', 'utf8', 'ascii') and
+                not any(props.get(k) for k in ('startline', 'headerlines', 'start', 'headers')))
+
+    def previous_rows(self):
+        """Return the number of rows from the last load of this resource, or, if it hasn't been
+        loaded, of the resource with the same name in the latest loaded version of the package,
+        for estimating the progress of a load. Returns None if there is neither"""
+        from .document import Document
+        from .stats import ColumnStats
+
+        if self.stats:
+            return self.stats[0].rows
+
+        session = inspect(self).session
+
+        name_nv = session.query(Document.name_nv).filter(Document.id == self.document_id).scalar()
+
+        return session.query(ColumnStats.rows)\
+            .join(Resource, ColumnStats.resource_id == Resource.id)\
+            .join(Document, Resource.document_id == Document.id)\
+            .filter(Document.name_nv == name_nv)\
+            .filter(Resource.name == self.name)\
+            .filter(Resource.id != self.id)\
+            .filter(Resource.loaded.is_(True))\
+            .order_by(Document.id.desc(), ColumnStats.position)\
+            .limit(1).scalar()
+
+    def finish_load(self, connection, bulk=False, index_spec=None):
+        """Build the indexes of a loaded table. For a bulk load, also make the table logged,
+        if it is an UNLOGGED PostgreSQL table, and update the query planner's statistics
+
+        :param index_spec: Index spec, which must be passed in for a detached resource
+        """
+
+        quote = connection.dialect.identifier_preparer.quote
+        dialect_name = connection.dialect.name
+
+        if bulk and dialect_name == 'postgresql':
+            connection.execute('ALTER TABLE {} SET LOGGED'.format(quote(self.table_name)))
+
+        for index in self.indexes(spec=index_spec):
+            index.create(connection)
+
+        if bulk:
+            analyze = 'ANALYZE TABLE {}' if dialect_name == 'mysql' else 'ANALYZE {}'
+            connection.execute(analyze.format(quote(self.table_name)))
+
+    def load_rows(self, connection, cache=None, batch_size=5000, queue_size=4, fast_csv=None, bulk=False,
+                  index_spec=None, progress=None, total_rows=None):
+        """Load the source rows into the resource's storage backend, through a connection
+        from the backend's connect(), then finish the load. For the 'sql' backend, the load is
+        finished with finish_load(). Doesn't require a session, so it can be run on a
+        detached resource. Local CSV sources are read through a memory map, without
+        rowgenerators. See load_resource()
+
+        :param fast_csv: Value of the fast_csv property, which must be passed in
+        for a detached resource.
+        :param bulk: Passed to finish_load()
+        :param index_spec: Passed to finish_load()
+        :param progress: Optional callable, which is called with a LoadProgress after each
+        batch is written, and when the rows are loaded
+        :param total_rows: Expected number of rows, for the progress ETA, such as from
+        previous_rows()
+        """
 
         from rowgenerators import parse_app_url, get_generator
+        from .coerce import Coercer
+        from .loader import LoadProgress, PipelinedLoader, mmap_csv_rows
+        from .stats import StatsCollector
+        from os.path import exists, getsize
+
+        columns = [c['header'] for c in self.schema]
+
+        backend = self.backend
 
-        if not self.loaded:
+        # Duplicates of the primary key, or another unique index, are rejected as they are loaded,
+        # since they would fail the index, which is built at the end of the load
+        spec = self.index_spec if index_spec is None else index_spec
+        unique = [names for _, names, is_unique in schema_indexes(self.table_name, self.schema, spec) if is_unique]
+
+        # File backends have no connection, and take the converted Python values
+        coercer = Coercer(self.schema, connection.dialect if connection is not None else None, unique)
+        collector = StatsCollector(columns)
+
+        def transform(rows):
+            rows, rejects = coercer.coerce(rows)
+            collector.update(rows)
+            return rows, rejects
+
+        if fast_csv is None:
+            fast_csv = self.fast_csv
+
+        load_progress = LoadProgress(self.name, progress, total_rows=total_rows) if progress is not None else None
+
+        def source():
+            url = parse_app_url(self.resolve_source(cache))
+            target = url.get_resource().get_target()
+
+            path = getattr(target, 'fspath', None)
+
+            if fast_csv and target.proto == 'file' and target.target_format == 'csv' and path and exists(str(path)):
+                if load_progress is None:
+                    yield from mmap_csv_rows(str(path), columns)
+                else:
+                    # Smaller blocks, so the bytes read, and the estimate of the rows, are updated often
+                    load_progress.total_bytes = getsize(str(path))
+                    yield from mmap_csv_rows(str(path), columns, block_size=1024 * 1024, progress=load_progress)
+                return
+
+            g = get_generator(target)
+
+            if load_progress is None or target.target_format != 'csv' or not (path and exists(str(path))):
+                for d in g.iter_dict:
+                    yield tuple(d.get(c) for c in columns)
+                return
+
+            # The parser doesn't report the bytes it reads, so count the length of each row. Remote
+            # sources are downloaded before they are parsed, so the size is their Content-Length
+            load_progress.total_bytes = getsize(str(path))
+
+            for d in g.iter_dict:
+                load_progress.read(sum(len(str(v)) for v in d.values() if v is not None) + len(d))
+                yield tuple(d.get(c) for c in columns)
+
+        writers = backend.writers(self, connection)
+
+        loader = PipelinedLoader(source, writers[0],
+                                 batch_size=batch_size, queue_size=queue_size,
+                                 transform=transform,
+                                 rejects=writers[1],
+                                 progress=load_progress)
+
+        try:
+            loader.run()
+        except:
+            backend.abort(self, writers)
+            raise
+
+        backend.finish(self, connection, writers, bulk, index_spec)
+
+        stats = loader.stats()
+        stats['columns'] = collector.stats()
+
+        return stats
+
+    def set_column_stats(self, columns):
+        """Replace the column statistics with a list of dicts, from the 'columns' value
+        of the statistics returned by load_rows()"""
+        from .stats import ColumnStats
+
+        self.stats = [ColumnStats(**c) for c in columns]
+
+    def load_resource(self, **kwargs):
+        """Load rows into a previously created resource table.
+
+        Fetching and parsing the source runs in a separate thread from inserting rows, so
+        the two overlap. Values are converted to the datatypes of the schema, and rows
+        that can't be converted are written to the rejects table, rejects_table_name.
+        Statistics for each column are collected on the same pass, and stored in stats.
+        Returns a dict of statistics for the parser and writer stages, or None if the
+        resource was already loaded.
+
+        :param batch_size: Number of rows per insert
+        :param queue_size: Number of batches that can be waiting to be inserted. With
+        batch_size, this limits how far parsing can get ahead of inserting.
+        :param bulk: If True, finish with the steps for a bulk load. See finish_load()
+        :param progress: Progress callback. See load_rows()
+        """
+
+        if self.loaded:
+            return None
+
+        session = inspect(self).session
+        manager = session.info['manager']
 
-            url = parse_app_url(self.source_url)
-            g = get_generator(url.get_resource().get_target())
+        if kwargs.get('progress') is not None:
+            kwargs.setdefault('total_rows', self.previous_rows())
 
-            session = inspect(self).session
+        with self.backend.connect(self, manager.database, session) as connection:
+            stats = self.load_rows(connection, manager.cache, **kwargs)
 
-            session.bulk_insert_mappings(self.mapper, g.iter_dict)
+        self.set_column_stats(stats['columns'])
+        self.mark_loaded()
 
-            self.loaded = True
+        return stats
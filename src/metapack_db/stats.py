@@ -0,0 +1,161 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Column statistics, collected on the batches of rows as they are loaded, so building
+a profile of a resource doesn't require scanning its table again.
+"""
+
+import math
+from collections import Counter
+from hashlib import blake2b
+
+from sqlalchemy import Column, ForeignKey, Integer, String
+
+from .orm import Base, JSONEncodedObj, MutationList
+
+
+class ColumnStats(Base):
+    """Statistics for one column of a loaded resource table"""
+
+    __tablename__ = 'mt_column_stats'
+
+    id = Column(Integer, primary_key=True)
+    resource_id = Column(Integer, ForeignKey("mt_resources.id"), nullable=False, index=True)
+    # Resource defines a backref to 'resource'
+
+    position = Column(Integer)
+    column_name = Column(String)
+
+    rows = Column(Integer)
+    nulls = Column(Integer)
+    min_value = Column(String)
+    max_value = Column(String)
+    distinct_count = Column(Integer)  # Exact if there is a histogram, otherwise estimated
+
+    # List of [value, count] pairs, for columns with few distinct values
+    histogram = Column(MutationList.as_mutable(JSONEncodedObj))
+
+    def copy(self):
+        """Return a copy of these statistics, for another resource"""
+        return ColumnStats(position=self.position, column_name=self.column_name, rows=self.rows,
+                           nulls=self.nulls, min_value=self.min_value, max_value=self.max_value,
+                           distinct_count=self.distinct_count,
+                           histogram=list(self.histogram) if self.histogram is not None else None)
+
+    def __repr__(self):
+        return "<ColumnStats {} rows={} nulls={} distinct={}>".format(
+            self.column_name, self.rows, self.nulls, self.distinct_count)
+
+
+class HyperLogLog(object):
+    """HyperLogLog sketch, for estimating the number of distinct values in a column"""
+
+    def __init__(self, p=12):
+        self.p = p
+        self.m = 1 << p
+        self.registers = bytearray(self.m)
+        self.alpha = 0.7213 / (1 + 1.079 / self.m)
+
+    def add(self, value):
+        x = int.from_bytes(blake2b(str(value).encode('utf8'), digest_size=8).digest(), 'big')
+
+        j = x >> (64 - self.p)
+        w = x & ((1 << (64 - self.p)) - 1)
+        rank = (64 - self.p) - w.bit_length() + 1
+
+        if rank > self.registers[j]:
+            self.registers[j] = rank
+
+    def count(self):
+        est = self.alpha * self.m * self.m / sum(2.0 ** -r for r in self.registers)
+
+        if est <= 2.5 * self.m:
+            zeros = self.registers.count(0)
+            if zeros:
+                est = self.m * math.log(self.m / zeros)  # Linear counting, for small cardinalities
+
+        return int(round(est))
+
+
+class ColumnCollector(object):
+    """Collect statistics for the values of one column"""
+
+    def __init__(self, name, position, histogram_max=50):
+        self.name = name
+        self.position = position
+        self.histogram_max = histogram_max
+
+        self.rows = 0
+        self.nulls = 0
+        self.min = None
+        self.max = None
+
+        self._ordered = True  # False if the values can't be compared
+
+        # Exact counts are kept until there are too many distinct values, then
+        # distinct values are estimated with a sketch
+        self.counter = Counter()
+        self.hll = None
+
+    def update(self, values):
+
+        non_null = [v for v in values if v is not None]
+
+        self.rows += len(values)
+        self.nulls += len(values) - len(non_null)
+
+        if not non_null:
+            return
+
+        if self._ordered:
+            try:
+                lo, hi = min(non_null), max(non_null)
+                self.min = lo if self.min is None else min(self.min, lo)
+                self.max = hi if self.max is None else max(self.max, hi)
+            except TypeError:
+                self._ordered = False
+                self.min = self.max = None
+
+        if self.counter is not None:
+            self.counter.update(non_null)
+
+            if len(self.counter) > self.histogram_max:
+                self.hll = HyperLogLog()
+                for v in self.counter:
+                    self.hll.add(v)
+                self.counter = None
+        else:
+            for v in set(non_null):
+                self.hll.add(v)
+
+    def stats(self):
+        """Return a dict of values for a ColumnStats"""
+        return {
+            'position': self.position,
+            'column_name': self.name,
+            'rows': self.rows,
+            'nulls': self.nulls,
+            'min_value': str(self.min) if self.min is not None else None,
+            'max_value': str(self.max) if self.max is not None else None,
+            'distinct_count': len(self.counter) if self.counter is not None else self.hll.count(),
+            'histogram': [[str(k), v] for k, v in self.counter.most_common()] if self.counter is not None else None
+        }
+
+
+class StatsCollector(object):
+    """Collect statistics for all of the columns in batches of row tuples"""
+
+    def __init__(self, names, histogram_max=50):
+        self.columns = [ColumnCollector(name, i, histogram_max) for i, name in enumerate(names)]
+
+    def update(self, rows):
+        if not rows:
+            return
+
+        for c, values in zip(self.columns, zip(*rows)):
+            c.update(values)
+
+    def stats(self):
+        """Return a list of dicts, one per column, with values for ColumnStats"""
+        return [c.stats() for c in self.columns]
@@ -0,0 +1,289 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Storage backends for resource rows.
+
+A resource's storage column names the backend that holds its rows. The 'sql' backend
+stores them in a table in the catalog database, or in a shard file. The 'parquet' backend
+stores them in a Parquet file, in the database's columnar directory, and queries
+them with DuckDB, which only reads the columns a query uses. It is much smaller and
+faster to scan for wide resources, but the tables can't be joined with tables in the
+catalog database. Either way, the resource is registered in the catalog, and
+queried, by its table name.
+
+The parquet backend requires pyarrow and duckdb, which are installed with the 'columnar'
+extra: pip install metapack-db[columnar]
+
+Other backends can be added with register_storage().
+"""
+
+from contextlib import contextmanager
+from os import makedirs, remove, replace
+from os.path import dirname, exists
+
+SQL = 'sql'
+PARQUET = 'parquet'
+
+
+def created_file(session, path):
+    """Record a file that was created for a resource in a session's transaction. If the
+    transaction is rolled back, MetatabManager.session() removes the file, which would
+    otherwise be left with no resource that refers to it"""
+    session.info.setdefault('created_files', []).append(path)
+
+
+class SqlStorage(object):
+    """Rows in a table in the catalog database, or, if the database has a shard directory, in
+    a shard file"""
+
+    name = SQL
+    columnar = False
+
+    def create(self, r, session, unlogged=False):
+        """Create the storage for a resource's rows
+
+        :param unlogged: If True, and the database is PostgreSQL, create the table UNLOGGED
+        """
+
+        database = session.info['manager'].database
+
+        if database.shard_dir:
+            r.shard_path = database.shard_path(r.table_name)
+
+            created_file(session, r.shard_path)
+
+            with database.shard_engine(r.shard_path).begin() as connection:
+                r.table.create(connection)
+        else:
+            connection = session.connection()
+
+            if unlogged and connection.dialect.name == 'postgresql':
+                table = r.make_sa_table(prefixes=['UNLOGGED'])
+            else:
+                table = r.table
+
+            # Use the session's connection, so the table is created in the same transaction
+            table.create(connection)
+
+    def detached(self, r):
+        """True if the rows are loaded outside of the catalog transaction"""
+        return bool(r.shard_path)
+
+    @contextmanager
+    def connect(self, r, database, session=None):
+        """Provide the connection that rows are loaded through, which is passed to writers()
+        and finish(). Without a session, the resource must be detached"""
+
+        if r.shard_path:
+            with database.shard_engine(r.shard_path).begin() as connection:
+                yield connection
+        else:
+            yield session.connection()
+
+    def writers(self, r, connection):
+        """Return writers for the rows, and for the rejected rows, of a load"""
+        from .coerce import RejectWriter
+        from .loader import RowWriter
+
+        return (RowWriter(connection, r.table_name, [c['header'] for c in r.schema]),
+                RejectWriter(connection, r.rejects_table_name))
+
+    def finish(self, r, connection, writers, bulk=False, index_spec=None):
+        """Finish a load, after all of the rows are written"""
+        r.finish_load(connection, bulk, index_spec)
+
+    def abort(self, r, writers):
+        """Clean up after a load fails. The transaction is rolled back"""
+
+
+class ParquetWriter(object):
+    """Writes batches of row tuples to a Parquet file, one row group per batch. Like a
+    resource table, the file has an _id column, which numbers the rows from 1. The file is
+    written under a temporary name, and moved into place by close()"""
+
+    def __init__(self, path, schema):
+        """
+        :param path: Path of the Parquet file
+        :param schema: A pyarrow Schema, for the columns of the rows, after _id
+        """
+        import pyarrow as pa
+
+        self.path = path
+        self.tmp = path + '.tmp'
+        self.schema = pa.schema([('_id', pa.int64())] + list(schema))
+
+        self.rows = 0
+
+        self._writer = None
+
+    def _open(self):
+        import pyarrow.parquet as pq
+
+        makedirs(dirname(self.path), exist_ok=True)
+        self._writer = pq.ParquetWriter(self.tmp, self.schema, compression='zstd')
+
+    def write(self, rows):
+        import pyarrow as pa
+
+        if not rows:
+            return
+
+        if self._writer is None:
+            self._open()
+
+        ids = pa.array(range(self.rows + 1, self.rows + len(rows) + 1), type=pa.int64())
+
+        columns = [ids] + [pa.array(col, type=f.type) for col, f in zip(zip(*rows), list(self.schema)[1:])]
+
+        self.rows += len(rows)
+
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self, write_empty=True):
+        """Close the file, and move it into place
+
+        :param write_empty: If True, and no rows were written, write a file with no rows,
+        so the table can still be queried
+        """
+        if self._writer is None:
+            if not write_empty:
+                return
+
+            self._open()
+
+        self._writer.close()
+        self._writer = None
+
+        replace(self.tmp, self.path)
+
+    def abort(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+        if exists(self.tmp):
+            remove(self.tmp)
+
+
+class ParquetStorage(object):
+    """Rows in a Parquet file, in the database's columnar directory"""
+
+    name = PARQUET
+    columnar = True
+
+    def create(self, r, session, unlogged=False):
+
+        database = session.info['manager'].database
+
+        if not database.columnar_dir:
+            raise ValueError("The '{}' storage requires a Database with a columnar_dir".format(self.name))
+
+        r.storage_path = database.columnar_path(r.table_name)
+
+        # The file is written when the resource is loaded
+        created_file(session, r.storage_path)
+        created_file(session, self.rejects_path(r.storage_path))
+
+    def detached(self, r):
+        return True
+
+    @contextmanager
+    def connect(self, r, database, session=None):
+        yield None
+
+    @staticmethod
+    def rejects_path(path):
+        """Path of the Parquet file of rejected rows, for the Parquet file of a resource"""
+        return path[:-len('.parquet')] + '_rejects.parquet' if path.endswith('.parquet') else path + '_rejects'
+
+    @staticmethod
+    def arrow_schema(r):
+        """Return a pyarrow Schema for a resource's schema"""
+        import pyarrow as pa
+        from sqlalchemy import BLOB, Boolean, Date, DateTime, Float, Integer, String, Time
+        from .coerce import type_map
+
+        arrow_types = {
+            Integer: pa.int64(),
+            Float: pa.float64(),
+            Boolean: pa.bool_(),
+            Date: pa.date32(),
+            DateTime: pa.timestamp('us'),
+            Time: pa.time64('us'),
+            BLOB: pa.binary(),
+        }
+
+        return pa.schema([(c['header'], arrow_types.get(type_map.get(c.get('datatype'), String), pa.string()))
+                          for c in r.schema])
+
+    def writers(self, r, connection):
+        import pyarrow as pa
+
+        rejects_schema = pa.schema([('row_number', pa.int64()), ('reason', pa.string()), ('row', pa.string())])
+
+        return (ParquetWriter(r.storage_path, self.arrow_schema(r)),
+                ParquetWriter(self.rejects_path(r.storage_path), rejects_schema))
+
+    def finish(self, r, connection, writers, bulk=False, index_spec=None):
+        rows, rejects = writers
+
+        rows.close()
+        rejects.close(write_empty=False)
+
+        # Parquet files have no indexes. Row group statistics serve range scans
+
+    def abort(self, r, writers):
+        for w in writers:
+            w.abort()
+
+    def drop(self, path):
+        """Delete the files of a resource"""
+        for p in (path, self.rejects_path(path)):
+            if exists(p):
+                remove(p)
+
+    def query(self, tables, sql, params=()):
+        """Run a query against Parquet files, each as a view named for its table, and return a
+        list of row tuples
+
+        :param tables: Dict of table names to Parquet file paths
+        """
+        import duckdb
+
+        connection = duckdb.connect()
+
+        try:
+            for table_name, path in tables.items():
+                connection.execute('CREATE VIEW "{}" AS SELECT * FROM read_parquet(\'{}\')'
+                                   .format(table_name.replace('"', '""'), path.replace("'", "''")))
+
+                rejects = self.rejects_path(path)
+
+                if exists(rejects):
+                    connection.execute('CREATE VIEW "{}_rejects" AS SELECT * FROM read_parquet(\'{}\')'
+                                       .format(table_name.replace('"', '""'), rejects.replace("'", "''")))
+
+            return connection.execute(sql, list(params)).fetchall()
+        finally:
+            connection.close()
+
+
+_storage = {
+    SQL: SqlStorage(),
+    PARQUET: ParquetStorage(),
+}
+
+
+def register_storage(backend):
+    """Register a storage backend, an object with the methods of SqlStorage, under its name"""
+    _storage[backend.name] = backend
+
+
+def get_storage(name):
+    """Return the storage backend with a name. None is the 'sql' backend"""
+
+    try:
+        return _storage[name or SQL]
+    except KeyError:
+        raise ValueError("Unknown storage '{}'. Expected one of: {}".format(name, ', '.join(sorted(_storage))))
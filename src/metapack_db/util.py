@@ -33,6 +33,18 @@ def base_encode(number, alphabet=string.ascii_lowercase, fill=None):
     else:
         return v
 
+def chunks(iterable, n):
+    """Yield successive lists of at most n items from an iterable"""
+    from itertools import islice
+
+    it = iter(iterable)
+
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
 # From http://stackoverflow.com/a/295466
 def tablenamify(value):
     """
@@ -5,8 +5,8 @@ from metapack import MetapackDoc
 from metapack_db import Database, MetatabManager
 from metapack_db.document import Document
 from metapack_db.term import Term
-from os import remove
-from os.path import exists
+from os import listdir, remove
+from os.path import exists, join
 
 from sqlalchemy.exc import IntegrityError
 
@@ -57,6 +57,56 @@ class BasicTests(unittest.TestCase):
             self.assertEqual(0, len(list(s.query(Document))))
             self.assertEqual(0, len(list(s.query(Term))))
 
+    def test_delete_documents(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        db = Database('sqlite:///' + test_database_path)
+
+        mm = MetatabManager(db)
+
+        mm.add_doc(MetapackDoc(test_data('example1.csv')))
+        mm.add_doc(MetapackDoc(test_data('example.com-full-2017-us.csv')))
+
+        doc = mm.document(identifier='cfcba102-9d8f-11e7-8adb-3c0754078006')
+
+        self.assertEqual(1, mm.delete_documents([doc.id], chunk_size=1))
+
+        with mm.session() as s:
+            self.assertEqual(['316821b9-9082-4c9e-8662-db50d9d91135'], [d.identifier for d in s.query(Document)])
+            self.assertEqual(0, s.query(Term).filter(Term.document_id == doc.id).count())
+
+        # The resource tables are dropped with the document
+        from sqlalchemy import inspect
+
+        doc, (r,) = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+        self.assertIn(r.table_name, inspect(db.engine).get_table_names())
+
+        self.assertEqual(1, mm.delete_documents([doc.id]))
+        self.assertNotIn(r.table_name, inspect(db.engine).get_table_names())
+
+    def test_batch(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        db = Database('sqlite:///' + test_database_path)
+
+        mm = MetatabManager(db)
+
+        with mm.batch(commit_every=1) as b:
+            b.add_doc(MetapackDoc(test_data('example1.csv')))
+            b.add_doc(MetapackDoc(test_data('example1.csv')))  # Duplicate, rolled back
+            b.add_doc(MetapackDoc(test_data('example.com-full-2017-us.csv')))
+
+        self.assertEqual(2, len(b.added))
+        self.assertEqual(1, len(b.failed))
+        self.assertIsInstance(b.failed[0][1], IntegrityError)
+
+        with mm.session() as s:
+            self.assertEqual(2, len(list(s.query(Document))))
+
     def test_iterate_doc(self):
 
         doc = MetapackDoc(test_data('example1.csv'))
@@ -162,5 +212,319 @@ class BasicTests(unittest.TestCase):
 
         mm.load('http://library.metatab.org/example.com-full-2017-us-1.csv#random-names')
 
+    def test_shards(self):
+        from shutil import rmtree
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        shard_dir = '/tmp/test-shards'
+        rmtree(shard_dir, ignore_errors=True)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path, shard_dir=shard_dir))
+
+        doc, _ = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+
+        r = mm.resource(doc, 'numbers')
+        self.assertEqual(join(shard_dir, r.table_name + '.db'), r.shard_path)
+        self.assertTrue(exists(r.shard_path))
+        self.assertTrue(r.loaded)
+
+        self.assertEqual(20, len(mm.read(r)))
+        self.assertEqual([(19, 'nineteen')],
+                         list(mm.query('SELECT id, name FROM {} WHERE value > 300'.format(r.table_name))))
+
+        mm.delete_documents([doc.id])
+        self.assertFalse(exists(r.shard_path))
+
+        # The rejects table is in the shard file, and can be queried by itself
+        from shutil import copytree
+
+        package_dir = '/tmp/test-shards-package'
+        rmtree(package_dir, ignore_errors=True)
+        copytree(test_data('local'), package_dir)
+
+        with open(join(package_dir, 'data', 'numbers.csv'), 'a') as f:
+            f.write('twenty,twenty,400.0\n')
+
+        doc, _ = mm.load(join(package_dir, 'metadata.csv'), load_all_resources=True)
+        r = mm.resource(doc, 'numbers')
+
+        self.assertEqual([(21,)], list(mm.query('SELECT row_number FROM {}_rejects'.format(r.table_name))))
+
+        mm.delete_documents([doc.id])
+
+        # A lazy manager creates the shard files when it adds the document. They are removed
+        # if the transaction is rolled back
+        mm = MetatabManager(Database('sqlite:///' + test_database_path, shard_dir=shard_dir), lazy=True)
+
+        with self.assertRaises(ZeroDivisionError):
+            with mm.session():
+                mm.add_doc(MetapackDoc(test_data('local', 'metadata.csv')))
+                self.assertTrue(listdir(shard_dir))
+                1 / 0
+
+        self.assertEqual([], listdir(shard_dir))
+
+    def test_lazy(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path), lazy=True)
+
+        doc, resources = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+
+        r = mm.resource(doc, 'numbers')
+        self.assertTrue(r.table_created)
+        self.assertFalse(r.loaded)
+
+        self.assertEqual([(20,)], list(mm.query('SELECT count(*) FROM {}'.format(r.table_name))))
+        self.assertTrue(mm.resource(doc, 'numbers').loaded)
+
+    def test_progress_estimate(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+
+        progress = []
+
+        mm.load(test_data('local', 'metadata.csv'), load_all_resources=True, progress=progress.append)
+        self.assertIsNone(progress[0].total_rows)
+
+        # The next version of the package has an estimate, from the rows of the last version
+        progress = []
+        mm.load(test_data('local', 'metadata-2.csv'), load_all_resources=True, progress=progress.append)
+        self.assertEqual(20, progress[0].total_rows)
+
+    def test_shared_tables(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path), share=True)
+
+        doc1, (r1,) = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+        doc2, (r2,) = mm.load(test_data('local', 'metadata-2.csv'), load_all_resources=True)
+
+        r1, r2 = mm.resource(doc1, 'numbers'), mm.resource(doc2, 'numbers')
+
+        self.assertEqual(r1.table_name, r2.storage_table)
+        self.assertTrue(r2.shared)
+        self.assertEqual(20, len(mm.read(r2)))
+
+        # The shared table is kept until the last resource that uses it is deleted
+        mm.delete_documents([doc1.id])
+        self.assertEqual(20, len(mm.read(r2)))
+
+        mm.delete_documents([doc2.id])
+        self.assertEqual([], mm.query("SELECT name FROM sqlite_master WHERE name LIKE 'd%'"))
+
+    def test_gc(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+
+        doc1, _ = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+        doc2, _ = mm.load(test_data('local', 'metadata-2.csv'), load_all_resources=True)
+
+        self.assertEqual('example.com-local-2', mm.latest('example.com-local').name)
+        self.assertEqual([2, 1], [d.version for d in mm.versions('example.com-local')])
+
+        self.assertEqual([], mm.superseded(keep=1, newer_than=doc1.ingested.replace(year=2000)))
+        self.assertEqual([doc1.id], mm.gc(keep=1))
+
+        self.assertEqual(['example.com-local-2'], [d.name for d in mm.documents()])
+        self.assertEqual(20, len(mm.read(mm.resource(doc2, 'numbers'))))
+
+    def test_readers(self):
+        from shutil import copy
+
+        reader_path = '/tmp/test-reader.db'
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+        mm.add_doc(MetapackDoc(test_data('example1.csv')))
+
+        # The reader is a copy of the writer, which falls behind as the writer changes
+        copy(test_database_path, reader_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path, readers=['sqlite:///' + reader_path]))
+
+        mm.add_doc(MetapackDoc(test_data('example.com-full-2017-us.csv')))
+
+        # Reads right after a write go to the writer
+        self.assertEqual(2, len(list(mm.documents())))
+
+        mm.write_lag = 0
+        self.assertEqual(1, len(list(mm.documents())))
+
+        with self.assertRaises(RuntimeError):
+            with mm.session(read=True):
+                mm.add_doc(MetapackDoc(test_data('example1.csv')))
+
+    def test_snapshot(self):
+        from sqlalchemy.exc import OperationalError
+
+        snapshot_path = '/tmp/test-snapshot.db'
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+
+        doc, resources = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+        mm.add_doc(MetapackDoc(test_data('example1.csv')))
+
+        mm.export_snapshot(snapshot_path, resources)
+
+        sm = MetatabManager(Database.snapshot(snapshot_path))
+
+        self.assertEqual(2, len(list(sm.documents())))
+        self.assertEqual(20, len(sm.read(sm.resource(doc, 'numbers'))))
+
+        with self.assertRaises(OperationalError):
+            sm.add_doc(MetapackDoc(test_data('example.com-full-2017-us.csv')))
+
+    def test_bulk_load(self):
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+
+        doc, (r,) = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True, bulk=True)
+
+        # The index from the schema is built after loading, then the table is analyzed
+        self.assertEqual([('ix_{}_id'.format(r.table_name),)],
+                         mm.query("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?",
+                                  r.table_name))
+        self.assertTrue(mm.query("SELECT * FROM sqlite_stat1 WHERE tbl = ?", r.table_name))
+
+    def test_query_cache(self):
+        from metapack_db.querycache import QueryCache
+        from metapack_db.resource import Resource
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        qc = QueryCache()
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path), lazy=True, query_cache=qc)
+
+        doc, (r,) = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+
+        sql = 'SELECT count(*) FROM {}'.format(r.table_name)
+
+        self.assertEqual([(20,)], mm.query(sql))
+        self.assertEqual([(20,)], mm.query(sql.lower() + ';'))
+        self.assertEqual((1, 1), (qc.hits, qc.misses))
+
+        # Loading the table again increments its generation, so the cached result isn't used
+        with mm.session() as s:
+            s.query(Resource).get(r.id).mark_loaded()
+
+        self.assertEqual([(20,)], mm.query(sql))
+        self.assertEqual((1, 2), (qc.hits, qc.misses))
+
+        # Queries of the catalog tables aren't cached
+        mm.query('SELECT count(*) FROM mt_resources')
+        self.assertEqual((1, 2), (qc.hits, qc.misses))
+
+    def test_export(self):
+        import io
+        import json
+        from shutil import rmtree
+        from tempfile import mkdtemp
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        mm = MetatabManager(Database('sqlite:///' + test_database_path))
+
+        mm.add_doc(MetapackDoc(test_data('local', 'metadata.csv')))
+        mm.add_doc(MetapackDoc(test_data('local', 'metadata-2.csv')))
+
+        d = mm.document(name='example.com-local-1')
+
+        f = io.StringIO()
+        mm.export_document(d, f, format='jsonl')
+        lines = [json.loads(l) for l in f.getvalue().splitlines()]
+        self.assertIn(('title', 'A Local Example Package'), [(l['term'], l['value']) for l in lines])
+
+        # The CSV export is a Metatab document
+        dir = mkdtemp()
+        try:
+            self.assertEqual(2, mm.export_documents(dir, format='csv', chunk_size=1))
+
+            doc = MetapackDoc(join(dir, 'example.com-local-1.csv'))
+            self.assertEqual('example.com-local-1', doc.get_value('Root.Name'))
+            self.assertEqual(['numbers'], [r.name for r in doc.resources()])
+            self.assertEqual(['id', 'name', 'value'], [c['header'] for c in doc.resource('numbers').columns()])
+
+            # It has the same terms as the original, with the sections' property columns
+            def terms(d):
+                return [(t.join_lc, t.value) for t in d.all_terms]
+
+            self.assertEqual(terms(MetapackDoc(test_data('local', 'metadata.csv'))), terms(doc))
+            self.assertEqual(['DataType', 'Description', 'Index'], doc['Schema'].property_names)
+        finally:
+            rmtree(dir)
+
+        f = io.StringIO()
+        self.assertEqual(2, mm.export_documents(f))
+        self.assertEqual(2, f.getvalue().count('{"document": {'))
+
+    def test_columnar_storage(self):
+        from shutil import rmtree
+
+        try:
+            import duckdb, pyarrow
+        except ImportError:
+            self.skipTest("Requires the 'columnar' extra")
+
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        columnar_dir = '/tmp/test-columnar'
+        rmtree(columnar_dir, ignore_errors=True)
+
+        db = Database('sqlite:///' + test_database_path, columnar_dir=columnar_dir)
+        mm = MetatabManager(db, storage='parquet')
+
+        doc, _ = mm.load(test_data('local', 'metadata.csv'), load_all_resources=True)
+
+        r = mm.resource(doc, 'numbers')
+        self.assertEqual(('parquet', join(columnar_dir, r.table_name + '.parquet')), (r.storage, r.storage_path))
+        self.assertTrue(exists(r.storage_path))
+
+        # The same rows, and columns, as the table the 'sql' backend would create
+        self.assertEqual(20, len(mm.read(r)))
+        self.assertEqual([(19, 'nineteen')],
+                         list(mm.query('SELECT id, name FROM {} WHERE value > 300'.format(r.table_name))))
+
+        # A resource in the 'sql' backend, with the same rows, doesn't share the Parquet file
+        sql_mm = MetatabManager(db, share=True)
+        doc2, _ = sql_mm.load(test_data('local', 'metadata-2.csv'), load_all_resources=True)
+        r2 = sql_mm.resource(doc2, 'numbers')
+        self.assertEqual(('sql', r2.table_name), (r2.storage, r2.storage_table))
+
+        # Tables in the catalog database can't be read in the same query
+        with self.assertRaises(ValueError):
+            mm.query('SELECT * FROM {} JOIN {} USING (id)'.format(r.table_name, r2.table_name))
+
+        with self.assertRaises(ValueError):
+            mm.query('SELECT * FROM {} WHERE id IN (SELECT id FROM mt_resources)'.format(r.table_name))
+
+        mm.delete_documents([doc.id])
+        self.assertFalse(exists(r.storage_path))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from os import utime
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Thread
+
+from metapack_db.cache import DownloadCache
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+        self.cache = DownloadCache(join(self.dir, 'cache'), max_size=100)
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, name, data):
+        path = join(self.dir, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_file_hit_miss(self):
+
+        p = self.write('a.csv', 'a,b\n1,2\n')
+
+        path = self.cache.fetch('file:' + p)
+        self.assertTrue(path.endswith('.csv'))
+        self.assertEqual('a,b\n1,2\n', open(path).read())
+
+        self.assertEqual(path, self.cache.fetch('file:' + p))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+        self.assertEqual('file:' + path + '#sheet1', self.cache.localize('file:' + p + '#sheet1'))
+
+        # Changing the file changes the default fingerprint
+        self.write('a.csv', 'a,b\n3,4\n')
+        utime(p, (0, 0))
+        self.assertNotEqual(path, self.cache.fetch('file:' + p))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_content_addressed(self):
+
+        p1 = self.write('a.csv', 'a,b\n1,2\n')
+        p2 = self.write('b.csv', 'a,b\n1,2\n')
+
+        self.assertEqual(self.cache.fetch('file:' + p1), self.cache.fetch('file:' + p2))
+        self.assertEqual(1, self.cache.stats()['files'])
+
+    def test_eviction(self):
+
+        paths = [self.cache.fetch('file:' + self.write('f{}.csv'.format(i), str(i) * 40)) for i in range(3)]
+
+        self.assertFalse(exists(paths[0]))
+        self.assertTrue(exists(paths[2]))
+        self.assertEqual(1, self.cache.evictions)
+        self.assertLessEqual(self.cache.size, 100)
+
+        # The key file for the evicted content is removed with it
+        self.assertEqual(2, len(list(self.cache._keys())))
+
+    def test_http(self):
+
+        self.write('remote.csv', 'a,b\n1,2\n')
+
+        heads = []
+
+        class Handler(QuietHandler):
+            def __init__(s, *args, **kwargs):
+                super().__init__(*args, directory=self.dir, **kwargs)
+
+            def do_HEAD(s):
+                heads.append(s.path)
+                super().do_HEAD()
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+
+        try:
+            url = 'http://127.0.0.1:{}/remote.csv'.format(server.server_port)
+
+            path = self.cache.fetch(url)
+            self.assertEqual('a,b\n1,2\n', open(path).read())
+
+            self.cache.fetch(url)
+            self.assertEqual({'hits': 1, 'misses': 1}, {k: self.cache.stats()[k] for k in ('hits', 'misses')})
+
+            # One HEAD request for the fingerprint of each fetch, whether it is a hit or a miss
+            self.assertEqual(2, len(heads))
+
+            # A changed remote file has a different fingerprint, from its headers, so it is fetched again
+            self.write('remote.csv', 'a,b\n1,2\n3,4\n')
+            self.assertEqual('a,b\n1,2\n3,4\n', open(self.cache.fetch(url)).read())
+            self.assertEqual(2, self.cache.misses)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
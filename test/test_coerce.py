@@ -0,0 +1,105 @@
+import unittest
+from datetime import date
+
+from sqlalchemy import create_engine
+from sqlalchemy.dialects import sqlite
+
+from metapack_db.coerce import Coercer
+from metapack_db.loader import PipelinedLoader, RowWriter
+
+schema = [
+    {'header': 'id', 'datatype': 'integer'},
+    {'header': 'name', 'datatype': 'text'},
+    {'header': 'value', 'datatype': 'number'},
+    {'header': 'day', 'datatype': 'date'},
+]
+
+
+class CoerceTests(unittest.TestCase):
+
+    def test_coerce(self):
+
+        c = Coercer(schema)
+
+        rows, rejects = c.coerce([('1', 'a', '1.5', '2017-01-02'),
+                                  ('2.0', 'b', '', None),
+                                  ('x', 'c', '3', '2017-01-02'),
+                                  ('4', 'd', '4', 'not a date')])
+
+        self.assertEqual([(1, 'a', 1.5, date(2017, 1, 2)), (2, 'b', None, None)], rows)
+
+        self.assertEqual([3, 4], [r[0] for r in rejects])
+        self.assertTrue(rejects[0][1].startswith('id:'))
+        self.assertTrue(rejects[1][1].startswith('day:'))
+        self.assertEqual(2, c.rejected)
+
+        # Row numbers continue across batches
+        rows, rejects = c.coerce([('1.5', 'e', '1', '2017-01-01')])
+        self.assertEqual([], rows)
+        self.assertEqual(5, rejects[0][0])
+
+    def test_empty_strings(self):
+
+        # Empty strings are values in string columns, and missing values in other columns
+        rows, _ = Coercer(schema).coerce([('', '', '', '')])
+
+        self.assertEqual([(None, '', None, None)], rows)
+
+    def test_out_of_range(self):
+
+        # Integers that don't fit in 64 bits are rejected, rather than failing the insert
+        engine = create_engine('sqlite://')
+
+        rows = [('1', 'a', '1', None),
+                ('100000000000000000000', 'b', '2', None),
+                ('-9223372036854775809', 'c', '3', None),
+                ('9223372036854775807', 'd', '4', None),
+                ('1e30', 'e', '5', None)]
+
+        c = Coercer(schema, engine.dialect)
+        rejects = []
+
+        class Rejects(object):
+            def write(self, rows):
+                rejects.extend(rows)
+
+        with engine.begin() as conn:
+            conn.execute('CREATE TABLE t (id INTEGER, name TEXT, value REAL, day DATE)')
+
+            PipelinedLoader(lambda: iter(rows), RowWriter(conn, 't', ['id', 'name', 'value', 'day']),
+                            transform=c.coerce, rejects=Rejects()).run()
+
+            self.assertEqual([(1,), (9223372036854775807,)], list(conn.execute('SELECT id FROM t')))
+
+        self.assertEqual([2, 3, 5], [r[0] for r in rejects])
+        self.assertTrue(rejects[0][1].startswith('id: Integer out of range'))
+
+    def test_unique(self):
+
+        c = Coercer(schema, unique=[('id',), ('name', 'day')])
+
+        rows, rejects = c.coerce([('1', 'a', '1', '2017-01-02'),
+                                  ('01', 'b', '2', None),  # The same id, after conversion
+                                  ('2', 'a', '3', '2017-01-02'),
+                                  ('3', 'c', '4', None),
+                                  ('', 'd', '5', None)])
+
+        self.assertEqual([1, 3, None], [r[0] for r in rows])
+        self.assertEqual([(2, 'Duplicate value of (id), which must be unique'),
+                          (3, 'Duplicate value of (name, day), which must be unique')],
+                         [r[:2] for r in rejects])
+
+        # Keys are checked across batches, but not against rejected rows
+        rows, rejects = c.coerce([('3', 'e', '6', None), ('2', 'f', '7', None)])
+        self.assertEqual([6], [r[0] for r in rejects])
+        self.assertEqual([(2, 'f', 7.0, None)], rows)
+
+    def test_dialect_processing(self):
+
+        rows, _ = Coercer(schema, sqlite.dialect()).coerce([('1', 'a', '1', '2017-01-02')])
+
+        self.assertEqual([(1, 'a', 1.0, '2017-01-02')], rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import subprocess
+import sys
+import unittest
+from os.path import abspath, dirname, join
+
+src_dir = join(dirname(dirname(abspath(__file__))), 'src')
+
+# Importing the package and registering the subcommands shouldn't load these
+heavy_modules = ['sqlalchemy', 'sqlalchemy.dialects.postgresql', 'metapack', 'metatab', 'rowgenerators',
+                 'tabulate']
+
+import_script = """
+import sys
+sys.path.insert(0, {src!r})
+import metapack_db, metapack_db.cli.db, metapack_db.cli.sql
+print(' '.join(m for m in {heavy!r} if m in sys.modules))
+"""
+
+
+class ImportTests(unittest.TestCase):
+
+    def test_lazy_imports(self):
+
+        loaded = subprocess.check_output([sys.executable, '-c', import_script.format(src=src_dir, heavy=heavy_modules)],
+                                         universal_newlines=True)
+
+        self.assertEqual('', loaded.strip())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,203 @@
+import sqlite3
+import threading
+import time
+import unittest
+from datetime import datetime
+from os import remove
+from os.path import exists
+
+from sqlalchemy.exc import OperationalError
+
+from metapack_db import Database, MetatabManager
+from metapack_db.jobs import DONE, FAILED, QUEUED, RUNNING, JobQueue, Worker
+
+test_database_path = '/tmp/test-jobs.db'
+
+
+class JobTests(unittest.TestCase):
+
+    def setUp(self):
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        self.mm = MetatabManager(Database('sqlite:///' + test_database_path), lease_ttl=0.3)
+
+    def test_claim(self):
+
+        q = JobQueue(self.mm)
+
+        low = q.enqueue('http://example.com/low.zip')
+        high = q.enqueue('http://example.com/high.zip', priority=10)
+
+        # Higher priority first, and each job is claimed once
+        self.assertEqual(high, q.claim('a').id)
+        job = q.claim('b')
+        self.assertEqual((low, RUNNING, 'b', 1), (job.id, job.state, job.owner, job.attempts))
+        self.assertIsNone(q.claim('c'))
+
+        q.complete(job, 100, 2.0)
+        self.assertEqual(DONE, q.jobs(DONE)[0].state)
+
+    def test_retry(self):
+
+        q = JobQueue(self.mm, backoff=0.2)
+
+        q.enqueue('http://example.com/fails.zip', retries=1)
+
+        job = q.claim('a')
+        q.fail(job, 'Boom')
+
+        # Queued again, but not until after the backoff
+        self.assertEqual((QUEUED, 'Boom'), (q.jobs()[0].state, q.jobs()[0].error))
+        self.assertIsNone(q.claim('a'))
+        self.assertEqual(1, q.stats()['retrying'])
+
+        time.sleep(0.25)
+
+        job = q.claim('a')
+        self.assertEqual(2, job.attempts)
+        q.fail(job, 'Boom')
+
+        # Out of attempts
+        self.assertEqual(FAILED, q.jobs()[0].state)
+        self.assertIsNone(q.claim('a'))
+
+    def test_recover(self):
+
+        q = JobQueue(self.mm, backoff=0)
+
+        q.enqueue('http://example.com/a.zip')
+
+        dead = q.claim('dead worker')  # Never takes the lease, or finishes
+
+        self.assertEqual(0, q.recover())  # Too soon, the worker may be about to take the lease
+        time.sleep(0.4)
+        self.assertEqual(1, q.recover())
+
+        job = q.jobs()[0]
+        self.assertEqual(QUEUED, job.state)
+        self.assertIn('dead worker', job.error)
+
+        # If the worker was still running, it can't change the job, once it has been claimed again
+        self.assertFalse(q.complete(dead, 100, 1.0))
+        self.assertFalse(q.fail(dead, 'Boom'))
+
+        job = q.claim('b')
+        self.assertTrue(q.complete(job, 100, 1.0))
+        self.assertEqual(('b', 100), (q.jobs(DONE)[0].owner, q.jobs(DONE)[0].rows))
+
+    def test_worker(self):
+
+        q = JobQueue(self.mm, backoff=0)
+
+        loaded = []
+
+        def load(url, **kwargs):
+            if 'bad' in url:
+                raise ValueError('Bad package')
+            loaded.append(url)
+
+        self.mm.load = load
+
+        for i in range(6):
+            q.enqueue('http://example.com/{}.zip'.format(i))
+
+        q.enqueue('http://example.com/bad.zip', retries=2)
+
+        w = Worker(q, concurrency=3, poll=0.01, exit_when_empty=True)
+        w.run()
+
+        self.assertEqual(6, len(set(loaded)))
+        self.assertEqual((6, 3), (w.completed, w.failed))
+
+        stats = q.stats()
+        self.assertEqual((6, 1, 0, 0), (stats[DONE], stats[FAILED], stats[QUEUED], stats[RUNNING]))
+        self.assertEqual(6, stats['done_last_hour'])
+        self.assertIn('Bad package', q.jobs(FAILED)[0].error)
+        self.assertTrue(q.jobs(FAILED)[0].finished <= datetime.utcnow())
+
+    def test_long_load(self):
+
+        q = JobQueue(self.mm, backoff=0)
+        q.enqueue('http://example.com/a.zip')
+
+        def load(url, **kwargs):
+            # Like a load into a Sqlite catalog, which holds the write lock for longer than the ttl,
+            # so the heartbeat can't renew the job's lease
+            with self.mm.session(write_lock=True) as s:
+                connection = s.connection()  # Begins the transaction, taking the lock
+                time.sleep(1.0)
+                self.mm.leases.renew_held(connection)
+
+            time.sleep(0.2)  # Then fetch the next resource, outside of a transaction
+
+        self.mm.load = load
+
+        # Another worker, checking for stopped workers while the job runs
+        other = JobQueue(MetatabManager(Database('sqlite:///' + test_database_path), lease_ttl=0.3), backoff=0)
+        recovered = []
+        done = threading.Event()
+
+        def recover():
+            while not done.wait(0.05):
+                try:
+                    recovered.append(other.recover())
+                except OperationalError:
+                    pass
+
+        t = threading.Thread(target=recover)
+        t.start()
+
+        w = Worker(q, poll=0.05, exit_when_empty=True)
+        w.run()
+
+        done.set()
+        t.join()
+
+        self.assertEqual(0, sum(recovered))
+        self.assertEqual((1, 0), (w.completed, w.failed))
+        self.assertEqual((DONE, 1, None), (q.jobs()[0].state, q.jobs()[0].attempts, q.jobs()[0].error))
+
+    def test_locked_catalog(self):
+
+        # Don't wait long for the lock
+        mm = MetatabManager(Database('sqlite:///' + test_database_path + '?timeout=0.05'), lease_ttl=0.3)
+        mm.load = lambda url, **kwargs: None
+
+        q = JobQueue(mm, backoff=0)
+        q.enqueue('http://example.com/a.zip')
+
+        # Another process holds the write lock for a while
+        c = sqlite3.connect(test_database_path, check_same_thread=False)
+        c.execute('BEGIN IMMEDIATE')
+        threading.Timer(0.5, c.rollback).start()
+
+        w = Worker(q, poll=0.05, exit_when_empty=True)
+        w.run()
+
+        self.assertEqual((1, 0), (w.completed, w.failed))
+        self.assertEqual(1, q.stats()[DONE])
+
+    def test_worker_error(self):
+
+        q = JobQueue(self.mm, backoff=0)
+        q.enqueue('http://example.com/a.zip')
+
+        def load(url, **kwargs):
+            c = sqlite3.connect(test_database_path)
+            c.execute('DROP TABLE mt_jobs')
+            c.commit()
+
+        self.mm.load = load
+
+        # The job can't be recorded, and the error stops the worker, rather than being retried
+        w = Worker(q, poll=0.01)
+
+        with self.assertRaises(OperationalError):
+            w.run()
+
+        self.assertEqual((0, 0), (w.completed, w.failed))
+
+
+if __name__ == '__main__':
+    unittest.main()
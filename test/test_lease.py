@@ -0,0 +1,136 @@
+import sqlite3
+import threading
+import time
+import unittest
+from os import remove
+from os.path import exists
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from metapack_db import Database
+from metapack_db.lease import LeaseLost, Leases, LeaseTimeout
+
+test_database_path = '/tmp/test-leases.db'
+
+
+class LeaseTests(unittest.TestCase):
+
+    def setUp(self):
+        if exists(test_database_path):
+            remove(test_database_path)
+
+        self.db = Database('sqlite:///' + test_database_path)
+        self.db.create_tables()
+
+    def test_acquire(self):
+
+        a = Leases(self.db.engine)
+        b = Leases(self.db.engine)
+
+        self.assertTrue(a.try_acquire('resource:1'))
+        self.assertFalse(b.try_acquire('resource:1'))
+        self.assertEqual([('resource:1', a.owner)], [(l.name, l.owner) for l in b.active()])
+
+        a.release('resource:1')
+        self.assertTrue(b.try_acquire('resource:1'))
+
+    def test_expiry(self):
+
+        a = Leases(self.db.engine, ttl=0.1)
+        b = Leases(self.db.engine)
+
+        self.assertTrue(a.try_acquire('resource:1'))
+        time.sleep(0.2)
+
+        # The lease expired, so another owner can take it, and the first can't renew it
+        self.assertTrue(b.try_acquire('resource:1'))
+        self.assertFalse(a.renew('resource:1'))
+
+        with self.assertRaises(LeaseTimeout):
+            with a.hold('resource:1', timeout=0.05):
+                pass
+
+    def test_hold(self):
+
+        leases = Leases(self.db.engine, ttl=0.3, poll=0.01)
+
+        events = []
+
+        def work(i):
+            with leases.hold('resource:1'):
+                with leases.hold('resource:1'):  # Held again by the same thread
+                    events.append(('start', i))
+                    time.sleep(0.4)  # Longer than the ttl, so the heartbeat must renew
+                    events.append(('end', i))
+
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # The holds didn't overlap
+        self.assertEqual(['start', 'end', 'start', 'end'], [e[0] for e in events])
+        self.assertEqual([], leases.active())
+
+    def test_renew_held(self):
+
+        # Don't wait long for the lock
+        a = Leases(create_engine('sqlite:///' + test_database_path, connect_args={'timeout': 0.05}), ttl=0.3)
+        b = Leases(self.db.engine)
+
+        with a.hold('resource:1'):
+            # A write transaction, like a load, holds the Sqlite lock for longer than the ttl, so
+            # the heartbeat can't renew the lease. It is renewed in the transaction before it commits
+            with self.db.engine.execution_options(sqlite_immediate=True).begin() as connection:
+                time.sleep(0.4)
+                a.renew_held(connection)
+
+            self.assertFalse(b.try_acquire('resource:1'))
+
+        # A heartbeat that waits for the lock renews from the time it writes, not when it began waiting
+        c = Leases(self.db.engine, ttl=0.3)
+
+        with c.hold('resource:2'):
+            with self.db.engine.execution_options(sqlite_immediate=True).begin() as connection:
+                time.sleep(0.4)
+                c.renew_held(connection)
+
+            time.sleep(0.05)
+            self.assertFalse(b.try_acquire('resource:2'))
+
+        with a.hold('resource:1') as heartbeat:
+            with self.db.engine.begin() as connection:
+                connection.execute("UPDATE mt_leases SET expires = '2000-01-01 00:00:00'")
+
+            self.assertTrue(b.try_acquire('resource:1'))
+
+            with self.assertRaises(LeaseLost):
+                a.renew_held()
+
+            self.assertTrue(heartbeat.lost)
+
+    def test_locked(self):
+
+        # Don't wait long for the lock
+        leases = Leases(create_engine('sqlite:///' + test_database_path, connect_args={'timeout': 0.05}))
+
+        c = sqlite3.connect(test_database_path)
+        c.execute('BEGIN EXCLUSIVE')  # Another process writing, which also blocks reads
+
+        self.assertFalse(leases.try_acquire('resource:1'))
+
+        c.rollback()
+        self.assertTrue(leases.try_acquire('resource:1'))
+
+        # Other errors are raised
+        c.execute('DROP TABLE mt_leases')
+        c.commit()
+
+        with self.assertRaises(OperationalError):
+            leases.try_acquire('resource:2')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import unittest
+from os import remove
+from tempfile import NamedTemporaryFile
+
+from sqlalchemy import create_engine
+
+from metapack_db.loader import LoadProgress, PipelinedLoader, RowWriter, mmap_csv_rows
+
+
+class ListWriter(object):
+
+    def __init__(self, fail_after=None):
+        self.batches = []
+        self.fail_after = fail_after
+
+    def write(self, rows):
+        if self.fail_after is not None and len(self.batches) >= self.fail_after:
+            raise ValueError('Writer failed')
+        self.batches.append(rows)
+
+
+class LoaderTests(unittest.TestCase):
+
+    def test_pipeline(self):
+
+        w = ListWriter()
+
+        loader = PipelinedLoader(lambda: ((i, str(i)) for i in range(25)), w, batch_size=10, queue_size=1)
+
+        self.assertEqual(25, loader.run())
+        self.assertEqual([10, 10, 5], [len(b) for b in w.batches])
+
+        stats = loader.stats()
+        self.assertEqual(25, stats['parser']['rows'])
+        self.assertEqual(3, stats['writer']['batches'])
+        self.assertTrue(0 <= stats['writer']['utilization'] <= 1)
+
+    def test_parser_error(self):
+
+        def source():
+            yield (1,)
+            raise KeyError('bad row')
+
+        with self.assertRaises(KeyError):
+            PipelinedLoader(source, ListWriter(), batch_size=1).run()
+
+    def test_writer_error(self):
+
+        consumed = []
+
+        def source():
+            for i in range(10000):
+                consumed.append(i)
+                yield (i,)
+
+        with self.assertRaises(ValueError):
+            PipelinedLoader(source, ListWriter(fail_after=1), batch_size=10, queue_size=1).run()
+
+        # The parser stops soon after the writer fails
+        self.assertLess(len(consumed), 100)
+
+    def test_progress(self):
+
+        with NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('a\n' + ''.join('{}\n'.format(i % 10) for i in range(1000)))
+
+        reports = []
+
+        def callback(p):
+            reports.append((p.rows, p.fraction, p.eta, p.done))
+
+        try:
+            progress = LoadProgress('r', callback, total_bytes=2002)
+
+            loader = PipelinedLoader(lambda: mmap_csv_rows(f.name, ['a'], block_size=10, progress=progress),
+                                     ListWriter(), batch_size=100, progress=progress)
+
+            self.assertEqual(1000, loader.run())
+        finally:
+            remove(f.name)
+
+        self.assertEqual(11, len(reports))
+        self.assertEqual((1000, 1.0, 0.0, True), reports[-1])
+        self.assertEqual(2002, progress.bytes)
+
+        # Rows are estimated from the bytes read
+        rows, fraction, eta, done = reports[0]
+        self.assertEqual(100, rows)
+        self.assertAlmostEqual(0.1, fraction, delta=0.02)
+        self.assertIsNotNone(eta)
+
+        # Without a size or a row count, there is no ETA
+        p = LoadProgress('r', callback)
+        p.parsed(10)
+        p.wrote(10)
+        self.assertIsNone(p.fraction)
+        self.assertIsNone(p.eta)
+
+    def test_row_writer(self):
+
+        engine = create_engine('sqlite://')
+
+        with engine.begin() as conn:
+            conn.execute('CREATE TABLE t (a INTEGER, "b c" TEXT)')
+
+            loader = PipelinedLoader(lambda: ((i, str(i)) for i in range(7)),
+                                     RowWriter(conn, 't', ['a', 'b c']), batch_size=3)
+            loader.run()
+
+            self.assertEqual([(7, 21)], list(conn.execute('SELECT count(*), sum(a) FROM t')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import sqlite3
+import unittest
+from os import remove
+from os.path import exists
+
+from metapack_db import Database
+from metapack_db.migrations import MIGRATIONS, SCHEMA_VERSION
+
+test_database_path = '/tmp/test-migrations.db'
+
+# The catalog tables from before schema versions
+old_schema = """
+CREATE TABLE mt_documents (id INTEGER PRIMARY KEY, identifier VARCHAR NOT NULL UNIQUE,
+    name VARCHAR NOT NULL UNIQUE, name_nv VARCHAR NOT NULL, title VARCHAR, description VARCHAR,
+    dataset VARCHAR, origin VARCHAR, space VARCHAR, time VARCHAR, grain VARCHAR, variant VARCHAR,
+    created DATETIME, modified DATETIME, issued DATETIME, ref VARCHAR, package_url VARCHAR,
+    decl_sections TEXT, decl_terms TEXT, derived_terms TEXT, super_terms TEXT);
+CREATE TABLE mt_resources (id INTEGER PRIMARY KEY, document_id INTEGER NOT NULL,
+    resource_term_id INTEGER NOT NULL, name VARCHAR, source_url VARCHAR, table_name VARCHAR,
+    schema TEXT, table_created BOOLEAN, loaded BOOLEAN);
+"""
+
+
+class MigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        if exists(test_database_path):
+            remove(test_database_path)
+
+    def test_new_catalog(self):
+
+        db = Database('sqlite:///' + test_database_path)
+
+        self.assertEqual([], db.create_tables())
+        self.assertEqual([], db.create_tables())
+
+        c = sqlite3.connect(test_database_path)
+        self.assertEqual([(SCHEMA_VERSION,)], c.execute('SELECT version FROM mt_schema').fetchall())
+
+    def test_upgrade(self):
+
+        c = sqlite3.connect(test_database_path)
+        c.executescript(old_schema)
+        c.close()
+
+        self.assertEqual(MIGRATIONS, Database('sqlite:///' + test_database_path).create_tables())
+
+        c = sqlite3.connect(test_database_path)
+
+        columns = [r[1] for r in c.execute('PRAGMA table_info(mt_resources)')]
+        self.assertIn('storage_table', columns)
+        self.assertEqual([(SCHEMA_VERSION,)], c.execute('SELECT version FROM mt_schema').fetchall())
+
+        self.assertEqual([], Database('sqlite:///' + test_database_path).create_tables())
+
+    def test_concurrent_upgrade(self):
+        from threading import Thread
+
+        c = sqlite3.connect(test_database_path)
+        c.executescript(old_schema)
+        c.close()
+
+        results = []
+
+        def open_catalog():
+            results.append(Database('sqlite:///' + test_database_path).create_tables())
+
+        threads = [Thread(target=open_catalog) for i in range(4)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+        # The migrations ran once, under the lock, and the others found the catalog up to date
+        self.assertEqual([MIGRATIONS, [], [], []], sorted(results, key=len, reverse=True))
+
+        c = sqlite3.connect(test_database_path)
+        self.assertEqual([(SCHEMA_VERSION,)], c.execute('SELECT version FROM mt_schema').fetchall())
+
+
+if __name__ == '__main__':
+    unittest.main()
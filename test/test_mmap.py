@@ -0,0 +1,46 @@
+import unittest
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from metapack_db.loader import mmap_csv_rows
+
+
+class MmapCsvTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def write(self, data):
+        path = join(self.dir, 'data.csv')
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            f.write(data)
+        return path
+
+    def test_rows(self):
+
+        path = self.write('﻿id,name,value\r\n1,one,1.0\r\n2,"two, or ""2""",4.0\r\n\r\n3,three\r\n')
+
+        self.assertEqual([('1', '1.0', 'one'), ('2', '4.0', 'two, or "2"'), ('3', None, 'three')],
+                         list(mmap_csv_rows(path, ['id', 'value', 'name'])))
+
+        self.assertEqual([('1', None), ('2', None), ('3', None)], list(mmap_csv_rows(path, ['id', 'missing'])))
+
+    def test_blocks(self):
+
+        rows = [(str(i), 'line\nbreak {}'.format(i), 'é' * (i % 5)) for i in range(200)]
+
+        path = self.write('a,b,c\n' + ''.join('{},"{}",{}\n'.format(*r) for r in rows))
+
+        # Small blocks, so quoted newlines and multi-byte characters cross block boundaries
+        self.assertEqual(rows, list(mmap_csv_rows(path, ['a', 'b', 'c'], block_size=7)))
+
+    def test_empty(self):
+        self.assertEqual([], list(mmap_csv_rows(self.write(''), ['a'])))
+
+
+if __name__ == '__main__':
+    unittest.main()
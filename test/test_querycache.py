@@ -0,0 +1,79 @@
+import pickle
+import unittest
+from datetime import date, datetime, time
+from decimal import Decimal
+from os import makedirs
+from os.path import dirname
+from shutil import rmtree
+from tempfile import mkdtemp
+
+from metapack_db.querycache import QueryCache, normalize_sql
+
+
+class QueryCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.dir)
+
+    def test_normalize(self):
+
+        self.assertEqual("select * from t where a = 'A  b' and \"Col\" = 1",
+                         normalize_sql("SELECT *\n  FROM t WHERE a = 'A  b' AND \"Col\" = 1;"))
+
+        self.assertNotEqual(QueryCache.key('SELECT * FROM t', (), [('t', 1)]),
+                            QueryCache.key('SELECT * FROM t', (), [('t', 2)]))
+
+        self.assertEqual(QueryCache.key('SELECT * FROM t', (), [('t', 1), ('u', 1)]),
+                         QueryCache.key('select * from t', (), [('u', 1), ('t', 1)]))
+
+    def test_memory_lru(self):
+
+        qc = QueryCache(max_rows=4)
+
+        qc.put('a', [(1,), (2,)])
+        qc.put('b', [(3,), (4,)])
+        qc.get('a')
+        qc.put('c', [(5,)])  # Evicts b, the least recently used
+
+        self.assertEqual([(1,), (2,)], qc.get('a'))
+        self.assertIsNone(qc.get('b'))
+        self.assertEqual([(5,)], qc.get('c'))
+        self.assertEqual(1, qc.evictions)
+
+    def test_disk(self):
+
+        qc = QueryCache(self.dir, max_size=None)
+        qc.put('a' * 64, [(1, 'one')])
+
+        # Another cache, such as in another process, finds the result on disk
+        qc = QueryCache(self.dir)
+        self.assertEqual([(1, 'one')], qc.get('a' * 64))
+        self.assertEqual(1, qc.disk_hits)
+
+        qc.clear()
+        self.assertIsNone(QueryCache(self.dir).get('a' * 64))
+
+    def test_disk_types(self):
+
+        rows = [(1, 1.5, 'one', None, True, date(2017, 1, 2), datetime(2017, 1, 2, 3, 4, 5, 6), time(3, 4),
+                 Decimal('1.10'), b'\x00\xff', {'a': [1]})]
+
+        QueryCache(self.dir).put('b' * 64, rows)
+
+        self.assertEqual(rows, QueryCache(self.dir).get('b' * 64))
+
+        # Results are stored as JSON, so a file in the cache is never run as code
+        path = QueryCache(self.dir)._path('c' * 64)
+        makedirs(dirname(path), exist_ok=True)
+
+        with open(path, 'wb') as f:
+            f.write(pickle.dumps([(1,)]))
+
+        self.assertIsNone(QueryCache(self.dir).get('c' * 64))
+
+
+if __name__ == '__main__':
+    unittest.main()
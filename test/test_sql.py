@@ -0,0 +1,180 @@
+import threading
+import time
+import unittest
+from argparse import Namespace
+from os import remove
+from tempfile import NamedTemporaryFile
+
+from metapack_db.cli.sql import PackageResolver, index_sql, load_sql, sql_literal
+from metapack_db.resource import schema_indexes
+
+
+class Url(object):
+
+    def __init__(self, url):
+        self.base, _, self.target_file = url.partition('#')
+        self.proto = 'metapack' if self.base.startswith('metapack+') else 'file'
+
+    def clear_fragment(self):
+        return self.base
+
+
+class Target(object):
+
+    def __init__(self, path):
+        self.proto = 'file'
+        self.target_format = path.rsplit('.', 1)[-1]
+        self.fspath = path
+
+    def get_resource(self):
+        return self
+
+    def get_target(self):
+        return self
+
+
+class Res(object):
+
+    schema_term = True
+
+    def __init__(self, name, url, columns=(), rows=()):
+        self.name = name
+        self.resolved_url = Url(url)
+        self._columns = columns
+        self.iterdict = rows
+
+    def columns(self):
+        return iter(self._columns)
+
+
+class Package(object):
+
+    def __init__(self, name, resources):
+        self.name = name
+        self._resources = resources
+        self.default_resource = None
+
+    def resources(self):
+        return list(self._resources)
+
+    def resource(self, name):
+        return next(r for r in self._resources if r.name == name)
+
+
+packages = {
+    'a': Package('a', [Res('a1', 'a1.csv'), Res('b2', 'metapack+b#b2')]),
+    'c': Package('c', [Res('c1', 'c1.csv'), Res('b', 'metapack+b')]),
+    'metapack+b': Package('b', [Res('b1', 'b1.csv'), Res('b2', 'b2.csv')]),
+}
+
+
+class PackageResolverTests(unittest.TestCase):
+
+    def test_expand(self):
+
+        opened = []
+        lock = threading.Lock()
+
+        def opener(ref):
+            time.sleep(0.05 if ref == 'a' else 0)  # The first package finishes last
+            with lock:
+                opened.append(ref)
+            return packages[ref]
+
+        resolver = PackageResolver(max_workers=4, opener=opener)
+
+        expanded = [(p.name, r.name) for p, r in resolver.expand(['a', 'c'])]
+
+        self.assertEqual([('a', 'a1'), ('b', 'b2'), ('c', 'c1'), ('b', 'b1'), ('b', 'b2')], expanded)
+
+        # Each package is opened once, even though b is referenced twice
+        self.assertEqual(['a', 'c', 'metapack+b'], sorted(opened))
+
+        resolver.close()
+
+
+class LoadSqlTests(unittest.TestCase):
+
+    def setUp(self):
+        with NamedTemporaryFile('w', suffix='.csv', delete=False, newline='') as f:
+            f.write('id,name\r\n1,one\r\n')
+            self.path = f.name
+
+        columns = [{'header': 'id', 'datatype': 'integer'}, {'header': 'name', 'datatype': 'text'}]
+        rows = [{'id': i, 'name': "it's {}".format(i)} for i in range(3)]
+
+        self.r = Res('r', 'r.csv', columns, rows)
+        self.r.resolved_url = Target(self.path)
+
+        self.doc = Package('doc', [self.r])
+
+    def tearDown(self):
+        remove(self.path)
+
+    def args(self, dialect, **kwargs):
+        return Namespace(**dict(dict(dialect=dialect, inserts=False, batch_size=2, load_prog=None), **kwargs))
+
+    def test_bulk_load(self):
+
+        sql = load_sql(self.args('mysql'), self.doc, self.r)
+        self.assertTrue(sql.startswith('LOAD DATA LOCAL INFILE'))
+        self.assertIn("LINES TERMINATED BY '\\r\\n'", sql)
+        self.assertIn("SET id = NULLIF(@v0, ''), name = @v1;", sql)
+
+        sql = load_sql(self.args('postgresql'), self.doc, self.r)
+        self.assertTrue(sql.startswith('\\copy r_doc (id, name) FROM'))
+        self.assertIn('FORCE_NOT_NULL (name))', sql)
+
+        sql = load_sql(self.args('sqlite'), self.doc, self.r)
+        self.assertTrue(sql.startswith('.import --csv --skip 1'))
+
+        # With the columns in a different order than the table's, the rows are inserted by name
+        with open(self.path, 'w', newline='') as f:
+            f.write('name,id\r\none,1\r\n')
+
+        sql = load_sql(self.args('sqlite'), self.doc, self.r)
+        self.assertTrue(sql.startswith('INSERT INTO r_doc (id, name) VALUES'))
+
+        # With none of the table's columns, LOAD DATA would have nothing to set
+        with open(self.path, 'w', newline='') as f:
+            f.write('x,y\r\none,1\r\n')
+
+        sql = load_sql(self.args('mysql'), self.doc, self.r)
+        self.assertTrue(sql.startswith('INSERT INTO r_doc (id, name) VALUES'))
+
+    def test_inserts(self):
+
+        sql = load_sql(self.args('postgresql', inserts=True), self.doc, self.r)
+
+        self.assertEqual("INSERT INTO r_doc (id, name) VALUES\n(0, 'it''s 0'),\n(1, 'it''s 1');\n"
+                         "INSERT INTO r_doc (id, name) VALUES\n(2, 'it''s 2');", sql)
+
+        # Empty strings are values in string columns, and missing values in other columns
+        self.assertEqual(('NULL', "''"), (sql_literal('', 'mysql', 'integer'), sql_literal('', 'mysql', 'text')))
+        self.assertEqual('1', sql_literal(True, 'sqlite'))
+        self.assertEqual("'a\\\\b'", sql_literal('a\\b', 'mysql'))
+
+    def test_indexes(self):
+
+        schema = [{'header': 'id', 'primarykey': '1'}, {'header': 'geoid', 'unique': 'true'},
+                  {'header': 'state', 'foreignkey': 'states.id'}, {'header': 'county', 'index': 'no'}]
+
+        self.assertEqual([('pk_t', ('id',), True),
+                          ('uq_t_geoid', ('geoid',), True),
+                          ('ix_t_state', ('state',), False),
+                          ('ix_t_state_county', ('state', 'county'), False)],
+                         schema_indexes('t', schema, 'state; state, county'))
+
+        with self.assertRaises(ValueError):
+            schema_indexes('t', schema, 'city')
+
+        self.r._columns = [{'header': 'id', 'primarykey': '1'}, {'header': 'name'}]
+        self.r.properties = {'indexes': 'unique: name, id'}
+
+        self.assertEqual('CREATE UNIQUE INDEX pk_r_doc ON r_doc (id);\n'
+                         'CREATE UNIQUE INDEX uq_r_doc_name_id ON r_doc (name, id);',
+                         index_sql(self.args('sqlite'), self.doc, self.r))
+
+
+if __name__ == '__main__':
+    unittest.main()
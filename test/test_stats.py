@@ -0,0 +1,39 @@
+import unittest
+
+from metapack_db.stats import HyperLogLog, StatsCollector
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_collector(self):
+
+        c = StatsCollector(['id', 'color'], histogram_max=5)
+
+        c.update([(i, ['red', 'green', None][i % 3]) for i in range(0, 50)])
+        c.update([(i, ['red', 'green', None][i % 3]) for i in range(50, 100)])
+
+        id_stats, color_stats = c.stats()
+
+        self.assertEqual(100, id_stats['rows'])
+        self.assertEqual(0, id_stats['nulls'])
+        self.assertEqual(('0', '99'), (id_stats['min_value'], id_stats['max_value']))
+        self.assertIsNone(id_stats['histogram'])  # Too many distinct values
+        self.assertAlmostEqual(100, id_stats['distinct_count'], delta=5)
+
+        self.assertEqual(33, color_stats['nulls'])
+        self.assertEqual(2, color_stats['distinct_count'])
+        self.assertEqual([['red', 34], ['green', 33]], color_stats['histogram'])
+
+    def test_hll(self):
+
+        hll = HyperLogLog()
+
+        for i in range(20000):
+            hll.add(i)
+            hll.add(i)
+
+        self.assertAlmostEqual(20000, hll.count(), delta=20000 * .05)
+
+
+if __name__ == '__main__':
+    unittest.main()